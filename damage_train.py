@@ -10,17 +10,21 @@ from torch.utils import data as torch_data
 from torchvision import transforms, utils
 import segmentation_models_pytorch as smp
 from tabulate import tabulate
-from sklearn.metrics import confusion_matrix as confmatrix
 import wandb
 import matplotlib.pyplot as plt
 
 from unet import UNet
 from unet.dataloader import Xview2Detectron2DamageLevelDataset
+from unet.label_store import damage_one_hot_lut
 from unet.augmentations import *
+from unet.batch_augmentations import BatchRandomFlipRotate, BatchToDevice
+from unet.utils.image_cache import configure_image_cache, image_cache_stats
+from unet.labels_index import image_weights
 
 from experiment_manager.args import default_argument_parser
-from experiment_manager.metrics import MultiClassF1
+from experiment_manager.metrics import MultiClassF1, GroupedMultiClassF1, ConfusionMatrix, GroupedConfusionMatrix
 from experiment_manager.config import new_config
+from experiment_manager.utils import worker_kwargs
 from experiment_manager.loss import *
 from eval_unet_xview2 import inference_loop
 
@@ -62,18 +66,24 @@ def train_net(net,
         net = nn.DataParallel(net)
     net.to(device)
     bg_class = cfg.MODEL.BACKGROUND.TYPE
+    # Must exist before the DataLoader forks its workers
+    configure_image_cache(cfg.DATALOADER.IMAGE_CACHE_MB * 2**20)
     trfm = build_transforms(cfg, for_training=True, use_gts_mask=cfg.DATASETS.LOCALIZATION_MASK.TRAIN_USE_GTS_MASK)
     dataset = Xview2Detectron2DamageLevelDataset(cfg.DATASETS.TRAIN[0],
                                                  pre_or_post='post',
                                                  include_image_weight=True,
                                                  background_class=bg_class,
-                                                 transform=trfm)
+                                                 transform=trfm,
+                                                 use_label_store=cfg.DATASETS.USE_LABEL_STORE,
+                                                 use_tile_store=cfg.DATASETS.USE_TILE_STORE,
+                                                 use_labels_index=cfg.DATASETS.USE_LABELS_INDEX,
+                                                 crop_first=build_crop(cfg, for_training=True) if use_crop_first(cfg) else None)
 
     dataloader_kwargs = {
         'batch_size': cfg.TRAINER.BATCH_SIZE,
-        'num_workers': cfg.DATALOADER.NUM_WORKER,
         'shuffle':cfg.DATALOADER.SHUFFLE,
         'drop_last': True,
+        **worker_kwargs(cfg),
     }
 
     # sampler
@@ -85,6 +95,12 @@ def train_net(net,
 
     dataloader = torch_data.DataLoader(dataset, **dataloader_kwargs)
 
+    to_device = build_to_device(cfg, device, dataset.label_channels)
+    # Flips and rotations of whole batches on the training device, replaces RandomFlipRotate in the workers
+    batch_augment = None
+    if cfg.AUGMENTATION.RANDOM_FLIP_ROTATE and cfg.AUGMENTATION.BATCH_FLIP_ROTATE:
+        batch_augment = BatchRandomFlipRotate()
+
     max_epochs = cfg.TRAINER.EPOCHS
     global_step = 0
     for epoch in range(max_epochs):
@@ -97,9 +113,10 @@ def train_net(net,
         loss_component_set = []
         positive_pixels_set = [] # Used to evaluated image over sampling techniques
         for i, batch in enumerate(dataloader):
-            x = batch['x'].to(device)
-            y_gts = batch['y'].to(device)
+            x, y_gts = to_device(batch['x'], batch['y'])
             image_weight = batch['image_weight']
+            if batch_augment:
+                x, y_gts = batch_augment(x, y_gts)
 
             # # TODO DEBUG
             # xtest  = x.cpu().permute(0,2,3,1).contiguous().numpy()
@@ -157,6 +174,7 @@ def train_net(net,
                     'gpu_memory': max_mem,
                     'time': time_per_n_batches,
                     'total_positive_pixels': np.mean(positive_pixels_set),
+                    'image_cache_hit_rate': image_cache_stats()['hit_rate'],
                     'step': global_step,
                 }
 
@@ -186,10 +204,10 @@ def dmg_model_eval(net, cfg, device,
     :return:
     '''
     measurer = MultiClassF1(ignore_last_class=cfg.MODEL.BACKGROUND.TYPE=='new-class')
-    diaster_type_measurers = {}
+    diaster_type_measurers = GroupedMultiClassF1(ignore_last_class=cfg.MODEL.BACKGROUND.TYPE == 'new-class')
 
-    confusion_matrix_with_bg = []
-    confusion_matrices_by_disaster_type = {}
+    confusion_matrix_with_bg = ConfusionMatrix(num_classes=5)
+    confusion_matrices_by_disaster_type = GroupedConfusionMatrix(num_classes=5)
     component_f1 = []
     def evaluate(x, y_true, y_pred, img_filenames):
         if cfg.MODEL.BACKGROUND.MASK_OUTPUT:
@@ -205,43 +223,44 @@ def dmg_model_eval(net, cfg, device,
 
         # === Confusion Matrix stuff
         if use_confusion_matrix:
-            y_true_flat = y_true.argmax(dim=1).cpu().detach().numpy()
-            y_pred_flat = torch.softmax(y_pred, dim=1).argmax(dim=1).cpu().detach().numpy()
-            labels = [0, 1, 2, 3, 4] # 5 classes
-            _mat = confmatrix(y_true_flat.flatten(), y_pred_flat.flatten(), labels = labels)
-            confusion_matrix_with_bg.append(_mat)
+            # Accumulated on the device, argmax of the softmax is the argmax
+            confusion_matrix_with_bg.add_sample(y_true.argmax(dim=1), y_pred.argmax(dim=1))
 
         #=== Breakdown by image class
         # Disaster type
         if include_disaster_type_breakdown:
-            for i, img_filename in enumerate(img_filenames):
-                # Compute F1
-                disaster_type = img_filename.split('_')[0]
-                if disaster_type not in diaster_type_measurers:
-                    diaster_type_measurers[disaster_type] = MultiClassF1(ignore_last_class=cfg.MODEL.BACKGROUND.TYPE == 'new-class')
-                    confusion_matrices_by_disaster_type[disaster_type] = 0
-                diaster_type_measurers[disaster_type].add_sample(y_true[[i]], y_pred[[i]])
-
-                # Compute Confusion Matrix
-                if use_confusion_matrix:
-                    _mat = confmatrix(y_true_flat[i].flatten(), y_pred_flat[i].flatten(), labels=labels)
-                    confusion_matrices_by_disaster_type[disaster_type] += _mat
+            # All the images of the batch are added to their disaster type at once
+            disaster_types = [img_filename.split('_')[0] for img_filename in img_filenames]
+            diaster_type_measurers.add_sample(y_true, y_pred, disaster_types)
+
+            # Compute Confusion Matrix
+            if use_confusion_matrix:
+                confusion_matrices_by_disaster_type.add_sample(y_true.argmax(dim=1), y_pred.argmax(dim=1), disaster_types)
 
     use_gts_mask = run_type == 'TRAIN' and cfg.DATASETS.LOCALIZATION_MASK.TRAIN_USE_GTS_MASK
     dset_source = cfg.DATASETS.TEST[0] if run_type == 'TEST' else cfg.DATASETS.TRAIN[0]
 
-    trfm = build_transforms(cfg, use_gts_mask = use_gts_mask)
     bg_class = 'new-class' if cfg.MODEL.BACKGROUND.TYPE == 'new-class' else None
-    dataset = Xview2Detectron2DamageLevelDataset(dset_source,
-                                                 pre_or_post='post',
-                                                 transform=trfm,
-                                                 background_class=bg_class,)
+    def build_dataset():
+        trfm = build_transforms(cfg, use_gts_mask = use_gts_mask)
+        return Xview2Detectron2DamageLevelDataset(dset_source,
+                                                  pre_or_post='post',
+                                                  transform=trfm,
+                                                  background_class=bg_class,
+                                                  use_label_store=cfg.DATASETS.USE_LABEL_STORE,
+                                                  use_tile_store=cfg.DATASETS.USE_TILE_STORE,
+                                                  use_labels_index=cfg.DATASETS.USE_LABELS_INDEX,
+                                                  crop_first=build_crop(cfg) if use_crop_first(cfg) else None)
+    label_channels = damage_one_hot_lut(bg_class).shape[1]
+    # Only built on the first evaluation of each set, the loader and its workers are reused afterwards
     inference_loop(net, cfg, device, evaluate,
                    batch_size=cfg.TRAINER.INFERENCE_BATCH_SIZE,
                    run_type='TRAIN',
                    max_samples = max_samples,
-                   dataset = dataset,
-                   callback_include_x=True)
+                   dataset = build_dataset,
+                   callback_include_x=True,
+                   to_device=build_to_device(cfg, device, label_channels),
+                   cache_key=('damage', dset_source, use_gts_mask))
 
     # Summary gathering ===
 
@@ -289,7 +308,7 @@ def dmg_model_eval(net, cfg, device,
 
     # Plot confusion matrix
     if use_confusion_matrix:
-        cm = np.sum(confusion_matrix_with_bg, axis=0)
+        cm = confusion_matrix_with_bg.matrix
         plot_confmtx(name=run_type, confusion_matrix=cm)
         log_data['confusion_matrix'] = plt
 
@@ -362,22 +381,49 @@ def load_pretrained(net:nn.Module, cfg):
 
 def build_transforms(cfg, for_training=False, use_gts_mask = False):
     trfm = []
-    trfm.append(BGR2RGB())
+    if cfg.DATASETS.LOCALIZATION_MASK.ENABLED or cfg.DATASETS.INCLUDE_PRE_DISASTER:
+        # Stacked inputs are assembled in one float buffer instead of being concatenated channel group by group
+        num_channels = 3 + int(cfg.DATASETS.LOCALIZATION_MASK.ENABLED) + 3 * int(cfg.DATASETS.INCLUDE_PRE_DISASTER)
+        trfm.append(PreallocateChannels(num_channels, dtype=np.float32))
+    else:
+        trfm.append(BGR2RGB())
 
     if cfg.DATASETS.LOCALIZATION_MASK.ENABLED: trfm.append(IncludeLocalizationMask(use_gts_mask))
     if cfg.DATASETS.INCLUDE_PRE_DISASTER: trfm.append(StackPreDisasterImage())
     if cfg.AUGMENTATION.RESIZE: trfm.append(Resize(scale=cfg.AUGMENTATION.RESIZE_RATIO))
-    if cfg.AUGMENTATION.CROP_TYPE == 'uniform' and for_training:
-        trfm.append(UniformCrop(crop_size=cfg.AUGMENTATION.CROP_SIZE))
-    elif cfg.AUGMENTATION.CROP_TYPE == 'importance':
-        trfm.append(ImportanceRandomCrop(crop_size=cfg.AUGMENTATION.CROP_SIZE))
-    if cfg.AUGMENTATION.RANDOM_FLIP_ROTATE:
+    crop = build_crop(cfg, for_training)
+    if crop is not None and not use_crop_first(cfg): trfm.append(crop)
+    if cfg.AUGMENTATION.RANDOM_FLIP_ROTATE and not cfg.AUGMENTATION.BATCH_FLIP_ROTATE:
         trfm.append(RandomFlipRotate())
-    trfm.append(Npy2Torch())
+    # Labels only stay binary without interpolating augmentations in the workers
+    label_as_index = not (cfg.AUGMENTATION.RESIZE or any(isinstance(t, RandomFlipRotate) for t in trfm))
+    trfm.append(Npy2Torch(keep_uint8=cfg.DATALOADER.UINT8_TRANSPORT, label_as_index=label_as_index))
     if cfg.AUGMENTATION.ENABLE_VARI: trfm.append(VARI())
     trfm = transforms.Compose(trfm)
     return trfm
 
+def build_to_device(cfg, device, label_channels):
+    '''
+    Converts uint8 transported batches back to what Npy2Torch used to produce: plain images are scaled to [0, 1],
+    inputs that were float in the workers (stacked with the mask or the pre disaster image) are not, VARI is in [0, 1]
+    '''
+    float_input = cfg.DATASETS.LOCALIZATION_MASK.ENABLED or cfg.DATASETS.INCLUDE_PRE_DISASTER
+    num_channels = 3 + int(cfg.DATASETS.LOCALIZATION_MASK.ENABLED) + 3 * int(cfg.DATASETS.INCLUDE_PRE_DISASTER)
+    input_scale = [1. if float_input else 1 / 255] * num_channels
+    if cfg.AUGMENTATION.ENABLE_VARI: input_scale.append(1 / 255)
+    return BatchToDevice(device, input_scale, label_channels)
+
+def build_crop(cfg, for_training=False):
+    if cfg.AUGMENTATION.CROP_TYPE == 'uniform' and for_training:
+        return UniformCrop(crop_size=cfg.AUGMENTATION.CROP_SIZE)
+    elif cfg.AUGMENTATION.CROP_TYPE == 'importance':
+        return ImportanceRandomCrop(crop_size=cfg.AUGMENTATION.CROP_SIZE)
+    return None
+
+def use_crop_first(cfg):
+    # The dataset crops before the input and the sibling images are read, every transform placed before the crop is per pixel except Resize
+    return cfg.AUGMENTATION.CROP_FIRST and not cfg.AUGMENTATION.RESIZE
+
 def combo_loss(p, y, class_weights=None):
     y_ = y.argmax(dim=1).long()
     ce = F.cross_entropy(p, y_, weight=class_weights)
@@ -388,7 +434,7 @@ def combo_loss(p, y, class_weights=None):
 def image_sampling_weight(dataset_metadata):
     print('performing oversampling...', end='', flush=True)
     EMPTY_IMAGE_BASELINE = 1000
-    image_p = np.array([image_desc['post']['image_weight'] for image_desc in dataset_metadata]) + EMPTY_IMAGE_BASELINE
+    image_p = image_weights(dataset_metadata, 'post') + EMPTY_IMAGE_BASELINE
     print('done', flush=True)
     # normalize to [0., 1.]
     image_p = image_p
@@ -434,11 +480,7 @@ def setup(args):
         cfg.DATASETS.TRAIN = (args.data_dir,)
     return cfg
 
-if __name__ == '__main__':
-    args = default_argument_parser().parse_known_args()[0]
-    cfg = setup(args)
-
-    out_channels = cfg.MODEL.OUT_CHANNELS
+def build_net(cfg):
     if cfg.MODEL.BACKBONE.ENABLED:
         if cfg.MODEL.COMPLEX_ARCHITECTURE.ENABLED:
             if cfg.MODEL.COMPLEX_ARCHITECTURE.TYPE == 'pspnet':
@@ -458,16 +500,25 @@ if __name__ == '__main__':
             )
     else:
         net = UNet(cfg)
+    return net
+
+def load_checkpoint(net, full_model_path):
+    # Removing the module.** in front of keys
+    filtered_dict = {}
+    for k, v in torch.load(full_model_path).items():
+        k = '.'.join(k.split('.')[1:])
+        filtered_dict[k] = v
+    net.load_state_dict(filtered_dict)
+    print('Model loaded from {}'.format(full_model_path))
+    return net
+
+if __name__ == '__main__':
+    args = default_argument_parser().parse_known_args()[0]
+    cfg = setup(args)
 
+    net = build_net(cfg)
     if args.resume_from:
-        full_model_path = path.join(cfg.OUTPUT_DIR, args.resume_from)
-        # Removing the module.** in front of keys
-        filtered_dict = {}
-        for k, v in torch.load(full_model_path).items():
-            k = '.'.join(k.split('.')[1:])
-            filtered_dict[k] = v
-        net.load_state_dict(filtered_dict)
-        print('Model loaded from {}'.format(full_model_path))
+        load_checkpoint(net, path.join(cfg.OUTPUT_DIR, args.resume_from))
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     # cudnn.benchmark = True # faster convolutions, but more memory
@@ -143,9 +143,8 @@ class Trainer(object):
             loss = self.criterion(output, target)
             test_loss += loss.item()
             tbar.set_description('Test loss: %.3f' % (test_loss / (i + 1)))
-            pred = output.data.cpu().numpy()
-            target = target.cpu().numpy()
-            pred = np.argmax(pred, axis=1)
+            # Stays on the device, the evaluator only syncs when the scores are computed
+            pred = output.data.argmax(dim=1)
             # Add batch sample into evaluator
             self.evaluator.add_batch(target, pred)
 
@@ -1,10 +1,18 @@
 import numpy as np
+import torch
+
+from experiment_manager.metrics import ConfusionMatrix
 
 
 class Evaluator(object):
     def __init__(self, num_class):
         self.num_class = num_class
-        self.confusion_matrix = np.zeros((self.num_class,)*2)
+        # Accumulated on the device of the batches, synced to the host when the scores are computed
+        self.accumulator = ConfusionMatrix(num_class)
+
+    @property
+    def confusion_matrix(self):
+        return self.accumulator.matrix.astype(np.float64)
 
     def Pixel_Accuracy(self):
         Acc = np.diag(self.confusion_matrix).sum() / self.confusion_matrix.sum()
@@ -31,19 +39,20 @@ class Evaluator(object):
         FWIoU = (freq[freq > 0] * iu[freq > 0]).sum()
         return FWIoU
 
-    def _generate_matrix(self, gt_image, pre_image):
-        mask = (gt_image >= 0) & (gt_image < self.num_class)
-        label = self.num_class * gt_image[mask].astype('int') + pre_image[mask]
-        count = np.bincount(label, minlength=self.num_class**2)
-        confusion_matrix = count.reshape(self.num_class, self.num_class)
-        return confusion_matrix
-
     def add_batch(self, gt_image, pre_image):
+        '''
+        :param gt_image: [B, H, W] labels, tensor or numpy array
+        :param pre_image: [B, H, W] predicted classes, tensor or numpy array
+        '''
         assert gt_image.shape == pre_image.shape
-        self.confusion_matrix += self._generate_matrix(gt_image, pre_image)
+        if isinstance(gt_image, np.ndarray):
+            gt_image = torch.from_numpy(gt_image)
+        if isinstance(pre_image, np.ndarray):
+            pre_image = torch.from_numpy(pre_image)
+        self.accumulator.add_sample(gt_image, pre_image)
 
     def reset(self):
-        self.confusion_matrix = np.zeros((self.num_class,) * 2)
+        self.accumulator.reset()
 
 
 
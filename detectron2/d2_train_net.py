@@ -27,6 +27,7 @@ from detectron2.engine import DefaultTrainer, default_argument_parser, default_s
 from detectron2.evaluation import COCOEvaluator, DatasetEvaluators, verify_results
 from detectron2.utils.logger import setup_logger
 from eval_util.xview2_cocoeval import Xview2COCOEvaluator
+from unet.labels_index import load_labels
 
 class Trainer(DefaultTrainer):
     @classmethod
@@ -68,23 +69,41 @@ def setup(args):
 
 
 def get_building_dicts(img_dir, transform=False):
-    json_file = os.path.join(img_dir, "labels.json")
-    with open(json_file) as f:
-        imgs_anns = json.load(f)
+    # Read through the columnar labels index (built on first use) instead of parsing the whole labels.json
+    labels = load_labels(img_dir, use_index=True)
+    has_img_id = labels.has_column('img_id')
+    has_size = labels.has_column('height') and labels.has_column('width')
+    # labels.json annotations without these keys are single class buildings
+    has_category = labels.has_column('category_id')
+    has_iscrowd = labels.has_column('iscrowd')
     dataset_dicts = []
-    for v in imgs_anns:
+    for i in range(len(labels)):
         record = {}
-        filename = os.path.join(img_dir, v["file_name"])
-
         # Convert relative file name to absolute filename
-        v["file_name"] = filename
-        # Convert bbox mode to objects
-        v['image_id'] = v['img_id']
-        for anno in v['annotations']:
-            anno['bbox_mode'] = BoxMode.XYXY_ABS
+        record["file_name"] = os.path.join(img_dir, str(labels.column('file_name')[i]))
+        record["image_id"] = int(labels.column('img_id')[i]) if has_img_id else i
+        # Left out when labels.json has no sizes, detectron2 then takes them from the image
+        if has_size:
+            record["height"] = int(labels.column('height')[i])
+            record["width"] = int(labels.column('width')[i])
+
+        num_annotations = labels.num_annotations(i)
+        category_ids = labels.annotation_column('category_id', i) if has_category else np.zeros(num_annotations, int)
+        iscrowd = labels.annotation_column('iscrowd', i) if has_iscrowd else np.zeros(num_annotations, int)
+        objs = []
+        for polygons, bbox, category_id, crowd in zip(labels.segmentations(i), labels.bboxes(i), category_ids, iscrowd):
+            objs.append({
+                "bbox": bbox.tolist(),
+                "bbox_mode": BoxMode.XYXY_ABS,
+                "segmentation": [polygon.reshape(-1).tolist() for polygon in polygons],
+                "category_id": int(category_id),
+                "iscrowd": int(crowd)
+            })
+        record["annotations"] = objs
+        dataset_dicts.append(record)
 
     print('metadata loading complete!')
-    return imgs_anns
+    return dataset_dicts
 
 def main(args):
     cfg = setup(args)
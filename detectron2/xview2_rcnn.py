@@ -25,6 +25,8 @@ import json
 
 import itertools
 
+from unet.labels_index import load_labels
+
 
 
 # write a function that loads the dataset into detectron2's standard format
@@ -68,28 +70,26 @@ def get_balloon_dicts(img_dir):
     return dataset_dicts
 
 def get_building_dicts(img_dir):
-    json_file = os.path.join(img_dir, "labels.json")
-    with open(json_file) as f:
-        imgs_anns = json.load(f)
+    # Read through the columnar labels index (built on first use) instead of parsing the whole labels.json
+    labels = load_labels(img_dir, use_index=True)
+    has_size = labels.has_column('height') and labels.has_column('width')
 
     dataset_dicts = []
-    for v in imgs_anns:
+    for i in range(len(labels)):
         record = {}
-        filename = os.path.join(img_dir, v["file_name"])
+        filename = os.path.join(img_dir, str(labels.column('file_name')[i]))
         record["file_name"] = filename
-        record["height"] = v['height']
-        record["width"] = v['width']
+        # Left out when labels.json has no sizes, detectron2 then takes them from the image
+        if has_size:
+            record["height"] = int(labels.column('height')[i])
+            record["width"] = int(labels.column('width')[i])
 
-        annos = v["annotations"]
         objs = []
-        for polygon_pairs in annos:
-
-            poly = list(itertools.chain.from_iterable(polygon_pairs))
-            px, py = np.array(polygon_pairs).T
+        for polygon, bbox in zip(labels.polygons(i), labels.bboxes(i)):
             obj = {
-                "bbox": [np.min(px), np.min(py), np.max(px), np.max(py)],
+                "bbox": bbox.tolist(),
                 "bbox_mode": BoxMode.XYXY_ABS,
-                "segmentation": [poly],
+                "segmentation": [polygon.reshape(-1).tolist()],
                 "category_id": 0,
                 "iscrowd": 0
             }
@@ -1,9 +1,10 @@
 import sys
 import os
+import copy
 from os import path, listdir
 from os.path import join, isfile
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
 
 import numpy as np
 import torch
@@ -18,15 +19,26 @@ from tabulate import tabulate
 
 from unet import UNet
 from unet.dataloader import Xview2Detectron2Dataset, Xview2Detectron2DamageLevelDataset
-from experiment_manager.metrics import roc_score, f1_score, MultiThresholdMetric, MultiClassF1
+from experiment_manager.metrics import roc_score, f1_score, MultiThresholdMetric, MultiClassF1, HistogramMetric, GroupedHistogramMetric
+from experiment_manager.instance_metrics import InstanceMatchingMetric, instance_worker_pool
 from experiment_manager.args import default_argument_parser
 from experiment_manager.config import new_config
-from experiment_manager.utils import to_numpy
-from experiment_manager.dataset import SimpleInferenceDataset
+from experiment_manager.utils import to_numpy, worker_kwargs
+from experiment_manager.dataset import SimpleInferenceDataset, PrePostInferenceDataset
+from unet.batch_augmentations import BatchToDevice
+from unet.tiled_inference import TiledInference
+from unet.utils.utils import AsyncImageWriter
+from unet.label_store import NUM_DAMAGE_CLASSES
 from sklearn.metrics import roc_auc_score, average_precision_score, roc_curve
 from unet.augmentations import *
 # import hp
 
+# Probability bins of the metric histograms, the thresholds are the bin edges
+METRIC_BINS = 1000
+F1_BINS = 100
+# Checkpoints (net replicas) on the device at once in the checkpoints sweep, more checkpoints take further passes
+SWEEP_REPLICAS = 4
+
 def final_model_evaluation_runner(net, cfg):
     '''
     Runner that only concerns with only a single model,
@@ -36,27 +48,19 @@ def final_model_evaluation_runner(net, cfg):
     print('=== Evaluating final model ===')
     # Setup
 
-    F1_THRESH = torch.linspace(0, 1, 100).to(device)
-    y_true_set = []
-    y_pred_set = []
-    measurer = MultiThresholdMetric(F1_THRESH)
-    diaster_type_measurers = {}
+    # Streaming histograms over the whole set, curves are exact at the bin resolution
+    measurer = HistogramMetric(METRIC_BINS)
+    diaster_type_measurers = GroupedHistogramMetric(METRIC_BINS)
 
     def evaluate(y_true, y_pred, img_filenames):
         y_true = y_true.detach()
         y_pred = y_pred.detach()
-        y_true_set.append(y_true.cpu())
-        y_pred_set.append(y_pred.cpu())
 
         measurer.add_sample(y_true, y_pred)
 
-        # ==== Find Threshold per damage level
-        for idx, img_filename in enumerate(img_filenames):
-            disaster_type = img_filename.split('_')[0]
-            if disaster_type not in diaster_type_measurers.keys():
-                diaster_type_measurers[disaster_type] = MultiThresholdMetric(F1_THRESH)
-
-            diaster_type_measurers[disaster_type].add_sample(y_true[[idx],...], y_pred[[idx],...])
+        # ==== Find Threshold per disaster type
+        disaster_types = [img_filename.split('_')[0] for img_filename in img_filenames]
+        diaster_type_measurers.add_sample(y_true, y_pred, disaster_types)
 
 
     inference_loop(net, cfg, device, evaluate)
@@ -64,32 +68,28 @@ def final_model_evaluation_runner(net, cfg):
     # ===
     # Collect for summary
 
-    y_true_set = torch.cat(y_true_set, dim = 0).round()
-    y_pred_set = torch.cat(y_pred_set, dim=0)
-
-    y_true_set, y_pred_set = downsample_dataset_for_eval(y_true_set, y_pred_set)
-
-    y_true_np = to_numpy(y_true_set.flatten())
-    y_pred_np = to_numpy(y_pred_set.flatten())
-
     # F1 score
     print('Computing F1 vs thresholds', flush=True)
-    f1 = measurer.compute_f1().cpu().numpy()
-    plt.plot(np.arange(0, 100, 1, dtype=np.int32), f1)
+    thresholds = measurer.thresholds.numpy()
+    f1 = measurer.compute_f1().numpy()
+    plt.plot(thresholds, f1)
     plt.ylabel('f1 score')
     plt.xlabel('threshold ')
     plt.title('F1 vs threshold curve')
 
     wandb.log({'f1 vs threshold': plt})
     wandb.log({
-        'total False Negative': measurer.FN.cpu(),
-        'total False Positive': measurer.FP.cpu(),
+        'total False Negative': measurer.FN[f1.argmax()],
+        'total False Positive': measurer.FP[f1.argmax()],
+        'best threshold': thresholds[f1.argmax()],
+        'roc auc': measurer.compute_roc_auc(),
+        'average precision': measurer.compute_average_precision(),
                })
 
     for disaster_type, m in diaster_type_measurers.items():
-        f1 = m.compute_f1().cpu().numpy()
+        f1 = m.compute_f1().numpy()
 
-        plt.plot(np.arange(0, 100, 1, dtype=np.int32), f1)
+        plt.plot(thresholds, f1)
         plt.ylabel('f1 score')
         plt.xlabel('threshold ')
         plt.title('F1 vs threshold curve')
@@ -102,18 +102,10 @@ def final_model_evaluation_runner(net, cfg):
         })
 
     print('computing ROC curve', flush=True)
-    # ROC curve
-    fpr, tpr, thresh = roc_curve(y_true_np, y_pred_np)
-
-    # Down sample roc curve or matplotlib won't like it
-    num_ele = len(fpr)
-    downsample_idx = np.linspace(0, num_ele, 1000, dtype=np.int32, endpoint=False)
-    fpr_downsampled = fpr[downsample_idx]
-    tpr_downsampled = tpr[downsample_idx]
+    # ROC curve, one point per bin
+    fpr, tpr = measurer.compute_roc()
 
-
-
-    plt.plot(fpr_downsampled, tpr_downsampled)
+    plt.plot(fpr.numpy(), tpr.numpy())
     plt.plot([0, 1], [0, 1], color='navy', linestyle='--')
     plt.ylabel('true_positive rate')
     plt.xlabel('false_positive rate')
@@ -126,214 +118,241 @@ def final_model_evaluation_runner(net, cfg):
 
     print('done')
 
-def model_checkpoints_eval_runner(net, cfg):
+def model_checkpoints_eval_runner(net, cfg, max_replicas=SWEEP_REPLICAS):
 
     checkpoint_files = list_and_sort_checkpoint_files()
 
-    for cp_num, cp_file in checkpoint_files:
-        print(' ==== checkpoint', cp_file)
-        full_model_path = os.path.join(cfg.OUTPUT_DIR, cp_file)
-        net.load_state_dict(torch.load(full_model_path))
+    # One data pass per set for all the checkpoints
+    # TRAINING EVALUATION
+    checkpoints_sweep_eval(net, cfg, device, checkpoint_files, run_type='TRAIN', max_replicas=max_replicas)
 
-        # TRAINING EVALUATION
-        model_eval(net, cfg, device, run_type='TRAIN', step=cp_num)
+    # TEST SET EVALUATION
+    checkpoints_sweep_eval(net, cfg, device, checkpoint_files, run_type='TEST', max_replicas=max_replicas)
 
-        # TEST SET EVALUATION
-        model_eval(net, cfg, device, run_type='TEST', step=cp_num)
+def upscale_predictions(cfg, y_pred):
+    # interp image if scaling was originally enabled
+    if cfg.AUGMENTATION.RESIZE:
+        upscale_ratio = 1 / cfg.AUGMENTATION.RESIZE_RATIO
+        y_pred = torch.nn.functional.interpolate(y_pred,
+                                                 scale_factor=upscale_ratio,
+                                                 mode='bilinear')
+    return y_pred
 
-def localization_inference(net, cfg):
+def threshold_predictions(cfg, y_pred, threshold):
     '''
-    This method is for running inference on the actual dataset
-    :return:
+    Upsamples (if scaling was originally enabled) and thresholds a batch of predictions on the device
+    :return: [B, H, W] uint8 masks, on the device
     '''
-    inference_dataset = cfg.DATASETS.INFERENCE[0]
-    THRESHOLD = cfg.THRESH
-    dataset = SimpleInferenceDataset(inference_dataset, downsample_scale= cfg.AUGMENTATION.RESIZE_RATIO, filter='test_pre')
-    from PIL import Image
-
-    def save_to_png(y_true, y_pred, img_filenames):
-        # Y_pred activation
-
-        # interp image if scaling was originally enabled
-        if cfg.AUGMENTATION.RESIZE:
-            upscale_ratio = 1 / cfg.AUGMENTATION.RESIZE_RATIO
-            y_pred = torch.nn.functional.interpolate(y_pred,
-                                                     scale_factor=upscale_ratio,
-                                                     mode='bilinear')
-
-        y_pred = (y_pred > THRESHOLD).type(torch.uint8)
-
-        y_pred = y_pred.squeeze().cpu().numpy()
-        img_filename = img_filenames[0]
-        inference_dir = os.path.join(cfg.OUTPUT_DIR, 'predictions')
-        os.makedirs(inference_dir, exist_ok=True)
-
-
-
-        if img_filename.startswith('test'): # for the real dataset
-            test, pre, num_png = str.split(img_filename, '_')
-            num, png = str.split(num_png, '.')
-            test_localization_num_pred = '_'.join([test,'localization', num, 'prediction'])
-            img_filename = test_localization_num_pred + '.png'
-
-            test_damage_num_pred = '_'.join([test, 'damage', num, 'prediction'])
-            dmg_img_filename = test_damage_num_pred + '.png'
-
-        img_save_dir = os.path.join(inference_dir, img_filename)
-        dmg_img_save_dir = os.path.join(inference_dir, dmg_img_filename)
-        im = Image.fromarray(y_pred, mode='L')
-        im.save(img_save_dir)
-        im.save(dmg_img_save_dir)
-
+    y_pred = upscale_predictions(cfg, y_pred)
+    return (y_pred[:, 0] > threshold).type(torch.uint8)
 
+def submission_filenames(img_filename):
+    '''
+    xView2 submission names, e.g. test_pre_00000.png -> test_localization_00000_prediction.png and
+    test_damage_00000_prediction.png. Other images keep their name.
+    '''
+    if not img_filename.startswith('test'): # for the real dataset
+        return [img_filename]
+    test, pre, num_png = str.split(img_filename, '_')
+    num, png = str.split(num_png, '.')
+    test_localization_num_pred = '_'.join([test, 'localization', num, 'prediction'])
+    test_damage_num_pred = '_'.join([test, 'damage', num, 'prediction'])
+    return [test_localization_num_pred + '.png', test_damage_num_pred + '.png']
 
-    inference_loop(net, cfg, device, save_to_png, dataset=dataset)
-
-    return
-
-def damage_level_inference(net, cfg):
+def localization_inference(net, cfg):
     '''
     This method is for running inference on the actual dataset
     :return:
     '''
     inference_dataset = cfg.DATASETS.INFERENCE[0]
     THRESHOLD = cfg.THRESH
-    # TODO Transforms for loading pre images
-    # TODO Transform for generate masks and load masks (If the loc model has predictions, then use that instead)
-    dataset = SimpleInferenceDataset(inference_dataset, downsample_scale= cfg.AUGMENTATION.RESIZE_RATIO)
-    from PIL import Image
-
-    def save_to_png(y_true, y_pred, img_filenames):
-        # Y_pred activation
-
-        # interp image if scaling was originally enabled
-        if cfg.AUGMENTATION.RESIZE:
-            upscale_ratio = 1 / cfg.AUGMENTATION.RESIZE_RATIO
-            y_pred = torch.nn.functional.interpolate(y_pred,
-                                                     scale_factor=upscale_ratio,
-                                                     mode='bilinear')
-
-        y_pred = (y_pred > THRESHOLD).type(torch.uint8)
-
-        y_pred = y_pred.squeeze().cpu().numpy()
-        img_filename = img_filenames[0]
-        inference_dir = os.path.join(cfg.OUTPUT_DIR, 'predictions')
-        os.makedirs(inference_dir, exist_ok=True)
-
-
+    dataset = SimpleInferenceDataset(inference_dataset, downsample_scale= cfg.AUGMENTATION.RESIZE_RATIO, filter='test_pre',
+                                     keep_uint8=cfg.DATALOADER.UINT8_TRANSPORT)
+    inference_dir = os.path.join(cfg.OUTPUT_DIR, 'predictions')
+    os.makedirs(inference_dir, exist_ok=True)
+
+    with AsyncImageWriter(cfg.DATALOADER.NUM_WRITER) as writer:
+        def save_to_png(y_true, y_pred, img_filenames):
+            y_pred = threshold_predictions(cfg, y_pred, THRESHOLD).cpu().numpy()
+            for mask, img_filename in zip(y_pred, img_filenames):
+                # The damage prediction is the localization until the damage model is plugged in
+                for filename in submission_filenames(img_filename):
+                    writer.write(os.path.join(inference_dir, filename), mask)
+
+        # SimpleInferenceDataset only reads the image, its uint8 batches are always scaled to [0, 1]
+        inference_loop(net, cfg, device, save_to_png, dataset=dataset, to_device=BatchToDevice(device),
+                       batch_size=cfg.TRAINER.INFERENCE_BATCH_SIZE)
 
-        if img_filename.startswith('test'): # for the real dataset
-            test, pre, num_png = str.split(img_filename, '_')
-            num, png = str.split(num_png, '.')
-            test_localization_num_pred = '_'.join([test,'localization', num, 'prediction'])
-            img_filename = test_localization_num_pred + '.png'
+    return
 
-            test_damage_num_pred = '_'.join([test, 'damage', num, 'prediction'])
-            dmg_img_filename = test_damage_num_pred + '.png'
+def downscale_input(cfg, x):
+    # Same scaling as the Resize transform of the model's pipeline
+    if cfg.AUGMENTATION.RESIZE:
+        x = torch.nn.functional.interpolate(x, scale_factor=cfg.AUGMENTATION.RESIZE_RATIO, mode='area')
+    return x
 
-        img_save_dir = os.path.join(inference_dir, img_filename)
-        dmg_img_save_dir = os.path.join(inference_dir, dmg_img_filename)
-        im = Image.fromarray(y_pred, mode='L')
-        im.save(img_save_dir)
-        im.save(dmg_img_save_dir)
+def damage_model_input(dmg_cfg, post, loc_mask, pre):
+    '''
+    Builds the damage model input on the device, with the channels of damage_train.build_transforms
+    :param post: [B, 3, H, W] uint8 RGB post disaster images
+    :param loc_mask: [B, H, W] 0 / 1 localization masks, what gen_localization_mask writes to loc_predicted/
+    :param pre: [B, 3, H, W] uint8 RGB pre disaster images
+    '''
+    channels = [post.float()]
+    if dmg_cfg.DATASETS.LOCALIZATION_MASK.ENABLED: channels.append(loc_mask[:, None].float())
+    if dmg_cfg.DATASETS.INCLUDE_PRE_DISASTER: channels.append(pre.float())
+    x = torch.cat(channels, dim=1)
+    if len(channels) == 1:
+        # Without stacked channels the pipeline stays uint8 and Npy2Torch scales it
+        x = x / 255
+    if dmg_cfg.AUGMENTATION.ENABLE_VARI:
+        x = torch.cat([x, vari_tensor(post)[:, None]], dim=1)
+    return x
+
+def submission_inference(loc_net, dmg_net, loc_cfg, dmg_cfg):
+    '''
+    xView2 submission in a single pass: for every pre / post pair the localization model runs on the pre disaster
+    image, its mask goes straight into the damage model input, and both prediction files are written.
+    Replaces gen_localization_mask + a damage run reading loc_predicted/ back from the disk.
+    '''
+    dataset = PrePostInferenceDataset(loc_cfg.DATASETS.INFERENCE[0], keep_uint8=True)
+    dataloader = torch_data.DataLoader(dataset,
+                                       batch_size=loc_cfg.TRAINER.INFERENCE_BATCH_SIZE,
+                                       shuffle=False,
+                                       **worker_kwargs(loc_cfg))
+    inference_dir = os.path.join(loc_cfg.OUTPUT_DIR, 'predictions')
+    os.makedirs(inference_dir, exist_ok=True)
+
+    loc_net.to(device).eval()
+    dmg_net.to(device).eval()
+    loc_forward = build_forward(loc_net, loc_cfg)
+    dmg_forward = build_forward(dmg_net, dmg_cfg)
+
+    with torch.no_grad(), AsyncImageWriter(loc_cfg.DATALOADER.NUM_WRITER) as writer:
+        for step, batch in enumerate(dataloader):
+            pre = batch['x'].to(device, non_blocking=True)
+            post = batch['x_post'].to(device, non_blocking=True)
 
+            y_loc = activation(loc_forward(downscale_input(loc_cfg, pre.float() / 255)))
+            loc_mask = threshold_predictions(loc_cfg, y_loc, loc_cfg.THRESH)
 
+            x_dmg = downscale_input(dmg_cfg, damage_model_input(dmg_cfg, post, loc_mask, pre))
+            y_dmg = upscale_predictions(dmg_cfg, activation(dmg_forward(x_dmg)))
+            # Channels 0-3 are the damage levels 1-4 for every background type (see damage_one_hot_lut)
+            damage = (y_dmg[:, :NUM_DAMAGE_CLASSES].argmax(dim=1) + 1).type(torch.uint8) * loc_mask
 
-    inference_loop(net, cfg, device, save_to_png, dataset=dataset)
+            for loc, dmg, img_filename in zip(loc_mask.cpu().numpy(), damage.cpu().numpy(), batch['img_name']):
+                names = submission_filenames(img_filename)
+                if len(names) == 1:
+                    stem = os.path.splitext(img_filename)[0]
+                    names = [f'{stem}_localization.png', f'{stem}_damage.png']
+                writer.write(os.path.join(inference_dir, names[0]), loc)
+                writer.write(os.path.join(inference_dir, names[1]), dmg)
 
-    return
+            if step % 100 == 0:
+                print(f'Processed {step+1}/{len(dataloader)}')
 
 def gen_localization_mask(net, cfg):
     '''
     This method is for generated predicted masks for damage detection
     :return:
     '''
-    from PIL import Image
     THRESHOLD = cfg.THRESH
 
-    def save_to_png(y_true, y_pred, img_filenames):
-        # Y_pred activation
-
-        # interp image if scaling was originally enabled
-        if cfg.AUGMENTATION.RESIZE:
-            upscale_ratio = 1 / cfg.AUGMENTATION.RESIZE_RATIO
-            y_pred = torch.nn.functional.interpolate(y_pred,
-                                                     scale_factor=upscale_ratio,
-                                                     mode='bilinear')
-
-        y_pred = (y_pred > THRESHOLD).type(torch.uint8)
-
-        y_pred = y_pred.squeeze().cpu().numpy()
-        img_filename = img_filenames[0]
-
-
-        os.makedirs(save_dir, exist_ok=True)
-
-        img_save_dir = os.path.join(save_dir, img_filename)
-        im = Image.fromarray(y_pred, mode='L')
-        im.save(img_save_dir)
-
     def leave_model_signature(path):
         os.makedirs(path, exist_ok=True)
         signature_path = os.path.join(path, 'model_signature')
         with open(signature_path, 'w') as f:
             f.writelines([f'{cfg.NAME}, {cfg.CP_FILE}'])
 
-    # Training set
-    train_set = cfg.DATASETS.TRAIN[0]
-    save_dir = os.path.join(train_set, 'loc_predicted')
-    leave_model_signature(save_dir)
-    inference_loop(net, cfg, device, save_to_png, run_type='TRAIN')
-
-
-    test_set = cfg.DATASETS.TEST[0]
-    save_dir = os.path.join(test_set, 'loc_predicted')
-    leave_model_signature(save_dir)
-    inference_loop(net, cfg, device, save_to_png)
+    def mask_saver(writer, save_dir):
+        def save_to_png(y_true, y_pred, img_filenames):
+            y_pred = threshold_predictions(cfg, y_pred, THRESHOLD).cpu().numpy()
+            for mask, img_filename in zip(y_pred, img_filenames):
+                writer.write(os.path.join(save_dir, img_filename), mask)
+        return save_to_png
+
+    with AsyncImageWriter(cfg.DATALOADER.NUM_WRITER) as writer:
+        # Training set
+        train_set = cfg.DATASETS.TRAIN[0]
+        save_dir = os.path.join(train_set, 'loc_predicted')
+        leave_model_signature(save_dir)
+        inference_loop(net, cfg, device, mask_saver(writer, save_dir), run_type='TRAIN',
+                       batch_size=cfg.TRAINER.INFERENCE_BATCH_SIZE)
+
+        test_set = cfg.DATASETS.TEST[0]
+        save_dir = os.path.join(test_set, 'loc_predicted')
+        leave_model_signature(save_dir)
+        inference_loop(net, cfg, device, mask_saver(writer, save_dir),
+                       batch_size=cfg.TRAINER.INFERENCE_BATCH_SIZE)
 
     return
 
-def model_eval(net, cfg, device, run_type='TEST', max_samples = 1000, step=0, epoch=0):
+class ModelEvalMetrics():
     '''
-    Runner that is concerned with training changes
-    :param run_type: 'train' or 'eval'
-    :return:
+    Streaming accumulators of model_eval for one net: pixel level F1 / error rates and building level metrics
     '''
-
-    F1_THRESH = torch.linspace(0, 1, 100).to(device)
-    y_true_set = []
-    y_pred_set = []
-    cc_difference_ratio_abs = []
-    kernel = np.ones((5, 5), np.uint8)
-
-    measurer = MultiThresholdMetric(F1_THRESH)
-    def evaluate(y_true, y_pred, img_filename):
-
-        if cfg.MODEL.OUT_CHANNELS == 4: #
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.measurer = HistogramMetric(F1_BINS)
+        # Building level metrics, the connected components are labelled and matched in the run wide worker pool
+        # (in this process if there is none)
+        self.instances = InstanceMatchingMetric(threshold=0.52,  # 0.52 == best threshold
+                                                num_workers=0,
+                                                pool=eval_instance_pool(cfg))
+
+    def add_sample(self, y_true, y_pred):
+        if self.cfg.MODEL.OUT_CHANNELS == 4: #
             # y_true = y_true[:,2:,:,:].sum(1)
             # Y True is already binary, because in eval we are not transformign the label to 4 classes
             y_pred = y_pred[:,2:,:,:].sum(1)
 
         y_true = y_true.detach()
         y_pred = y_pred.detach()
-        y_true_set.append(y_true.cpu())
-        y_pred_set.append(y_pred.cpu())
-
-        measurer.add_sample(y_true, y_pred)
-
-        y_pred_thresh = (y_pred > 0.52).type(torch.int8)  # 0.52 == best threshold
-
-        # ==== Measuring connected components
-        y_true_thresh_numpy = y_pred_thresh.cpu().squeeze().numpy()
-        true_cc = cv2.connectedComponentsWithStats(y_true_thresh_numpy.astype(np.int8), connectivity=8)[0]
 
-        y_pred_numpy = y_pred.cpu().squeeze().numpy()
-        y_pred_denoised = cv2.morphologyEx(y_pred_numpy, cv2.MORPH_OPEN, kernel)
-        pred_cc = cv2.connectedComponentsWithStats(y_pred_denoised.astype(np.int8), connectivity=8)[0]
+        self.measurer.add_sample(y_true, y_pred)
+        self.instances.add_sample(y_true, y_pred)
+
+    def log(self, run_type='TEST', step=0, epoch=0):
+        print('Computing F1 score ', end=' ', flush=True)
+        # Max F1
+
+        f1 = self.measurer.compute_f1()
+        fpr, fnr = self.measurer.compute_basic_metrics()
+        maxF1 = f1.max()
+        argmaxF1 = f1.argmax()
+        best_fpr = fpr[argmaxF1]
+        best_fnr = fnr[argmaxF1]
+        print(maxF1.item(), flush=True)
+
+        building_precision, building_recall, building_f1, building_iou = self.instances.compute_basic_metrics()
+        avg_cc_difference = self.instances.compute_count_error()
+        print(f'building F1 {building_f1:.4f}, abs building count ratio {avg_cc_difference:.4f}', flush=True)
+        set_name = 'test_set' if run_type == 'TEST' else 'training_set'
+        wandb.log({f'{set_name} max F1': maxF1,
+                   f'{set_name} argmax F1': self.measurer.thresholds[argmaxF1].item(), # threshold of the max F1
+                   # f'{set_name} Average Precision': ap,
+                   f'{set_name} false positive rate': best_fpr,
+                   f'{set_name} false negative rate': best_fnr,
+                   f'{set_name} avg abs building count ratio': avg_cc_difference,
+                   f'{set_name} building precision': building_precision,
+                   f'{set_name} building recall': building_recall,
+                   f'{set_name} building F1': building_f1,
+                   f'{set_name} building IoU': building_iou,
+                   'step': step,
+                   'epoch': epoch,
+                   })
 
-        cc_ratio = np.abs(true_cc - pred_cc) / true_cc
-        cc_difference_ratio_abs.append(cc_ratio)
+def model_eval(net, cfg, device, run_type='TEST', max_samples = 1000, step=0, epoch=0):
+    '''
+    Runner that is concerned with training changes
+    :param run_type: 'train' or 'eval'
+    :return:
+    '''
 
+    metrics = ModelEvalMetrics(cfg)
+    def evaluate(y_true, y_pred, img_filename):
+        metrics.add_sample(y_true, y_pred)
 
     if run_type == 'TRAIN':
         inference_loop(net, cfg, device, evaluate, run_type= 'TRAIN', max_samples = max_samples)
@@ -341,45 +360,138 @@ def model_eval(net, cfg, device, run_type='TEST', max_samples = 1000, step=0, ep
         inference_loop(net, cfg, device, evaluate, max_samples = max_samples)
 
     # Summary gathering ===
+    metrics.log(run_type, step=step, epoch=epoch)
 
-    print('Computing F1 score ', end=' ', flush=True)
-    # Max of the mean F1 score
-
-    # measurer = MultiThresholdMetric(y_true_set, y_pred_set, F1_THRESH)
-    # Max F1
-
-
-    f1 = measurer.compute_f1()
-    fpr, fnr = measurer.compute_basic_metrics()
-    maxF1 = f1.max()
-    argmaxF1 = f1.argmax()
-    best_fpr = fpr[argmaxF1]
-    best_fnr = fnr[argmaxF1]
-    print(maxF1.item(), flush=True)
-
-    avg_cc_difference = np.mean(cc_difference_ratio_abs)
-    print(avg_cc_difference)
-    set_name = 'test_set' if run_type == 'TEST' else 'training_set'
-    wandb.log({f'{set_name} max F1': maxF1,
-               f'{set_name} argmax F1': argmaxF1,
-               # f'{set_name} Average Precision': ap,
-               f'{set_name} false positive rate': best_fpr,
-               f'{set_name} false negative rate': best_fnr,
-               f'avg abs connected components ratio': avg_cc_difference,
-               'step': step,
-               'epoch': epoch,
-               })
+def checkpoints_sweep_eval(net, cfg, device, checkpoint_files, run_type='TEST', max_samples=1000,
+                           max_replicas=SWEEP_REPLICAS):
+    '''
+    model_eval of many checkpoints in a single data pass: every batch is decoded and moved to the device once and
+    then run through one replica of the net per checkpoint, each with its own ModelEvalMetrics
+    :param checkpoint_files: (step, file name) pairs, relative to cfg.OUTPUT_DIR
+    :param max_replicas: largest number of replicas on the device at once, checkpoints beyond that are evaluated in
+                         further passes. 0 for all of them in one pass
+    '''
+    max_replicas = max_replicas or len(checkpoint_files)
+    # Not shuffled, every pass has to see the same max_samples images for the checkpoints to be comparable
+    dataloader = eval_dataloader(cfg, run_type, shuffle=False)
+    to_device = build_to_device(cfg, device, label_channels=getattr(dataloader.dataset, 'label_channels', 1))
+
+    dataset_length = np.minimum(len(dataloader.dataset), max_samples)
+    for group_start in range(0, len(checkpoint_files), max_replicas):
+        replicas = []
+        for cp_num, cp_file in checkpoint_files[group_start:group_start + max_replicas]:
+            print(' ==== checkpoint', cp_file)
+            replica = copy.deepcopy(net)
+            replica.load_state_dict(torch.load(os.path.join(cfg.OUTPUT_DIR, cp_file), map_location='cpu'))
+            replica.to(device)
+            replica.eval()
+            replicas.append((cp_num, build_forward(replica, cfg), ModelEvalMetrics(cfg)))
+
+        with torch.no_grad():
+            for step, batch in enumerate(dataloader):
+                imgs, y_label = to_device(batch['x'], batch['y'])
+                for _, forward, metrics in replicas:
+                    metrics.add_sample(y_label, activation(forward(imgs)))
+
+                if step % 100 == 0 or step == dataset_length-1:
+                    print(f'Processed {step+1}/{dataset_length}')
+                if (max_samples is not None) and step >= max_samples:
+                    break
+
+        for cp_num, _, metrics in replicas:
+            metrics.log(run_type, step=cp_num)
+        del replicas
+
+def build_to_device(cfg, device, label_channels=1):
+    '''
+    BatchToDevice of the localization datasets, VARI inputs are float in the workers and not scaled to [0, 1]
+    '''
+    input_scale = 1. if cfg.DATASETS.USE_CLAHE_VARI else 1 / 255
+    return BatchToDevice(device, input_scale, label_channels)
+
+def build_inference_dataset(cfg, dset_source):
+    trfm = []
+    use_canny = cfg.MODEL.IN_CHANNELS == 4
+    trfm.append(BGR2RGB())
+    # Same order as in training, clahe_vari/ and the precomputed edges are at full resolution,
+    # they have to be included before resizing
+    if cfg.DATASETS.USE_CLAHE_VARI: trfm.append(VARI())
+    if use_canny and cfg.DATASETS.PRECOMPUTED_CANNY: trfm.append(IncludeCanny())
+    if cfg.AUGMENTATION.RESIZE: trfm.append( Resize(scale=cfg.AUGMENTATION.RESIZE_RATIO))
+    if use_canny and not cfg.DATASETS.PRECOMPUTED_CANNY:
+        trfm.append(AddCanny())
+    label_as_index = not cfg.AUGMENTATION.RESIZE
+    trfm.append(Npy2Torch(keep_uint8=cfg.DATALOADER.UINT8_TRANSPORT, label_as_index=label_as_index))
+    trfm = transforms.Compose(trfm)
+
+    dataset = Xview2Detectron2Dataset(dset_source,
+                                      pre_or_post=cfg.DATASETS.PRE_OR_POST,
+                                      transform=trfm,
+                                      use_label_store=cfg.DATASETS.USE_LABEL_STORE,
+                                      use_tile_store=cfg.DATASETS.USE_TILE_STORE,
+                                      use_labels_index=cfg.DATASETS.USE_LABELS_INDEX)
+    return dataset
+
+def build_forward(net, cfg):
+    '''
+    :return: the net, wrapped in TiledInference if enabled
+    '''
+    if not cfg.TILED_INFERENCE.ENABLED:
+        return net
+    return TiledInference(net,
+                          tile_size=cfg.TILED_INFERENCE.TILE_SIZE,
+                          overlap=cfg.TILED_INFERENCE.OVERLAP,
+                          batch_size=cfg.TILED_INFERENCE.BATCH_SIZE)
+
+def activation(y_pred):
+    if y_pred.shape[1] > 1: # multi-class
+        # In Two class Cross entropy mode, positive classes are in Channel #2
+        return torch.softmax(y_pred, dim=1)
+    return torch.sigmoid(y_pred)
+
+# Evaluation DataLoaders (and their datasets) by cache key, kept for the whole run so that periodic evaluations
+# neither parse the labels again nor fork new workers
+_eval_loaders = {}
+# Building matching workers, started once on first use and shared by all the evaluations of the run. They are
+# forkserver workers (see worker_pool), never forked from the training process and its CUDA / DataLoader state
+_instance_pool = None
+
+def eval_instance_pool(cfg):
+    '''
+    :return: the run wide instance matching pool, None if cfg.DATALOADER.NUM_WORKER is 0
+    '''
+    global _instance_pool
+    if _instance_pool is None and cfg.DATALOADER.NUM_WORKER > 0:
+        _instance_pool = instance_worker_pool(cfg.DATALOADER.NUM_WORKER)
+    return _instance_pool
 
-def downsample_dataset_for_eval(y_true, y_pred):
-    # Full dataset is too big to compute for the CPU, so we down sample it
-    num_samples = y_pred.shape[0]
-    downsample_size = 100
-    if num_samples > downsample_size: # only downsample if data size is huge
-        down_idx = np.linspace(0, num_samples, downsample_size, endpoint=False, dtype=np.int)
-        y_pred = y_pred[down_idx]
-        y_true = y_true[down_idx]
+def eval_dataloader(cfg, run_type='TEST', batch_size=1, dataset=None, cache_key=None, shuffle=None):
+    '''
+    :param shuffle: defaults to cfg.DATALOADER.SHUFFLE
+    :param dataset: dataset to run on, or a function building it. Defaults to the localization dataset of run_type
+    :param cache_key: reuses the DataLoader built by an earlier call with the same key (the dataset is then not built
+                      again), the default localization dataset is always cached
+    '''
+    dset_source = cfg.DATASETS.TEST[0] if run_type == 'TEST' else cfg.DATASETS.TRAIN[0]
+    shuffle = cfg.DATALOADER.SHUFFLE if shuffle is None else shuffle
+    if dataset is None and cache_key is None:
+        cache_key = ('localization', dset_source, batch_size, shuffle)
+
+    if cache_key in _eval_loaders:
+        return _eval_loaders[cache_key]
 
-    return y_true, y_pred
+    dataset = build_inference_dataset(cfg, dset_source) if dataset is None else dataset
+    if callable(dataset):
+        dataset = dataset()
+    dataloader = torch_data.DataLoader(dataset,
+                                       batch_size=batch_size,
+                                       shuffle = shuffle,
+                                       drop_last=False,
+                                       **worker_kwargs(cfg),
+                                       )
+    if cache_key is not None:
+        _eval_loaders[cache_key] = dataloader
+    return dataloader
 
 def inference_loop(net, cfg, device,
                     callback = None,
@@ -388,52 +500,39 @@ def inference_loop(net, cfg, device,
                     max_samples = 999999999,
                     dataset = None,
                     callback_include_x = False,
+                    to_device = None,
+                    cache_key = None,
 
               ):
+    '''
+    :param dataset, cache_key: see eval_dataloader
+    '''
 
     net.to(device)
     net.eval()
 
-    # reset the generators
+    dataloader = eval_dataloader(cfg, run_type, batch_size, dataset, cache_key)
+    dataset = dataloader.dataset
 
-    dset_source = cfg.DATASETS.TEST[0] if run_type == 'TEST' else cfg.DATASETS.TRAIN[0]
-    if dataset is None:
-        trfm = []
-        if cfg.AUGMENTATION.RESIZE: trfm.append( Resize(scale=cfg.AUGMENTATION.RESIZE_RATIO))
-        trfm.append(BGR2RGB())
-        if cfg.DATASETS.USE_CLAHE_VARI: trfm.append(VARI())
-        if cfg.MODEL.IN_CHANNELS == 4:
-            trfm.append(AddCanny())
-        trfm.append(Npy2Torch())
-        trfm = transforms.Compose(trfm)
-
-        dataset = Xview2Detectron2Dataset(dset_source, pre_or_post=cfg.DATASETS.PRE_OR_POST, transform=trfm)
+    if to_device is None:
+        # Scales uint8 transported images, float batches are only moved
+        to_device = build_to_device(cfg, device, label_channels=getattr(dataset, 'label_channels', 1))
 
-    dataloader = torch_data.DataLoader(dataset,
-                                       batch_size=batch_size,
-                                       num_workers=cfg.DATALOADER.NUM_WORKER,
-                                       shuffle = cfg.DATALOADER.SHUFFLE,
-                                       drop_last=True,
-                                       )
+    forward = build_forward(net, cfg)
 
     dlen = len(dataset)
     dataset_length = np.minimum(len(dataset), max_samples)
     with torch.no_grad():
         for step, batch in enumerate(dataloader):
-            imgs = batch['x'].to(device)
-            y_label = batch['y'].to(device)
+            imgs, y_label = to_device(batch['x'], batch['y'])
             sample_name = batch['img_name']
 
-            y_pred = net(imgs)
+            y_pred = forward(imgs)
 
             if step % 100 == 0 or step == dataset_length-1:
                 print(f'Processed {step+1}/{dataset_length}')
 
-            if y_pred.shape[1] > 1: # multi-class
-                # In Two class Cross entropy mode, positive classes are in Channel #2
-                y_pred = torch.softmax(y_pred, dim=1)
-            else:
-                y_pred = torch.sigmoid(y_pred)
+            y_pred = activation(y_pred)
 
             if callback:
                 if callback_include_x:
@@ -487,8 +586,14 @@ def custom_argparse(parser):
     parser.add_argument('-T',"--eval-type",
                         dest='eval_type',
                         default="final",
-                        choices=['p', 'checkpoints', 'inference', 'loc_predict', 'final'],
+                        choices=['p', 'checkpoints', 'inference', 'loc_predict', 'final', 'submission'],
                         help="select an evaluation type")
+    parser.add_argument('--sweep-replicas', dest='sweep_replicas', type=int, default=SWEEP_REPLICAS,
+                        help="checkpoints evaluated per data pass by the checkpoints evaluation type, 0 for all")
+    parser.add_argument('--dmg-config-file', dest='dmg_config_file', type=str, default='',
+                        help="damage model config (configs/damage_detection/), for the submission evaluation type")
+    parser.add_argument('--dmg-resume-from', dest='dmg_resume_from', type=str, default='',
+                        help="damage model checkpoint, relative to its output directory")
     return parser
 
 if __name__ == '__main__':
@@ -518,7 +623,7 @@ if __name__ == '__main__':
                 project='urban_dl',
                 tags=['checkpoints_eval', 'final_model_eval'],
             )
-            model_checkpoints_eval_runner(net, cfg)
+            model_checkpoints_eval_runner(net, cfg, args.sweep_replicas)
             final_model_evaluation_runner(net, cfg)
         elif args.eval_type == 'final':
             wandb.init(
@@ -531,6 +636,14 @@ if __name__ == '__main__':
             localization_inference(net, cfg)
         elif args.eval_type == 'loc_predict':
             gen_localization_mask(net, cfg)
+        elif args.eval_type == 'submission':
+            import damage_train
+            dmg_args = Namespace(**vars(args))
+            dmg_args.config_file, dmg_args.opts = args.dmg_config_file, []
+            dmg_cfg = damage_train.setup(dmg_args)
+            dmg_net = damage_train.build_net(dmg_cfg)
+            damage_train.load_checkpoint(dmg_net, path.join(dmg_cfg.OUTPUT_DIR, args.dmg_resume_from))
+            submission_inference(net, dmg_net, cfg, dmg_cfg)
     except KeyboardInterrupt:
         torch.save(net.state_dict(), 'INTERRUPTED.pth')
         print('Saved interrupt')
@@ -9,13 +9,15 @@ import numpy as np
 import torch
 import pandas as pd
 import cv2
-from scipy.ndimage.morphology import distance_transform_edt
 from torchvision import transforms, utils
 
 from torch.utils import data as torch_data
 from unet import UNet
 from unet.dataloader import Xview2Detectron2Dataset
 from unet.augmentations import *
+from unet.labels_index import load_labels
+from eval_util.building_stats import BuildingStats, columns_to_frame
+from eval_util.sdt_profile import ColumnWriter, SdtStage, read_columns
 from experiment_manager.config import new_config
 
 
@@ -54,9 +56,8 @@ if TRAIN_TYPE == 'train':
 else:
     dset_source = cfg.DATASETS.TEST[0]
 
-with open(dset_source + '/labels.json') as f:
-    ds = json.load(f)
-dataset_json = ds
+# Columnar labels index instead of the parsed labels.json, annotations are only rebuilt for the images we visit
+dataset_json = load_labels(dset_source, use_index=True)
 
 def inference_loop2(net, cfg, device,
                    callback = None,
@@ -113,8 +114,7 @@ trfm.append(BGR2RGB())
 trfm.append(Npy2Torch())
 trfm = transforms.Compose(trfm)
 
-dataset = Xview2Detectron2Dataset(dset_source, pre_or_post=cfg.DATASETS.PRE_OR_POST, include_index=True, transform=trfm)
-results_table = []
+dataset = Xview2Detectron2Dataset(dset_source, pre_or_post=cfg.DATASETS.PRE_OR_POST, include_index=True, transform=trfm, use_labels_index=True)
 
 
 def compute_sample(x, Y_true, Y_pred, img_filenames, indices):
@@ -136,65 +136,31 @@ def compute_sample(x, Y_true, Y_pred, img_filenames, indices):
     bFN = (Y_true & ~Y_pred).sum(dim=hw_dims).cpu()
     bAreas = Y_true.sum(dim=hw_dims).cpu()
 
-    # All false positive pixels
-    bFP_pixels = (~Y_true & Y_pred).cpu().numpy()
-    # SDT = Signed Distance Transform
-    bSDT_FP_maps = (~Y_true).cpu().numpy() # All negative (both false pos + true neg) pixels to 1, all positive pixels to 0
-
-    # All false negative pixels
-    bFN_pixels = (Y_true & ~Y_pred).cpu().numpy()
-    bSDT_FN_maps = Y_true.cpu().numpy()
-
-    # Iterate through batch
-    for fn_pixels, sdt_fn_map, fp_pixels, sdt_fp_map, tp, tn, fp, fn, total_area, img_filename, index in zip(bFN_pixels, bSDT_FN_maps, bFP_pixels, bSDT_FP_maps, bTP, bTN, bFP, bFN, bAreas, img_filenames, indices):
-        tp = tp.item()
-        tn = tn.item()
-        fp = fp.item()
-        fn = fn.item()
-
-        # print(annotation_set.keys(), flush=True)
-        total_area = total_area.item()
-        density = len(dataset_json[index]['pre']['annotations'])
+    Y_true, Y_pred = Y_true.cpu().numpy(), Y_pred.cpu().numpy()
 
+    # Iterate through batch, the distance transforms are left to the sdt stage
+    for y_true, y_pred, tp, tn, fp, fn, total_area, img_filename, index in zip(Y_true, Y_pred, bTP, bTN, bFP, bFN, bAreas, img_filenames, indices):
         result = {
             'index': index.item(),
-            'TP': tp,
-            'TN': tn,
-            'FP': fp,
-            'FN': fn,
+            'TP': tp.item(),
+            'TN': tn.item(),
+            'FP': fp.item(),
+            'FN': fn.item(),
 
             'image_name': img_filename,
-            'density': density,
-            'total_area': total_area,
+            'density': dataset_json.num_annotations(int(index), 'pre'),
+            'total_area': total_area.item(),
         }
+        sdt_stage.submit(result, y_true, y_pred)
 
-        # Distance transform, distance from all negative pixels to positive pixels
-        sdt = distance_transform_edt(sdt_fp_map)
-        fp_distances = sdt[fp_pixels]
-
-        distance_intervals = 2 ** np.arange(1, 11)
-        for interval in distance_intervals:
-            interval_mask = fp_distances <= interval
-            fp_distances = fp_distances[~interval_mask] # next_interval
-            result[f'fp_sdt<={interval}'] = interval_mask.sum()
-
-        # Distance transform, distance from all negative pixels to positive pixels
-        sdt_fn = distance_transform_edt(sdt_fn_map)
-        fn_distances = sdt_fn[fn_pixels]
-        for interval in distance_intervals:
-            interval_mask = fn_distances <= interval
-            fn_distances = fn_distances[~interval_mask] # next_interval
-            result[f'fn_sdt<={interval}'] = interval_mask.sum()
 
-        results_table.append(result)
-
-
-inference_loop2(net, cfg, device, compute_sample,
-                dataset=dataset)
-results = pd.DataFrame(results_table)
 storage_path = path.join(cfg.OUTPUT_DIR, 'ablation',)
 os.makedirs(storage_path, exist_ok=True)
-results.to_pickle(path.join(storage_path, f'per_image_result_{TRAIN_TYPE}.pkl'))
+per_image_path = path.join(storage_path, f'per_image_result_{TRAIN_TYPE}.h5')
+with ColumnWriter(per_image_path) as writer, SdtStage(writer) as sdt_stage:
+    inference_loop2(net, cfg, device, compute_sample,
+                    dataset=dataset)
+read_columns(per_image_path).to_pickle(path.join(storage_path, f'per_image_result_{TRAIN_TYPE}.pkl'))
 
 
 # ===========
@@ -202,8 +168,9 @@ results.to_pickle(path.join(storage_path, f'per_image_result_{TRAIN_TYPE}.pkl'))
 # ===========
 print('================= Running ablation per building ===============', flush=True)
 
-dataset = Xview2Detectron2Dataset(dset_source, pre_or_post=cfg.DATASETS.PRE_OR_POST, include_index=True, transform=trfm)
-results_table = []
+dataset = Xview2Detectron2Dataset(dset_source, pre_or_post=cfg.DATASETS.PRE_OR_POST, include_index=True, transform=trfm, use_labels_index=True)
+results_columns = []
+building_stats = BuildingStats()
 
 
 def compute_sample(x, Y_true, Y_pred, img_filenames, indices):
@@ -216,70 +183,26 @@ def compute_sample(x, Y_true, Y_pred, img_filenames, indices):
                                                  mode='bilinear')
 
     # expand batch
-    Y_pred = Y_pred.squeeze(1) > THRESHOLD
-    Y_true = Y_true.type(torch.bool)
-    # Compute all TP, TN, FP, FP, FN at once
-    bTP = (Y_true & Y_pred)
-    bTN = (~Y_true & ~Y_pred)
-    bFP = (Y_true & ~Y_pred)
-    bFN = (~Y_true & Y_pred)
+    Y_pred = (Y_pred.squeeze(1) > THRESHOLD).cpu().numpy()
+    Y_true = Y_true.squeeze(1).type(torch.bool).cpu().numpy()
 
     # Iterate through batch
-    for y_pred, TP, TN, FP, FN, img_filename, index in zip(Y_pred, bTP, bTN, bFP, bFN, img_filenames, indices):
-        y_pred = y_pred.cpu().numpy()
-        num_buildings = len(dataset_json[index]['pre']['annotations'])
-
-
-        # iterate through buildings
-        for idx, anno in enumerate(dataset_json[index]['pre']['annotations']):
-            x1, y1, x2, y2 = np.array(anno['bbox']).astype(np.int32)
-
-            crop_range = (slice(y1 - 2, y2 + 2), slice(x1 - 2, x2 + 2))  # equiv: [y1-2:y2+2, x1-2:x2+2]
-
-            tp = TP[crop_range].sum().item()
-            tn = TN[crop_range].sum().item()
-            fp = FP[crop_range].sum().item()
-            fn = FN[crop_range].sum().item()
-
-            height = y2 - y1
-            width = x2 - x1
-
-            # Real Per building A
-
-            seg = np.array(anno['segmentation'], dtype=np.int32)
-            seg_xy = seg.reshape(-1, 2)
-            building_poly = np.zeros((1024, 1024), dtype=np.uint8)
-            cv2.fillConvexPoly(building_poly, seg_xy , 1)
-            y_true_real = building_poly.astype(np.bool)
-
-            real_area = y_true_real.sum()
-            real_tp = (y_pred & y_true_real).sum()
-            real_fn = real_area - real_tp
-
-            result = {
-                'index': index.item(),
-                'TP': tp,
-                'TN': tn,
-                'FP': fp,
-                'FN': fn,
-
-                'image_name': img_filename,
-                'height': height,
-                'width': width,
-                'area': height * width,
-
-                'real_TP': real_tp,
-                'real_FN': real_fn,
-                'real_area': real_area,
-
-            }
-            results_table.append(result)
+    for y_pred, y_true, img_filename, index in zip(Y_pred, Y_true, img_filenames, indices):
+        annotations = dataset_json.record(int(index), 'pre')['annotations']
+        stats = building_stats(y_pred, y_true, annotations)
+        # Same column order as the per building table always had
+        results_columns.append({'index': np.full(len(annotations), index.item()),
+                                'TP': stats['TP'], 'TN': stats['TN'], 'FP': stats['FP'], 'FN': stats['FN'],
+                                'image_name': [img_filename] * len(annotations),
+                                'height': stats['height'], 'width': stats['width'], 'area': stats['area'],
+                                'real_TP': stats['real_TP'], 'real_FN': stats['real_FN'],
+                                'real_area': stats['real_area']})
 
 
 inference_loop2(net, cfg, device, compute_sample,
                 dataset=dataset)
 
-results = pd.DataFrame(results_table)
+results = columns_to_frame(results_columns)
 storage_path = path.join(cfg.OUTPUT_DIR, 'ablation',)
 os.makedirs(storage_path, exist_ok=True)
 results.to_pickle(path.join(storage_path, f'per_building_result_{TRAIN_TYPE}.pkl'))
\ No newline at end of file
@@ -0,0 +1,129 @@
+#
+# sdt_profile.py : signed distance error profiling of localization predictions. How far false positives lie from
+#                  the buildings and false negatives from the background, binned into power of two intervals.
+#                  The distance transforms run in a process pool next to inference, results are appended to a
+#                  columnar hdf5 file as they come in
+
+import numpy as np
+import pandas as pd
+import h5py
+from scipy.ndimage import distance_transform_edt
+
+from experiment_manager.worker_pool import OrderedMaskJobs
+
+DISTANCE_INTERVALS = 2 ** np.arange(1, 11)
+
+
+def bin_distances(distances, intervals=DISTANCE_INTERVALS):
+    '''
+    Counts of distances per interval (previous interval, interval], the first one starting at 0.
+    Distances beyond the last interval are not counted
+    '''
+    bins = np.searchsorted(intervals, distances, side='left')
+    return np.bincount(bins, minlength=len(intervals) + 1)[:len(intervals)]
+
+def sdt_profile(y_true, y_pred, intervals=DISTANCE_INTERVALS):
+    '''
+    :param y_true: [H, W] boolean target
+    :param y_pred: [H, W] boolean prediction
+    :return: dict with the fp_sdt<=interval and fn_sdt<=interval counts
+    '''
+    result = {}
+    # Distance of false positives to the closest positive pixel, of false negatives to the closest negative one
+    for name, distance_map, error_pixels in (('fp', ~y_true, ~y_true & y_pred), ('fn', y_true, y_true & ~y_pred)):
+        distances = distance_transform_edt(distance_map)[error_pixels]
+        for interval, count in zip(intervals, bin_distances(distances, intervals)):
+            result[f'{name}_sdt<={interval}'] = count
+    return result
+
+
+class ColumnWriter():
+    '''
+    Appends rows to one resizable hdf5 dataset per column. Rows are buffered and written every flush_every rows,
+    the columns are created from the first rows (strings as variable length utf-8). hdf5 lists datasets
+    alphabetically, the column order is kept in the 'columns' attribute of the file
+    '''
+    def __init__(self, path, flush_every=64):
+        self.file = h5py.File(path, 'w')
+        self.flush_every = flush_every
+        self.rows = []
+
+    def append(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if 'columns' not in self.file.attrs:
+            self.file.attrs['columns'] = list(self.rows[0])
+        for name in self.rows[0]:
+            column = np.array([row[name] for row in self.rows])
+            if column.dtype.kind in 'OUS':
+                column = column.astype(object)
+                dtype = h5py.string_dtype()
+            else:
+                dtype = column.dtype
+            if name not in self.file:
+                self.file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True)
+            dataset = self.file[name]
+            dataset.resize((dataset.shape[0] + len(column),))
+            dataset[-len(column):] = column
+        self.file.flush()
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_columns(path):
+    '''
+    :return: DataFrame of a file written by ColumnWriter
+    '''
+    with h5py.File(path, 'r') as f:
+        names = [str(name) for name in f.attrs['columns']] if 'columns' in f.attrs else list(f)
+        columns = {name: f[name][()] for name in names}
+    for name, column in columns.items():
+        if column.dtype == object:
+            columns[name] = [value.decode() if isinstance(value, bytes) else value for value in column]
+    return pd.DataFrame(columns)
+
+
+class SdtStage():
+    '''
+    Runs sdt_profile in a process pool, so inference goes on while the cpus do the distance transforms.
+    Finished rows are written in submission order, at most max_pending images are in flight (submit waits
+    for the oldest one beyond that, bounding memory)
+    :param writer: ColumnWriter the rows (submitted columns + profile) go to
+    :param start_method: forked workers by default, the evaluation scripts run at module level and must not be
+                         re-imported by the workers
+    '''
+    def __init__(self, writer, num_workers=None, max_pending=None, start_method='fork'):
+        self.writer = writer
+        self.jobs = OrderedMaskJobs(sdt_profile, lambda row, profile: self.writer.append({**row, **profile}),
+                                    num_workers=num_workers, max_pending=max_pending, start_method=start_method)
+
+    def submit(self, row, y_true, y_pred):
+        '''
+        :param row: dict of the columns already known for this image
+        :param y_true: [H, W] boolean numpy target
+        :param y_pred: [H, W] boolean numpy prediction
+        '''
+        self.jobs.submit([y_true, y_pred], tag=row)
+
+    def close(self):
+        self.jobs.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
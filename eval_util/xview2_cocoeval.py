@@ -8,7 +8,9 @@ import logging
 import numpy as np
 import os
 import pickle
+import tempfile
 from collections import OrderedDict
+from functools import lru_cache
 import pycocotools.mask as mask_util
 import torch
 from fvcore.common.file_io import PathManager
@@ -68,13 +70,73 @@ class Xview2COCOEvaluator(DatasetEvaluator):
         # Test set json files do not contain annotations (evaluation must be
         # performed using the COCO evaluation server).
         self._do_evaluation = "annotations" in self._coco_api.dataset
-        self._metrics = Metric()
+        # Merged ground truth RLE per image id, the annotations never change between evaluations
+        self._gt_rles = {}
+        self._prediction_stream = None
+        self._temp_path = None
 
     def reset(self):
+        # Predictions are pickled one by one into a per rank stream file instead of being held in memory
+        self._close_prediction_stream()
+        self._remove_temp_stream()
         self._predictions = []
-        self._inputs = []
+        self._prediction_path = None
+        if self._output_dir:
+            # The output dir has to be shared by all ranks, rank 0 reads the streams of the others
+            PathManager.mkdirs(self._output_dir)
+            self._prediction_path = os.path.join(self._output_dir,
+                                                 f"instances_predictions_rank{comm.get_rank()}.pkl")
+        elif not self._distributed:
+            fd, self._prediction_path = tempfile.mkstemp(suffix=".pkl")
+            os.close(fd)
+            self._temp_path = self._prediction_path
+        # Distributed without an output dir the local temp dirs of the ranks are not visible to rank 0,
+        # the predictions stay in memory and are gathered
+        if self._prediction_path is not None:
+            self._prediction_stream = PathManager.open(self._prediction_path, "wb")
+        self._num_predictions = 0
+        self._metrics = Metric()
         self._coco_results = []
 
+    def _close_prediction_stream(self):
+        if getattr(self, "_prediction_stream", None) is not None:
+            self._prediction_stream.close()
+            self._prediction_stream = None
+
+    def __del__(self):
+        # The temporary stream lives until the next reset (evaluate can run more than once) or until teardown
+        self._close_prediction_stream()
+        self._remove_temp_stream()
+
+    def _remove_temp_stream(self):
+        if getattr(self, "_temp_path", None) is not None:
+            if os.path.exists(self._temp_path):
+                os.remove(self._temp_path)
+            self._temp_path = None
+
+    def _iter_predictions(self):
+        """
+        Yields the gathered in memory predictions and those of all the gathered stream files
+        """
+        yield from self._predictions
+        for path in self._prediction_paths:
+            with PathManager.open(path, "rb") as f:
+                while True:
+                    try:
+                        yield pickle.load(f)
+                    except EOFError:
+                        break
+
+    def _gt_rle(self, img_id):
+        """
+        Union of all the ground truth annotations of an image, as a single RLE
+        """
+        if img_id not in self._gt_rles:
+            img = self._coco_api.imgs[img_id]
+            rles = [self._coco_api.annToRLE(ann) for ann in self._coco_api.imgToAnns[img_id]]
+            self._gt_rles[img_id] = merge_rles(rles, img["height"], img["width"])
+        return self._gt_rles[img_id]
+
     def _tasks_from_config(self, cfg):
         """
         Returns:
@@ -96,11 +158,10 @@ class Xview2COCOEvaluator(DatasetEvaluator):
             outputs: the outputs of a COCO model. It is a list of dicts with key
                 "instances" that contains :class:`Instances`.
         """
-        #  self._inputs = inputs
-        self._inputs.append(inputs[0])
         for input, output in zip(inputs, outputs):
 
             prediction = {"image_id": input["image_id"]}
+            predicted_rle = None
 
             # TODO this is ugly
             if "instances" in output:
@@ -112,19 +173,17 @@ class Xview2COCOEvaluator(DatasetEvaluator):
                     # since this evaluator stores outputs of the entire dataset
                     # Our model may predict bool array, but cocoapi expects uint8
 
-                    # Yonk added this
-                    THRESHOLD = 0.5
-                    # Searching in negative because np only takes ascending order
-                    thrs_pos = np.searchsorted(-instances.scores.numpy(), -THRESHOLD, side='right')
-                    masks = np.array(instances.pred_masks[:thrs_pos])
-                    # combine masks into a single image
-                    predicted_mask = np.any(masks, axis=0)
-                    prediction['merged_mask'] = predicted_mask
-
                     rles = [
                         mask_util.encode(np.array(mask[:, :, None], order="F", dtype="uint8"))[0]
                         for mask in instances.pred_masks
                     ]
+
+                    # Yonk added this
+                    THRESHOLD = 0.5
+                    # combine the confident masks into a single image, without decoding them
+                    confident = (instances.scores >= THRESHOLD).tolist()
+                    predicted_rle = merge_rles([rle for rle, keep in zip(rles, confident) if keep],
+                                               *instances.image_size)
                     for rle in rles:
                         # "counts" is an array encoded by mask_util as a byte-stream. Python3's
                         # json writer which always produces strings cannot serialize a bytestream
@@ -137,37 +196,43 @@ class Xview2COCOEvaluator(DatasetEvaluator):
                 prediction["instances"] = instances_to_json(instances, input["image_id"])
             if "proposals" in output:
                 prediction["proposals"] = output["proposals"].to(self._cpu_device)
-            self._predictions.append(prediction)
+            if self._prediction_stream is not None:
+                pickle.dump(prediction, self._prediction_stream, protocol=pickle.HIGHEST_PROTOCOL)
+            else:
+                self._predictions.append(prediction)
+            self._num_predictions += 1
 
             # TODO YONK CODE HERE
-
-
-
-            img_id = 1
-            anns = self._coco_api.imgToAnns[img_id]
-            masks = []
-            for ann in anns:
-                mask = self._coco_api.annToMask(ann)
-                masks.append(mask)
-            ground_truth_mask = np.any(masks, axis=0)
-
-            self._metrics.add_sample(ground_truth_mask, predicted_mask)
-
-
+            if predicted_rle is not None:
+                self._metrics.add_counts(*rle_confusion(self._gt_rle(input["image_id"]), predicted_rle))
 
     def evaluate(self):
+        self._close_prediction_stream()
+        counts = [self._metrics.TP, self._metrics.TN, self._metrics.FP, self._metrics.FN]
         if self._distributed:
             comm.synchronize()
-            self._predictions = comm.gather(self._predictions, dst=0)
-            self._predictions = list(itertools.chain(*self._predictions))
+            if self._prediction_path is not None:
+                self._prediction_paths = comm.gather(self._prediction_path, dst=0)
+            else:
+                self._prediction_paths = []
+                predictions = comm.gather(self._predictions, dst=0)
+                self._predictions = list(itertools.chain(*predictions)) if comm.is_main_process() else []
+            num_predictions = comm.gather(self._num_predictions, dst=0)
+            counts = comm.gather(counts, dst=0)
 
             if not comm.is_main_process():
                 return {}
-
+            num_predictions = sum(num_predictions)
+            counts = np.sum(counts, axis=0)
+        else:
+            self._prediction_paths = [self._prediction_path]
+            num_predictions = self._num_predictions
 
         # ==== TODO My code
-        f1 = self._metrics.compute_f1()
-        fpr, fnr = self._metrics.compute_basic_metrics()
+        metrics = Metric()
+        metrics.add_counts(*counts)
+        f1 = metrics.compute_f1()
+        fpr, fnr = metrics.compute_basic_metrics()
 
         print("\n!!>!>!>!>!>!>!>!>!>>!>!>!>!>!>!>!>!>!>>!>!>!>!>!>!>!>!\n")
         print('F1 score: ', f1)
@@ -177,31 +242,28 @@ class Xview2COCOEvaluator(DatasetEvaluator):
 
         # End of my code
 
-        if len(self._predictions) == 0:
+        if num_predictions == 0:
             self._logger.warning("[XView2COCOEvaluator] Did not receive valid predictions.")
             return {}
 
-        if self._output_dir:
-            PathManager.mkdirs(self._output_dir)
-            file_path = os.path.join(self._output_dir, "instances_predictions.pth")
-            with PathManager.open(file_path, "wb") as f:
-                torch.save(self._predictions, f)
-
+        # The predictions themselves are already on disk, in the instances_predictions_rank*.pkl streams
+        # (or gathered in memory, distributed without an output dir)
         self._results = OrderedDict()
-        if "proposals" in self._predictions[0]:
+        first_prediction = next(self._iter_predictions())
+        if "proposals" in first_prediction:
             self._eval_box_proposals()
-        if "instances" in self._predictions[0]:
+        if "instances" in first_prediction:
             self._eval_predictions(set(self._tasks))
         # Copy so the caller can do whatever with results
         return copy.deepcopy(self._results)
 
     def _eval_predictions(self, tasks):
         """
-        Evaluate self._predictions on the given tasks.
+        Evaluate the streamed predictions on the given tasks.
         Fill self._results with the metrics of the tasks.
         """
         self._logger.info("Preparing results for COCO format ...")
-        self._coco_results = list(itertools.chain(*[x["instances"] for x in self._predictions]))
+        self._coco_results = list(itertools.chain.from_iterable(x["instances"] for x in self._iter_predictions()))
 
         # unmap the category ids for COCO
         if hasattr(self._metadata, "thing_dataset_id_to_contiguous_id"):
@@ -246,15 +308,16 @@ class Xview2COCOEvaluator(DatasetEvaluator):
 
     def _eval_box_proposals(self):
         """
-        Evaluate the box proposals in self._predictions.
+        Evaluate the streamed box proposals.
         Fill self._results with the metrics for "box_proposals" task.
         """
+        predictions = list(self._iter_predictions())
         if self._output_dir:
             # Saving generated box proposals to file.
             # Predicted box_proposals are in XYXY_ABS mode.
             bbox_mode = BoxMode.XYXY_ABS.value
             ids, boxes, objectness_logits = [], [], []
-            for prediction in self._predictions:
+            for prediction in predictions:
                 ids.append(prediction["image_id"])
                 boxes.append(prediction["proposals"].proposal_boxes.tensor.numpy())
                 objectness_logits.append(prediction["proposals"].objectness_logits.numpy())
@@ -278,7 +341,7 @@ class Xview2COCOEvaluator(DatasetEvaluator):
         for limit in [100, 1000]:
             for area, suffix in areas.items():
                 stats = _evaluate_box_proposals(
-                    self._predictions, self._coco_api, area=area, limit=limit
+                    predictions, self._coco_api, area=area, limit=limit
                 )
                 key = "AR{}@{:d}".format(suffix, limit)
                 res[key] = float(stats["ar"].item() * 100)
@@ -376,8 +439,14 @@ class Metric():
         np.bitwise_and(y_true, y_pred)
         self.TP += np.bitwise_and(y_true, y_pred).sum(dtype='float')
         self.TN += np.bitwise_and(n_y_true, n_y_pred).sum(dtype='float')
-        self.FP += np.bitwise_and(y_true, n_y_pred).sum(dtype='float')
-        self.FN += np.bitwise_and(n_y_true, y_pred).sum(dtype='float')
+        self.FP += np.bitwise_and(n_y_true, y_pred).sum(dtype='float')
+        self.FN += np.bitwise_and(y_true, n_y_pred).sum(dtype='float')
+
+    def add_counts(self, TP, TN, FP, FN):
+        self.TP += float(TP)
+        self.TN += float(TN)
+        self.FP += float(FP)
+        self.FN += float(FN)
 
     @property
     def precision(self):
@@ -414,6 +483,29 @@ class Metric():
         denom = self.precision + self.recall
         return 2 * self.precision * self.recall / denom
 
+@lru_cache(maxsize=8)
+def _empty_rle(height, width):
+    return mask_util.encode(np.zeros((height, width, 1), order="F", dtype="uint8"))[0]
+
+def merge_rles(rles, height, width):
+    """
+    Union of RLEs, an empty mask of the given size if there are none
+    """
+    if len(rles) == 0:
+        return _empty_rle(height, width)
+    return mask_util.merge(rles, intersect=False)
+
+def rle_confusion(gt_rle, pred_rle):
+    """
+    Pixel counts of a merged ground truth and prediction, computed on the encodings
+    Returns:
+        TP, TN, FP, FN
+    """
+    tp = int(mask_util.area(mask_util.merge([gt_rle, pred_rle], intersect=True)))
+    gt_area, pred_area = int(mask_util.area(gt_rle)), int(mask_util.area(pred_rle))
+    height, width = gt_rle["size"]
+    return tp, height * width - gt_area - pred_area + tp, pred_area - tp, gt_area - tp
+
 def instances_to_json(instances, img_id):
     num_instance = len(instances)
     if num_instance == 0:
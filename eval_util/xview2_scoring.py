@@ -13,7 +13,7 @@
 # t: target (ground truth)
 # x: usually a numpy array
 
-import os, json
+import os, json, hashlib
 
 import numpy as np
 import pandas as pd
@@ -21,42 +21,147 @@ import pandas as pd
 from multiprocessing import Pool, cpu_count
 from pathlib import Path
 from PIL import Image
-from typing import Union
+from typing import Union, List
+
+
+# Targets are packed into one value per pixel: localization * TARGET_DMG_LEVELS + damage
+TARGET_DMG_LEVELS = 5
+TARGET_CACHE_NAME = 'scoring_targets'
 
 
 class PathHandler:
     def __init__(self, pred_dir: Path, targ_dir: Path, img_id: str, test_hold: str):
         """
         Args:
-            pred_dir  (Path): directory of localization and damage predictions
+            pred_dir  (Path): directory of localization and damage predictions, None when scoring in memory predictions
             targ_dir  (Path): directory of localization and damage targets
             img_id    (str) : 5 digit string of image id
             test_hold (str) : either 'test' or 'hold'. Most likely 'test' unless you have access to holdout set
         """
-        assert isinstance(pred_dir, Path), f"pred_dir should be of type Path, got {type(pred_dir)}"
-        assert pred_dir.is_dir(), f"Directory '{pred_dir}' does not exist or is not a directory"
+        if pred_dir is not None:
+            assert isinstance(pred_dir, Path), f"pred_dir should be of type Path, got {type(pred_dir)}"
+            assert pred_dir.is_dir(), f"Directory '{pred_dir}' does not exist or is not a directory"
+            self.lp = pred_dir / f"{test_hold}_localization_{img_id}_prediction.png"  # localization prediction
+            self.dp = pred_dir / f"{test_hold}_damage_{img_id}_prediction.png"  # damage prediction
 
         assert isinstance(targ_dir, Path), f"targ_dir '{targ_dir}' should be of type Path, got {type(pred_dir)}"
         assert targ_dir.is_dir(), f"Directory '{targ_dir}' does not exist or is not a directory"
 
         assert test_hold in ['test', 'hold'], f"test_hold '{test_hold}' was not one of 'test' or 'hold'"
 
-        self.lp = pred_dir / f"{test_hold}_localization_{img_id}_prediction.png"  # localization prediction
-        self.dp = pred_dir / f"{test_hold}_damage_{img_id}_prediction.png"  # damage prediction
+        self.img_id = img_id
         self.lt = targ_dir / f"{test_hold}_localization_{img_id}_target.png"  # localization target
         self.dt = targ_dir / f"{test_hold}_damage_{img_id}_target.png"  # damage target
-        self.paths = (self.lp, self.dp, self.lt, self.dt)
+        # Set when the targets are read from a TargetCache
+        self.target_cache = None
+        self.target_index = None
+
+    @staticmethod
+    def validate_image(img, name):
+        assert img.dtype == np.uint8, f"{name} is of wrong format {img.dtype} - should be np.uint8"
+        # uint8 values are >= 0, the max is enough to check the range
+        assert img.max() <= 4, f"values must ints 0-4, found {np.unique(img)}, path: {name}"
+        assert img.shape == (1024, 1024), f"{name} must be a 1024x1024 image"
+        return img
 
     def load_and_validate_image(self, path):
         assert path.is_file(), f"file '{path}' does not exist or is not a file"
-        img = np.array(Image.open(path))
-        assert img.dtype == np.uint8, f"{path.name} is of wrong format {img.dtype} - should be np.uint8"
-        assert set(np.unique(img)) <= {0, 1, 2, 3, 4}, f"values must ints 0-4, found {np.unique(img)}, path: {path}"
-        assert img.shape == (1024, 1024), f"{path} must be a 1024x1024 image"
-        return img
+        return self.validate_image(np.array(Image.open(path)), path.name)
+
+    def load_predictions(self):
+        return self.load_and_validate_image(self.lp), self.load_and_validate_image(self.dp)
+
+    def load_targets(self):
+        """ Returns the packed targets, lt * TARGET_DMG_LEVELS + dt """
+        if self.target_cache is not None:
+            return TargetCache.read(self.target_cache, self.target_index)
+        lt, dt = self.load_and_validate_image(self.lt), self.load_and_validate_image(self.dt)
+        return pack_targets(lt, dt)
+
+    def target_stamp(self):
+        """ Changes whenever one of the target files does """
+        return [[path.stat().st_mtime_ns, path.stat().st_size] for path in (self.lt, self.dt)]
+
+
+def pack_targets(lt: np.ndarray, dt: np.ndarray) -> np.ndarray:
+    return (lt > 0).astype(np.uint8) * TARGET_DMG_LEVELS + dt
 
-    def load_images(self):
-        return [self.load_and_validate_image(path) for path in self.paths]
+
+class TargetCache:
+    """
+    Decoded and validated targets of a target directory, packed into a single [N, 1024, 1024] uint8 array
+    (see pack_targets), so that re-scoring never decodes a target PNG again.
+    The cache is rebuilt whenever the target files change.
+
+    Args:
+        cache_dir (str): where the caches are kept, one per target directory. Defaults to $XVIEW2_TARGET_CACHE,
+            or ~/.cache/xview2_scoring
+    """
+    _opened = {}  # path -> memory mapped array, per process
+
+    def __init__(self, targ_dir: Path, path_handlers, cache_dir=None):
+        cache_dir = cache_dir or os.environ.get('XVIEW2_TARGET_CACHE') or Path.home() / '.cache' / 'xview2_scoring'
+        self.cache_dir = Path(cache_dir)
+        targ_key = hashlib.sha1(str(targ_dir.resolve()).encode()).hexdigest()[:12]
+        self.path = self.cache_dir / f'{TARGET_CACHE_NAME}_{targ_key}.npy'
+        self.meta_path = self.cache_dir / f'{TARGET_CACHE_NAME}_{targ_key}.json'
+        self.path_handlers = path_handlers
+
+    def meta(self):
+        return {'ids': [ph.img_id for ph in self.path_handlers],
+                'stamps': [ph.target_stamp() for ph in self.path_handlers]}
+
+    def is_valid(self):
+        if not (self.path.is_file() and self.meta_path.is_file()):
+            return False
+        with open(self.meta_path) as f:
+            return json.load(f) == self.meta()
+
+    def build(self, pool=None):
+        """ Fills the cache file target by target, only a few targets are ever in memory """
+        tmp_path = self.path.with_name(f'{self.path.stem}.tmp{os.getpid()}.npy')
+        tmp_meta_path = self.meta_path.with_name(f'{self.meta_path.stem}.tmp{os.getpid()}.json')
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                              shape=(len(self.path_handlers), 1024, 1024))
+            targets = (pool.imap(PathHandler.load_targets, self.path_handlers, chunksize=4) if pool is not None
+                       else map(PathHandler.load_targets, self.path_handlers))
+            for index, target in enumerate(targets):
+                array[index] = target
+            array.flush()
+            del array
+            with open(tmp_meta_path, 'w') as f:
+                json.dump(self.meta(), f)
+            # The meta is replaced last, it marks the cache as complete
+            if self.meta_path.exists():
+                self.meta_path.unlink()
+            os.replace(tmp_path, self.path)
+            os.replace(tmp_meta_path, self.meta_path)
+        except OSError as e:
+            print(f'Could not write the target cache {self.path}: {e}')
+            for path in (tmp_path, tmp_meta_path):
+                if path.exists():
+                    path.unlink()
+        TargetCache._opened.pop(str(self.path), None)
+
+    def attach(self, pool=None):
+        """ Builds the cache if needed and makes the path handlers read their targets from it """
+        if not self.is_valid():
+            self.build(pool)
+        if self.path.is_file() and self.is_valid():
+            for index, ph in enumerate(self.path_handlers):
+                ph.target_cache, ph.target_index = str(self.path), index
+
+    def load(self):
+        return TargetCache.read(str(self.path))
+
+    @classmethod
+    def read(cls, path, index=None):
+        if path not in cls._opened:
+            cls._opened[path] = np.load(path, mmap_mode='r')
+        array = cls._opened[path]
+        return array if index is None else array[index]
 
 
 class RowPairCalculator:
@@ -65,6 +170,33 @@ class RowPairCalculator:
     false negatives (FNs), and false positives (FPs), for a pair of localization/damage predictions
     """
 
+    @staticmethod
+    def count_row_pair(lp: np.ndarray, dp: np.ndarray, targets: np.ndarray):
+        """
+        All the localization and damage counts of one image from a single bincount.
+
+        Args:
+            lp (np.ndarray): localization prediction
+            dp (np.ndarray): damage prediction
+            targets (np.ndarray): packed targets, see pack_targets
+        """
+        lp_b = (lp > 0).astype(np.uint8)
+        dp = dp * lp_b  # only give credit to damages where buildings are predicted
+        # (lp_b, dp, lt_b, dt) of every pixel, 2 * 5 * 2 * 5 values
+        index = (lp_b * 5 + dp) * (2 * TARGET_DMG_LEVELS) + targets
+        counts = np.bincount(index.ravel(), minlength=100).reshape(2, 5, 2, TARGET_DMG_LEVELS)
+
+        loc = counts.sum(axis=(1, 3))  # [lp_b, lt_b]
+        lrow = [loc[1, 1], loc[0, 1], loc[1, 0]]
+
+        # only score damage where there exist buildings in target damage
+        dmg = counts.sum(axis=(0, 2))[:, 1:]  # [dp, dt - 1]
+        drow = []
+        for i in range(1, 5):
+            TP = dmg[i, i - 1]
+            drow += [TP, dmg[:, i - 1].sum() - TP, dmg[i].sum() - TP]
+        return [int(x) for x in lrow], [int(x) for x in drow]
+
     @staticmethod
     def extract_buildings(x: np.ndarray):
         """ Returns a mask of the buildings in x """
@@ -96,16 +228,8 @@ class RowPairCalculator:
         Args:
             ph (PathHandler): used to load the required prediction and target images
         """
-        lp, dp, lt, dt = ph.load_images()
-        lp_b, lt_b, dt_b = map(cls.extract_buildings, (lp, lt, dt))  # convert all damage scores 1-4 to 1
-
-        dp = dp * lp_b  # only give credit to damages where buildings are predicted
-        dp, dt = dp[dt_b == 1], dt[dt_b == 1]  # only score damage where there exist buildings in target damage
-
-        lrow = cls.compute_tp_fn_fp(lp_b, lt_b, 1)
-        drow = []
-        for i in range(1, 5): drow += cls.compute_tp_fn_fp(dp, dt, i)
-        return lrow, drow
+        lp, dp = ph.load_predictions()
+        return cls.count_row_pair(lp, dp, ph.load_targets())
 
 
 class F1Recorder:
@@ -172,9 +296,25 @@ class XviewMetrics:
             └── ...
     """
 
-    def __init__(self, pred_dir, targ_dir):
-        self.pred_dir, self.targ_dir = Path(pred_dir), Path(targ_dir)
-        assert self.pred_dir.is_dir(), f"Could not find prediction directory: '{pred_dir}'"
+    def __init__(self, pred_dir, targ_dir, predictions=None, use_target_cache=True, num_workers=None,
+                 target_cache_dir=None):
+        """
+        Args:
+            pred_dir (str): directory of localization and damage predictions, unused if predictions are given
+            targ_dir (str): directory of localization and damage targets
+            predictions (dict): optional in memory predictions, img_id -> (localization, damage) uint8 arrays
+            use_target_cache (bool): read the targets from a TargetCache, built on first use
+            num_workers (int): scoring processes, all cpus by default
+            target_cache_dir (str): where the TargetCache is kept, see TargetCache
+        """
+        self.pred_dir = Path(pred_dir) if predictions is None else None
+        self.targ_dir = Path(targ_dir)
+        self.predictions = predictions
+        self.use_target_cache = use_target_cache
+        self.num_workers = num_workers
+        self.target_cache_dir = target_cache_dir
+        if self.pred_dir is not None:
+            assert self.pred_dir.is_dir(), f"Could not find prediction directory: '{pred_dir}'"
         assert self.targ_dir.is_dir(), f"Could not find target directory: '{targ_dir}'"
 
         self.dmg2str = {1: f'No damage     (1) ',
@@ -202,7 +342,7 @@ class XviewMetrics:
 
     def get_path_handlers(self):
         self.path_handlers = []
-        for path in self.targ_dir.glob('*.png'):
+        for path in sorted(self.targ_dir.glob('*.png')):
             test_hold, loc_dmg, img_id, target = path.name.rstrip('.png').split('_')
             assert loc_dmg in ['localization',
                                'damage'], f"target filenames must have 'localization' or 'damage' in filename, got {path}"
@@ -215,8 +355,19 @@ class XviewMetrics:
         builds the localization dataframe (self.ldf) and damage dataframe (self.ddf) from
         path handlers (self.path_handlers)
         """
-        with Pool() as p:
-            all_rows = p.map(RowPairCalculator.get_row_pair, self.path_handlers)
+        with Pool(self.num_workers) as p:
+            if self.use_target_cache:
+                TargetCache(self.targ_dir, self.path_handlers, self.target_cache_dir).attach(p)
+
+            if self.predictions is None:
+                all_rows = p.map(RowPairCalculator.get_row_pair, self.path_handlers)
+            else:
+                # Already decoded, counting in this process is cheaper than sending them to the workers
+                all_rows = []
+                for ph in self.path_handlers:
+                    lp, dp = (PathHandler.validate_image(np.asarray(x), f'{ph.img_id} prediction')
+                              for x in self.predictions[ph.img_id])
+                    all_rows.append(RowPairCalculator.count_row_pair(lp, dp, ph.load_targets()))
 
         lcolumns = ['lTP', 'lFN', 'lFP']
         self.ldf = pd.DataFrame([lrow for lrow, drow in all_rows], columns=lcolumns)
@@ -263,16 +414,28 @@ class XviewMetrics:
         return 0.3 * self.lf1 + 0.7 * self.df1
 
     @classmethod
-    def compute_score(cls, pred_dir, targ_dir, out_fp):
+    def from_arrays(cls, predictions, targ_dir, **kwargs):
+        """
+        Scores in memory predictions, without writing PNGs
+
+        Args:
+            predictions (dict): img_id -> (localization, damage) uint8 arrays, e.g. '00000' for test_*_00000_target.png
+            targ_dir (str): directory of localization and damage targets
+        """
+        return cls(None, targ_dir, predictions=predictions, **kwargs)
+
+    @classmethod
+    def compute_score(cls, pred_dir, targ_dir, out_fp, target_cache_dir=None):
         """
         Args:
             pred_dir (str): directory of localization and damage predictions
             targ_dir (str): directory of localization and damage targets
             out_fp   (str): output json - folder must already exist
+            target_cache_dir (str): where the decoded targets are cached, see TargetCache
         """
         print(f"Calculating metrics using {cpu_count()} cpus...")
 
-        self = cls(pred_dir, targ_dir)
+        self = cls(pred_dir, targ_dir, target_cache_dir=target_cache_dir)
 
         d = {'score': self.score,
              'damage_f1': self.df1,
@@ -7,12 +7,12 @@ class SimpleInferenceDataset(torch.utils.data.Dataset):
     '''
     A dataset objects that lists
     '''
-    def __init__(self, dataset_path, file_extension='.png', downsample_scale=None, filter=None):
+    def __init__(self, dataset_path, file_extension='.png', downsample_scale=None, filter=None, keep_uint8=False):
 
         image_files = []
 
         for filename in os.listdir(dataset_path):
-            if filename.endswith(file_extension) and filter in filename:
+            if filename.endswith(file_extension) and (filter is None or filter in filename):
                 image_files.append(filename)
 
         self.image_files = image_files
@@ -20,12 +20,18 @@ class SimpleInferenceDataset(torch.utils.data.Dataset):
         self.dataset_path = dataset_path
         self.downsample_scale = downsample_scale
         self.filter = filter
+        # uint8 transport, images are scaled on the device (see unet.batch_augmentations.BatchToDevice)
+        self.keep_uint8 = keep_uint8
 
     def __getitem__(self, index):
         label = np.zeros(1)
         image_filename = self.image_files[index]
         x = self._process_input(image_filename)
-        return x, label, image_filename
+        return {
+            'x': x,
+            'y': label,
+            'img_name': image_filename,
+        }
 
     def _process_input(self, image_filename):
         img_path = os.path.join(self.dataset_path, image_filename)
@@ -38,13 +44,37 @@ class SimpleInferenceDataset(torch.utils.data.Dataset):
         # BGR to RGB
         img = img[...,::-1]
 
-        img = img.astype(np.float32) / 255.
+        if not self.keep_uint8:
+            img = img.astype(np.float32) / 255.
         # move from (x, y, c) to (c, x, y) PyTorch style
-        img = np.moveaxis(img, -1, 0)
+        img = np.ascontiguousarray(np.moveaxis(img, -1, 0))
 
         return img
 
 
     def __len__(self):
 
-        return self.length
\ No newline at end of file
+        return self.length
+class PrePostInferenceDataset(SimpleInferenceDataset):
+    '''
+    Pre disaster images with their post disaster counterpart, each decoded once.
+    'x' is the pre disaster image, 'x_post' the post disaster one, 'img_name' the pre disaster filename.
+    '''
+    def __init__(self, dataset_path, file_extension='.png', downsample_scale=None, keep_uint8=False):
+        super().__init__(dataset_path, file_extension, downsample_scale, filter='pre', keep_uint8=keep_uint8)
+        # 'pre' may be part of other names, only keep actual pre disaster images
+        self.image_files = [f for f in self.image_files if 'pre' in f.split('_')]
+        self.length = len(self.image_files)
+
+    def __getitem__(self, index):
+        sample = super().__getitem__(index)
+        sample['x_post'] = self._process_input(post_filename(sample['img_name']))
+        return sample
+
+def post_filename(pre_filename):
+    '''
+    test_pre_00000.png -> test_post_00000.png, hurricane-harvey_00000000_pre_disaster.png -> ..._post_disaster.png
+    '''
+    name_split = pre_filename.split('_')
+    name_split[name_split.index('pre')] = 'post'
+    return '_'.join(name_split)
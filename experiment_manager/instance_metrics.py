@@ -0,0 +1,141 @@
+#
+# instance_metrics.py : building level (instance) localization metrics. Predicted and true buildings are the
+#                       8-connected components of the masks, matched by IoU through an overlap table built with one
+#                       bincount over the (true label, predicted label) pairs of an image. The per image work is cpu
+#                       bound (cv2), it runs in worker processes fed by the inference callback
+
+import numpy as np
+import torch
+import cv2
+
+from experiment_manager.worker_pool import OrderedMaskJobs, worker_pool
+
+
+def label_components(mask, connectivity=8):
+    '''
+    :param mask: [H, W] uint8 mask
+    :return: number of components (without background), [H, W] int32 labels (0 = background)
+    '''
+    num_labels, labels = cv2.connectedComponents(mask, connectivity=connectivity, ltype=cv2.CV_32S)
+    return num_labels - 1, labels
+
+def overlap_table(true_labels, pred_labels, num_true, num_pred, max_dense=1 << 22):
+    '''
+    Sparse overlap table of two label maps
+    :param max_dense: largest table counted with a dense bincount, bigger ones (very noisy predictions) are counted
+                      with np.unique
+    :return: true label, pred label, intersection and IoU of every overlapping pair of components
+    '''
+    true_area = np.bincount(true_labels.ravel(), minlength=num_true + 1)
+    pred_area = np.bincount(pred_labels.ravel(), minlength=num_pred + 1)
+
+    both = (true_labels > 0) & (pred_labels > 0)
+    num_pred_labels = num_pred + 1
+    pairs = true_labels[both].astype(np.int64) * num_pred_labels + pred_labels[both]
+    if (num_true + 1) * num_pred_labels <= max_dense:
+        counts = np.bincount(pairs, minlength=(num_true + 1) * num_pred_labels)
+        pairs = np.nonzero(counts)[0]
+        intersection = counts[pairs]
+    else:
+        pairs, intersection = np.unique(pairs, return_counts=True)
+
+    t, p = pairs // num_pred_labels, pairs % num_pred_labels
+    iou = intersection / (true_area[t] + pred_area[p] - intersection)
+    return t, p, intersection, iou
+
+def match_instances(true_labels, pred_labels, num_true, num_pred, iou_threshold=0.5):
+    '''
+    Greedy one to one matching by descending IoU. Above an IoU of 0.5 a component can only overlap that much with
+    a single other one, so the matching is unique there
+    :return: IoU of the matched pairs
+    '''
+    t, p, _, iou = overlap_table(true_labels, pred_labels, num_true, num_pred)
+    candidates = iou >= iou_threshold
+    t, p, iou = t[candidates], p[candidates], iou[candidates]
+    if iou_threshold > 0.5:
+        return iou
+
+    order = np.argsort(-iou, kind='stable')
+    used_true, used_pred, matched = set(), set(), []
+    for i in order:
+        if t[i] not in used_true and p[i] not in used_pred:
+            used_true.add(t[i])
+            used_pred.add(p[i])
+            matched.append(iou[i])
+    return np.array(matched)
+
+def instance_counts(y_true, y_pred, iou_threshold=0.5, open_kernel=5):
+    '''
+    Building level counts of one image
+    :param y_true: [H, W] boolean target
+    :param y_pred: [H, W] boolean (thresholded) prediction
+    :param open_kernel: size of the morphological opening removing speckles from the prediction, 0 to disable
+    :return: [true buildings, predicted buildings, matched buildings, sum of matched IoUs]
+    '''
+    pred_mask = y_pred.astype(np.uint8)
+    if open_kernel:
+        pred_mask = cv2.morphologyEx(pred_mask, cv2.MORPH_OPEN, np.ones((open_kernel, open_kernel), np.uint8))
+    num_true, true_labels = label_components(y_true.astype(np.uint8))
+    num_pred, pred_labels = label_components(pred_mask)
+    matched = match_instances(true_labels, pred_labels, num_true, num_pred, iou_threshold)
+    return [num_true, num_pred, len(matched), float(matched.sum())]
+
+
+def instance_worker_pool(num_workers):
+    # forkserver workers, see worker_pool
+    return worker_pool(num_workers)
+
+
+class InstanceMatchingMetric():
+    '''
+    Building level precision, recall and F1. Samples are thresholded on their device, the component labelling and
+    matching of every image runs in a pool of worker processes while inference goes on (see OrderedMaskJobs).
+    Takes in rasterized and batched images
+    :param y_true: [B, 1, H, W] or [B, H, W]
+    :param y_pred: [B, 1, H, W] or [B, H, W], probabilities
+    :param threshold: probability threshold of the predicted building pixels
+    :param iou_threshold: minimum IoU of a true and a predicted building to count as a match
+    :param num_workers: worker processes, 0 computes the counts in the calling process
+    :param pool: executor shared with other metrics (see instance_worker_pool), it is then not shut down by counts
+    '''
+    def __init__(self, threshold=0.5, iou_threshold=0.5, open_kernel=5, num_workers=4, max_pending=64, pool=None):
+        self.threshold = threshold
+        self.iou_threshold = iou_threshold
+        self.open_kernel = open_kernel
+        self.image_counts = [] # [true, pred, matched, matched iou sum] per image
+        self.jobs = OrderedMaskJobs(instance_counts, lambda _, counts: self.image_counts.append(counts),
+                                    pool=pool, num_workers=num_workers, max_pending=max_pending)
+
+    def add_sample(self, y_true:torch.Tensor, y_pred):
+        y_true = (y_true.detach() > 0.5).reshape(-1, *y_true.shape[-2:]).cpu().numpy()
+        y_pred = (y_pred.detach() >= self.threshold).reshape(-1, *y_pred.shape[-2:]).cpu().numpy()
+        for true_mask, pred_mask in zip(y_true, y_pred):
+            self.jobs.submit([true_mask, pred_mask], self.iou_threshold, self.open_kernel)
+
+    def counts(self):
+        '''
+        Waits for all the submitted images and shuts the workers down
+        :return: [N, 4] array of true, predicted and matched buildings and the matched IoU sum per image
+        '''
+        self.jobs.close()
+        return np.array(self.image_counts, dtype=np.float64).reshape(-1, 4)
+
+    def compute_basic_metrics(self):
+        '''
+        :return: building precision, recall, F1 and the mean IoU of the matched buildings
+        '''
+        num_true, num_pred, num_matched, iou_sum = self.counts().sum(axis=0)
+        precision = num_matched / max(num_pred, 1)
+        recall = num_matched / max(num_true, 1)
+        f1 = 2 * precision * recall / max(precision + recall, 1e-12)
+        mean_iou = iou_sum / max(num_matched, 1)
+        return precision, recall, f1, mean_iou
+
+    def compute_count_error(self):
+        '''
+        :return: mean absolute relative error of the number of predicted buildings per image
+        '''
+        counts = self.counts()
+        if len(counts) == 0:
+            return 0.
+        return np.mean(np.abs(counts[:, 0] - counts[:, 1]) / np.maximum(counts[:, 0], 1))
@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 from sklearn.metrics import roc_auc_score, roc_curve
 import sys
@@ -86,6 +87,119 @@ class MultiThresholdMetric():
         denom = (self.precision + self.recall).clamp(10e-05)
         return 2 * self.precision * self.recall / denom
 
+class HistogramMetric():
+    '''
+    Streaming multi threshold metrics. Predicted probabilities are binned into num_bins equal bins, separately for
+    positive and negative pixels and for every class, so the whole dataset fits into O(num_bins) memory.
+    Thresholds are the bin edges (a pixel is predicted positive if its probability is >= the threshold), all the
+    counts are exact at that resolution.
+    Takes in rasterized and batched images
+    :param y_true: [B, C, H, W] or [B, H, W]
+    :param y_pred: [B, C, H, W] or [B, H, W], probabilities
+    '''
+    def __init__(self, num_bins=1000):
+        self.num_bins = num_bins
+        self.pos_hist = None # [C, num_bins]
+        self.neg_hist = None
+
+    @property
+    def thresholds(self):
+        return torch.arange(self.num_bins, dtype=torch.float64) / self.num_bins
+
+    def add_sample(self, y_true:torch.Tensor, y_pred):
+        if y_pred.dim() == 3: y_pred = y_pred[:, None]
+        if y_true.dim() == 3: y_true = y_true[:, None]
+        num_classes = y_pred.shape[1]
+        if self.pos_hist is None:
+            self.pos_hist = torch.zeros(num_classes, self.num_bins, dtype=torch.int64, device=y_pred.device)
+            self.neg_hist = torch.zeros_like(self.pos_hist)
+
+        bins = (y_pred.detach() * self.num_bins).long().clamp_(0, self.num_bins - 1)
+        # One histogram per class, in one bincount
+        bins += (torch.arange(num_classes, device=bins.device) * self.num_bins).view(1, -1, 1, 1)
+        positive = y_true.detach().expand_as(bins) > 0.5
+
+        size = num_classes * self.num_bins
+        self.pos_hist += torch.bincount(bins[positive], minlength=size).view(num_classes, self.num_bins)
+        self.neg_hist += torch.bincount(bins[~positive], minlength=size).view(num_classes, self.num_bins)
+
+    def _counts(self, class_index=None):
+        '''
+        :param class_index: counts of one class, summed over all classes if None
+        :return: TP, FP, TN, FN, one float64 value per threshold
+        '''
+        pos_hist, neg_hist = self.pos_hist.double().cpu(), self.neg_hist.double().cpu()
+        if class_index is None:
+            pos_hist, neg_hist = pos_hist.sum(0), neg_hist.sum(0)
+        else:
+            pos_hist, neg_hist = pos_hist[class_index], neg_hist[class_index]
+        # Everything in the bins at and above a threshold is predicted positive
+        TP = pos_hist.flip(-1).cumsum(-1).flip(-1)
+        FP = neg_hist.flip(-1).cumsum(-1).flip(-1)
+        FN = pos_hist.sum() - TP
+        TN = neg_hist.sum() - FP
+        return TP, FP, TN, FN
+
+    @property
+    def TP(self):
+        return self._counts()[0]
+
+    @property
+    def FP(self):
+        return self._counts()[1]
+
+    @property
+    def TN(self):
+        return self._counts()[2]
+
+    @property
+    def FN(self):
+        return self._counts()[3]
+
+    def compute_precision_recall(self, class_index=None):
+        TP, FP, TN, FN = self._counts(class_index)
+        precision = TP / (TP + FP).clamp(10e-05)
+        recall = TP / (TP + FN).clamp(10e-05)
+        return precision, recall
+
+    def compute_basic_metrics(self, class_index=None):
+        '''
+        Computes False Positive rate and False Negative Rate
+        :return:
+        '''
+        TP, FP, TN, FN = self._counts(class_index)
+        false_pos_rate = FP / (FP + TN).clamp(10e-05)
+        false_neg_rate = FN / (FN + TP).clamp(10e-05)
+        return false_pos_rate, false_neg_rate
+
+    def compute_f1(self, class_index=None):
+        precision, recall = self.compute_precision_recall(class_index)
+        denom = (precision + recall).clamp(10e-05)
+        return 2 * precision * recall / denom
+
+    def compute_roc(self, class_index=None):
+        '''
+        :return: fpr, tpr with increasing fpr, from (0, 0) to (1, 1)
+        '''
+        TP, FP, TN, FN = self._counts(class_index)
+        tpr = TP / (TP + FN).clamp(10e-05)
+        fpr = FP / (FP + TN).clamp(10e-05)
+        zero = torch.zeros(1, dtype=fpr.dtype)
+        return torch.cat([zero, fpr.flip(0)]), torch.cat([zero, tpr.flip(0)])
+
+    def compute_roc_auc(self, class_index=None):
+        fpr, tpr = self.compute_roc(class_index)
+        # Trapezoids, pixels in the same bin count as tied scores
+        return torch.trapz(tpr, fpr).item()
+
+    def compute_average_precision(self, class_index=None):
+        '''
+        Step wise area under the precision recall curve, like sklearn's average_precision_score
+        '''
+        precision, recall = self.compute_precision_recall(class_index)
+        recall_next = torch.cat([recall[1:], torch.zeros(1, dtype=recall.dtype)])
+        return ((recall - recall_next) * precision).sum().item()
+
 class MultiClassF1():
     def __init__(self, ignore_last_class = False):
 
@@ -106,6 +220,17 @@ class MultiClassF1():
         self.FN = 0
 
     def add_sample(self, y_true:torch.Tensor, y_pred):
+        TP, TN, FP, FN = self.sample_counts(y_true, y_pred)
+        self.TP += TP.sum(0)
+        self.TN += TN.sum(0)
+        self.FP += FP.sum(0)
+        self.FN += FN.sum(0)
+
+    def sample_counts(self, y_true:torch.Tensor, y_pred):
+        '''
+        :return: TP, TN, FP, FN of every image, [B, C] each
+        '''
+        y_true_mask = True
         if self.ignore_last_class:
             # Ignore background classes
 
@@ -119,10 +244,12 @@ class MultiClassF1():
         y_pred_argmax = torch.argmax(y_pred, dim=1, keepdim=True)  # [B, C, ...]
         y_pred = torch.zeros_like(y_pred, dtype=torch.bool).scatter_(1, y_pred_argmax,True)
 
-        self.TP += (y_true & y_pred).sum(dim=self._data_dims).float()
-        self.TN += ((~y_true & ~y_pred) * y_true_mask).sum(dim=self._data_dims).float()
-        self.FP += ((~y_true & y_pred) * y_true_mask).sum(dim=self._data_dims).float()
-        self.FN += (y_true & ~y_pred).sum(dim=self._data_dims).float()
+        image_dims = (2, 3)
+        TP = (y_true & y_pred).sum(dim=image_dims).float()
+        TN = ((~y_true & ~y_pred) * y_true_mask).sum(dim=image_dims).float()
+        FP = ((~y_true & y_pred) * y_true_mask).sum(dim=image_dims).float()
+        FN = (y_true & ~y_pred).sum(dim=image_dims).float()
+        return TP, TN, FP, FN
 
 
     def compute_basic_metrics(self):
@@ -198,3 +325,174 @@ def roc_score(y_true:torch.Tensor, y_preds:torch.Tensor, ):
     curve = roc_curve(y_true, y_preds, pos_label=1,  drop_intermediate=False)
     # print(curve)
     return curve
+
+
+class GroupIndex():
+    '''
+    Maps group names (e.g. disaster types) to consecutive indices, new names are added as they come
+    '''
+    def __init__(self):
+        self.names = []
+        self._index = {}
+
+    def __call__(self, names, device=None):
+        '''
+        :return: [len(names)] int64 group ids
+        '''
+        for name in names:
+            if name not in self._index:
+                self._index[name] = len(self.names)
+                self.names.append(name)
+        return torch.tensor([self._index[name] for name in names], dtype=torch.int64, device=device)
+
+    def __len__(self):
+        return len(self.names)
+
+def _grow_groups(tensor, num_groups):
+    # Zero rows for the groups seen for the first time
+    if tensor.shape[0] >= num_groups:
+        return tensor
+    padding = torch.zeros((num_groups - tensor.shape[0],) + tensor.shape[1:], dtype=tensor.dtype, device=tensor.device)
+    return torch.cat([tensor, padding])
+
+class GroupedHistogramMetric():
+    '''
+    HistogramMetric per group (e.g. per disaster type), all groups of a batch are binned in one bincount
+    '''
+    def __init__(self, num_bins=1000):
+        self.num_bins = num_bins
+        self.group_index = GroupIndex()
+        self.pos_hist = None # [G, C, num_bins]
+        self.neg_hist = None
+
+    def add_sample(self, y_true:torch.Tensor, y_pred, groups):
+        '''
+        :param groups: group name of every image of the batch
+        '''
+        if y_pred.dim() == 3: y_pred = y_pred[:, None]
+        if y_true.dim() == 3: y_true = y_true[:, None]
+        num_classes = y_pred.shape[1]
+        group_ids = self.group_index(groups, y_pred.device)
+        num_groups = len(self.group_index)
+        if self.pos_hist is None:
+            self.pos_hist = torch.zeros(0, num_classes, self.num_bins, dtype=torch.int64, device=y_pred.device)
+            self.neg_hist = torch.zeros_like(self.pos_hist)
+        self.pos_hist = _grow_groups(self.pos_hist, num_groups)
+        self.neg_hist = _grow_groups(self.neg_hist, num_groups)
+
+        bins = (y_pred.detach() * self.num_bins).long().clamp_(0, self.num_bins - 1)
+        # Histogram (group, class) of every pixel
+        offsets = group_ids.view(-1, 1) * num_classes + torch.arange(num_classes, device=bins.device).view(1, -1)
+        bins += (offsets * self.num_bins)[..., None, None]
+        positive = y_true.detach().expand_as(bins) > 0.5
+
+        size = num_groups * num_classes * self.num_bins
+        self.pos_hist += torch.bincount(bins[positive], minlength=size).view(self.pos_hist.shape)
+        self.neg_hist += torch.bincount(bins[~positive], minlength=size).view(self.neg_hist.shape)
+
+    def items(self):
+        '''
+        :return: (group name, HistogramMetric of the group) pairs
+        '''
+        for group_id, name in enumerate(self.group_index.names):
+            measurer = HistogramMetric(self.num_bins)
+            measurer.pos_hist = self.pos_hist[group_id]
+            measurer.neg_hist = self.neg_hist[group_id]
+            yield name, measurer
+
+class GroupedMultiClassF1():
+    '''
+    MultiClassF1 per group (e.g. per disaster type), the counts of all the images of a batch are added to their
+    group with one index_add
+    '''
+    def __init__(self, ignore_last_class = False):
+        self.ignore_last_class = ignore_last_class
+        self._counter = MultiClassF1(ignore_last_class)
+        self.group_index = GroupIndex()
+        self.counts = None # [4, G, C] TP, TN, FP, FN
+
+    def add_sample(self, y_true:torch.Tensor, y_pred, groups):
+        '''
+        :param groups: group name of every image of the batch
+        '''
+        group_ids = self.group_index(groups, y_pred.device)
+        counts = torch.stack(self._counter.sample_counts(y_true, y_pred), dim=1) # [B, 4, C]
+        if self.counts is None:
+            self.counts = torch.zeros(0, *counts.shape[1:], device=counts.device)
+        self.counts = _grow_groups(self.counts, len(self.group_index))
+        self.counts.index_add_(0, group_ids, counts)
+
+    def items(self):
+        '''
+        :return: (group name, MultiClassF1 of the group) pairs
+        '''
+        for group_id, name in enumerate(self.group_index.names):
+            measurer = MultiClassF1(self.ignore_last_class)
+            measurer.TP, measurer.TN, measurer.FP, measurer.FN = self.counts[group_id]
+            yield name, measurer
+
+class ConfusionMatrix():
+    '''
+    Confusion matrix accumulated on the device of the samples (bincount of true * C + pred), only matrix syncs to
+    the host. True labels outside [0, num_classes), e.g. 255 ignore labels, are skipped.
+    '''
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        self._matrix = None
+
+    def add_sample(self, y_true_index:torch.Tensor, y_pred_index):
+        '''
+        :param y_true_index: [B, H, W] class indices
+        :param y_pred_index: [B, H, W] class indices
+        '''
+        n = self.num_classes
+        valid = (y_true_index >= 0) & (y_true_index < n)
+        index = y_true_index[valid].long() * n + y_pred_index[valid].long()
+        counts = torch.bincount(index, minlength=n * n).view(n, n)
+        self._matrix = counts if self._matrix is None else self._matrix + counts
+
+    @property
+    def matrix(self):
+        '''
+        :return: [num_classes (true), num_classes (pred)] numpy confusion matrix
+        '''
+        if self._matrix is None:
+            return np.zeros((self.num_classes, self.num_classes), dtype=np.int64)
+        return self._matrix.cpu().numpy()
+
+class GroupedConfusionMatrix():
+    '''
+    Confusion matrices per group, accumulated on the device with one bincount per batch
+    '''
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.group_index = GroupIndex()
+        self.matrices = None # [G, num_classes (true), num_classes (pred)]
+
+    def add_sample(self, y_true_index:torch.Tensor, y_pred_index, groups):
+        '''
+        :param y_true_index: [B, H, W] class indices
+        :param y_pred_index: [B, H, W] class indices
+        :param groups: group name of every image of the batch
+        '''
+        n = self.num_classes
+        group_ids = self.group_index(groups, y_true_index.device)
+        num_groups = len(self.group_index)
+        if self.matrices is None:
+            self.matrices = torch.zeros(0, n, n, dtype=torch.int64, device=y_true_index.device)
+        self.matrices = _grow_groups(self.matrices, num_groups)
+
+        valid = (y_true_index >= 0) & (y_true_index < n)
+        index = (group_ids.view(-1, 1, 1) * n + y_true_index.long()) * n + y_pred_index.long()
+        self.matrices += torch.bincount(index[valid], minlength=num_groups * n * n).view(num_groups, n, n)
+
+    def items(self):
+        '''
+        :return: (group name, [num_classes, num_classes] numpy confusion matrix) pairs
+        '''
+        matrices = self.matrices.cpu().numpy()
+        for group_id, name in enumerate(self.group_index.names):
+            yield name, matrices[group_id]
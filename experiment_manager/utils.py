@@ -3,3 +3,14 @@ import torch
 def to_numpy(tensor:torch.Tensor):
     return tensor.cpu().detach().numpy()
 
+def worker_kwargs(cfg):
+    '''
+    DataLoader worker arguments from cfg.DATALOADER, persistent workers and prefetching only exist with worker processes
+    :return: kwargs for torch.utils.data.DataLoader
+    '''
+    kwargs = {'num_workers': cfg.DATALOADER.NUM_WORKER}
+    if cfg.DATALOADER.NUM_WORKER > 0:
+        kwargs['persistent_workers'] = cfg.DATALOADER.PERSISTENT_WORKERS
+        kwargs['prefetch_factor'] = cfg.DATALOADER.PREFETCH_FACTOR
+    return kwargs
+
@@ -0,0 +1,75 @@
+#
+# worker_pool.py : per image mask jobs (cv2 / scipy, cpu bound) run in a process pool next to inference.
+#                  Masks travel to the workers bit packed, results come back in submission order with a bounded
+#                  number of images in flight
+
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def worker_pool(num_workers, start_method='forkserver'):
+    '''
+    :param start_method: the workers of a forkserver pool are forked from a clean server process, not from a caller
+                         that may already hold a CUDA context, DataLoader threads and a used OpenCV thread pool (fork
+                         deadlocks). The job functions have to be importable and the calling script must guard its
+                         main code with if __name__ == '__main__'. 'fork' for scripts that run at module level
+    '''
+    return ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context(start_method))
+
+def _call_packed(fn, packed_masks, shape, args):
+    # 8x less to pickle than boolean masks
+    masks = [np.unpackbits(bits, count=shape[0] * shape[1]).reshape(shape).astype(bool) for bits in packed_masks]
+    return fn(*masks, *args)
+
+
+class OrderedMaskJobs():
+    '''
+    Runs fn(*masks, *args) for every submitted image in a pool and passes the results to on_result(tag, result) in
+    submission order. At most max_pending images are in flight, submit waits for the oldest one beyond that,
+    bounding memory
+    :param fn: module level (importable) function taking [H, W] boolean masks first
+    :param pool: executor shared with other jobs (see worker_pool), it is then not shut down by close
+    :param num_workers: size of the pool created on first use if none is given, 0 runs fn in the calling process
+    '''
+    def __init__(self, fn, on_result, pool=None, num_workers=None, max_pending=None, start_method='forkserver'):
+        self.fn = fn
+        self.on_result = on_result
+        self.pool = pool
+        self.owns_pool = pool is None
+        self.num_workers = num_workers
+        self.max_pending = max_pending or 4 * (num_workers or multiprocessing.cpu_count())
+        self.start_method = start_method
+        self.pending = deque()
+
+    def submit(self, masks, *args, tag=None):
+        '''
+        :param masks: [H, W] boolean numpy masks of one image, all of the same shape
+        '''
+        if self.pool is None and self.num_workers == 0:
+            self.on_result(tag, self.fn(*masks, *args))
+            return
+        if self.pool is None:
+            self.pool = worker_pool(self.num_workers or multiprocessing.cpu_count(), self.start_method)
+        future = self.pool.submit(_call_packed, self.fn, [np.packbits(mask) for mask in masks], masks[0].shape, args)
+        self.pending.append((tag, future))
+        self.collect(self.max_pending)
+
+    def collect(self, max_pending=0):
+        '''
+        Hands over the finished results, waiting for the oldest ones until at most max_pending are left
+        '''
+        while self.pending and (self.pending[0][1].done() or len(self.pending) > max_pending):
+            tag, future = self.pending.popleft()
+            self.on_result(tag, future.result())
+
+    def close(self):
+        '''
+        Waits for all the submitted images, shuts an own pool down (a new one is created if more images come)
+        '''
+        self.collect(0)
+        if self.pool is not None and self.owns_pool:
+            self.pool.shutdown()
+            self.pool = None
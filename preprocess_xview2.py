@@ -0,0 +1,93 @@
+'''
+One-shot offline preprocessing of xView2 splits. Everything produced here is
+cached inside the split directory and picked up by the datasets at training time.
+'''
+import argparse
+import json
+import os
+from os import path
+from multiprocessing import Pool, cpu_count
+
+import cv2
+
+from unet.label_store import build_label_store
+from unet.tile_store import build_tile_store
+from unet.labels_index import build_labels_index
+from unet.augmentations import multi_threshold_canny, bgr2rgb, clahe, vari_channel
+
+
+def building_masks(dataset_path, dataset_metadata, args):
+    for pre_or_post in ['pre', 'post']:
+        build_label_store(dataset_path, 'building_mask', pre_or_post, dataset_metadata, num_workers=args.num_workers)
+
+def damage_classes(dataset_path, dataset_metadata, args):
+    # Damage is only annotated on post disaster images
+    build_label_store(dataset_path, 'damage_class', 'post', dataset_metadata, num_workers=args.num_workers)
+
+def tile_store(dataset_path, dataset_metadata, args):
+    build_tile_store(dataset_path, dataset_metadata, num_workers=args.num_workers)
+
+def labels_index(dataset_path, dataset_metadata, args):
+    build_labels_index(dataset_path, dataset_metadata)
+
+def _canny_worker(args):
+    img_path, canny_path = args
+    # Same channel order as AddCanny sees after BGR2RGB, the strongest channel wins ties by order
+    img = bgr2rgb(cv2.imread(img_path))
+    cv2.imwrite(canny_path, multi_threshold_canny(img))
+
+def _clahe_worker(args):
+    img_path, clahe_path, vari_path = args
+    clahe_img = clahe(cv2.imread(img_path))
+    cv2.imwrite(clahe_path, clahe_img)
+    cv2.imwrite(vari_path, vari_channel(bgr2rgb(clahe_img)))
+
+def clahe_vari(dataset_path, dataset_metadata, args):
+    # clahe/ is read by the datasets with use_clahe, clahe_vari/ by the VARI transform
+    for subdir in ['clahe', 'clahe_vari']:
+        os.makedirs(path.join(dataset_path, subdir), exist_ok=True)
+    jobs = [(path.join(dataset_path, file_name), path.join(dataset_path, 'clahe', file_name), path.join(dataset_path, 'clahe_vari', file_name))
+            for file_name in (image_desc[pre_or_post]['file_name'] for image_desc in dataset_metadata for pre_or_post in ['pre', 'post'])]
+    print(f'computing clahe and vari of {len(jobs)} images...', end='', flush=True)
+    with Pool(args.num_workers or cpu_count()) as p:
+        for _ in p.imap_unordered(_clahe_worker, jobs, chunksize=16):
+            pass
+    print('done', flush=True)
+
+def canny(dataset_path, dataset_metadata, args):
+    # Edge channel of the 4 channel models, read by IncludeCanny
+    os.makedirs(path.join(dataset_path, 'canny'), exist_ok=True)
+    jobs = [(path.join(dataset_path, image_desc[pre_or_post]['file_name']), path.join(dataset_path, 'canny', image_desc[pre_or_post]['file_name']))
+            for image_desc in dataset_metadata for pre_or_post in ['pre', 'post']]
+    print(f'computing canny channel of {len(jobs)} images...', end='', flush=True)
+    with Pool(args.num_workers or cpu_count()) as p:
+        for _ in p.imap_unordered(_canny_worker, jobs, chunksize=16):
+            pass
+    print('done', flush=True)
+
+
+TASKS = {
+    'building_masks': building_masks,
+    'damage_classes': damage_classes,
+    'tile_store': tile_store,
+    'labels_index': labels_index,
+    'canny': canny,
+    'clahe': clahe_vari,
+}
+
+def get_args():
+    parser = argparse.ArgumentParser(description="xView2 preprocessing")
+    parser.add_argument('-d', '--data-dir', dest='data_dirs', type=str, nargs='+', required=True, help='dataset (split) directories')
+    parser.add_argument('-t', '--task', dest='tasks', type=str, nargs='+', default=list(TASKS.keys()),
+                        choices=list(TASKS.keys()), help='preprocessing tasks to run')
+    parser.add_argument('-j', '--num-workers', dest='num_workers', type=int, default=None, help='number of processes, defaults to all cores')
+    return parser.parse_known_args()[0]
+
+if __name__ == '__main__':
+    args = get_args()
+    for dataset_path in args.data_dirs:
+        print('==== preprocessing', dataset_path, flush=True)
+        with open(path.join(dataset_path, 'labels.json')) as f:
+            dataset_metadata = json.load(f)
+        for task in args.tasks:
+            TASKS[task](dataset_path, dataset_metadata, args)
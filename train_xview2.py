@@ -25,10 +25,14 @@ import wandb
 from unet import UNet
 from unet.dataloader import Xview2Detectron2Dataset
 from unet.augmentations import *
+from unet.batch_augmentations import BatchRandomFlipRotate, BatchToDevice
+from unet.utils.image_cache import configure_image_cache, image_cache_stats
+from unet.labels_index import image_weights
 
 from experiment_manager.metrics import f1_score
 from experiment_manager.args import default_argument_parser
 from experiment_manager.config import new_config
+from experiment_manager.utils import worker_kwargs
 from experiment_manager.loss import soft_dice_loss, soft_dice_loss_balanced, jaccard_like_loss, jaccard_like_balanced_loss
 from eval_unet_xview2 import model_eval
 
@@ -99,17 +103,32 @@ def train_net(net,
     trfm = []
     trfm.append(BGR2RGB())
     if cfg.DATASETS.USE_CLAHE_VARI: trfm.append(VARI())
+    use_canny = cfg.MODEL.IN_CHANNELS == 4
+    if use_canny and cfg.DATASETS.PRECOMPUTED_CANNY: trfm.append(IncludeCanny())
     if cfg.AUGMENTATION.RESIZE: trfm.append(Resize(scale=cfg.AUGMENTATION.RESIZE_RATIO))
+    crop = None
     if cfg.AUGMENTATION.CROP_TYPE == 'uniform':
-        trfm.append(UniformCrop(crop_size=cfg.AUGMENTATION.CROP_SIZE))
+        crop = UniformCrop(crop_size=cfg.AUGMENTATION.CROP_SIZE)
     elif cfg.AUGMENTATION.CROP_TYPE == 'importance':
-        trfm.append(ImportanceRandomCrop(crop_size=cfg.AUGMENTATION.CROP_SIZE))
-    if cfg.AUGMENTATION.RANDOM_FLIP_ROTATE: trfm.append(RandomFlipRotate())
-    if cfg.MODEL.IN_CHANNELS == 4:
+        crop = ImportanceRandomCrop(crop_size=cfg.AUGMENTATION.CROP_SIZE)
+    # In crop first mode the dataset crops before reading the input, BGR2RGB and VARI are per pixel so the order doesn't matter
+    crop_first = cfg.AUGMENTATION.CROP_FIRST and not cfg.AUGMENTATION.RESIZE
+    if crop is not None and not crop_first: trfm.append(crop)
+    if cfg.AUGMENTATION.RANDOM_FLIP_ROTATE and not cfg.AUGMENTATION.BATCH_FLIP_ROTATE: trfm.append(RandomFlipRotate())
+    batch_augment = None
+    if cfg.AUGMENTATION.RANDOM_FLIP_ROTATE and cfg.AUGMENTATION.BATCH_FLIP_ROTATE: batch_augment = BatchRandomFlipRotate()
+    if use_canny and not cfg.DATASETS.PRECOMPUTED_CANNY:
         trfm.append(AddCanny())
 
-    trfm.append(Npy2Torch())
+    # Labels only stay binary without interpolating augmentations in the workers
+    label_as_index = not (use_edge_loss or cfg.AUGMENTATION.RESIZE or any(isinstance(t, RandomFlipRotate) for t in trfm))
+    trfm.append(Npy2Torch(keep_uint8=cfg.DATALOADER.UINT8_TRANSPORT, label_as_index=label_as_index))
     trfm = transforms.Compose(trfm)
+    # VARI inputs are float in the workers and not scaled to [0, 1] (see VARI)
+    to_device = BatchToDevice(device, input_scale=1. if cfg.DATASETS.USE_CLAHE_VARI else 1 / 255)
+
+    # Must exist before the DataLoader forks its workers
+    configure_image_cache(cfg.DATALOADER.IMAGE_CACHE_MB * 2**20)
 
     # reset the generators
     dataset = Xview2Detectron2Dataset(cfg.DATASETS.TRAIN[0],
@@ -119,14 +138,18 @@ def train_net(net,
                                       include_edge_mask=use_edge_loss,
                                       edge_mask_type=cfg.MODEL.EDGE_WEIGHTED_LOSS.TYPE,
                                       use_clahe=cfg.DATASETS.USE_CLAHE_VARI,
+                                      use_label_store=cfg.DATASETS.USE_LABEL_STORE,
+                                      use_tile_store=cfg.DATASETS.USE_TILE_STORE,
+                                      use_labels_index=cfg.DATASETS.USE_LABELS_INDEX,
+                                      crop_first=crop if crop_first else None,
                                       )
 
     dataloader_kwargs = {
         'batch_size': cfg.TRAINER.BATCH_SIZE,
-        'num_workers': cfg.DATALOADER.NUM_WORKER,
         'shuffle':cfg.DATALOADER.SHUFFLE,
         'drop_last': True,
         'pin_memory': True,
+        **worker_kwargs(cfg),
     }
 
     # sampler
@@ -152,9 +175,10 @@ def train_net(net,
         for i, batch in enumerate(dataloader):
             optimizer.zero_grad()
 
-            x = batch['x'].to(device)
-            y_gts = batch['y'].to(device)
+            x, y_gts = to_device(batch['x'], batch['y'])
             image_weight = batch['image_weight']
+            if batch_augment:
+                x, y_gts = batch_augment(x, y_gts)
 
 
             y_pred = net(x)
@@ -213,6 +237,7 @@ def train_net(net,
                     'gpu_memory': max_mem,
                     'time': time_per_n_batches,
                     'total_positive_pixels': np.mean(positive_pixels_set),
+                    'image_cache_hit_rate': image_cache_stats()['hit_rate'],
                     'step': global_step,
                 })
 
@@ -261,7 +286,7 @@ def plot_images(x_n, y_gts_n, y_pred_n, idx):
 def image_sampling_weight(dataset_metadata):
     print('performing oversampling...', end='', flush=True)
     EMPTY_IMAGE_BASELINE = 1000
-    image_p = np.array([image_desc['pre']['image_weight'] for image_desc in dataset_metadata]) + EMPTY_IMAGE_BASELINE
+    image_p = image_weights(dataset_metadata, 'pre') + EMPTY_IMAGE_BASELINE
     print('done', flush=True)
     # normalize to [0., 1.]
     image_p = image_p
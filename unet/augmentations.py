@@ -1,4 +1,5 @@
 import os
+from collections import OrderedDict
 
 import torchvision.transforms.functional as TF
 
@@ -23,33 +24,155 @@ class Resize():
 
         return input, label, image_path
 
+VARI_EPS = 1e-6
+
+def vari_channel(rgb):
+    '''
+    Visible Atmospherically Resistant Index, (G - R) / (G + R - B), clipped to [-1, 1] and mapped to [0, 1]
+    :param rgb: [H, W, 3] uint8 image in RGB order
+    :return: [H, W] uint8, [0, 1] scaled to [0, 255] so that Npy2Torch scales it like the image
+    '''
+    R, G, B = cv2.split(rgb.astype(np.float32))
+    vari = (G - R) / (G + R - B + VARI_EPS)
+    vari = np.clip(vari, -1., 1.) * 0.5 + 0.5
+    return np.round(vari * 255).astype(np.uint8)
+
+def vari_tensor(rgb):
+    '''
+    vari_channel on tensors, without the uint8 quantization
+    :param rgb: [..., 3, H, W] RGB tensor, in any scale
+    :return: [..., H, W] float in [0, 1]
+    '''
+    R, G, B = rgb[..., 0, :, :].float(), rgb[..., 1, :, :].float(), rgb[..., 2, :, :].float()
+    return torch.clamp((G - R) / (G + R - B + VARI_EPS), -1., 1.) * 0.5 + 0.5
+
+def clahe(bgr, clip_limit=2.0, tile_grid_size=(8, 8)):
+    '''
+    Contrast limited adaptive histogram equalization of the lightness channel
+    :param bgr: [H, W, 3] uint8 image as read by cv2
+    :return: [H, W, 3] uint8 BGR image
+    '''
+    lab = cv2.cvtColor(bgr, cv2.COLOR_BGR2LAB)
+    lab[..., 0] = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size).apply(lab[..., 0])
+    return cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+
 class VARI():
+    '''
+    Appends the VARI channel, read from clahe_vari/ if it was generated (preprocess_xview2.py -t clahe),
+    computed on the input otherwise. Works before Npy2Torch ([H, W, C] uint8 RGB) and after it ([C, H, W] in [0, 1]).
+    Before Npy2Torch the input becomes float32, which Npy2Torch does not rescale: all the channels reach the net
+    in [0, 255], the scale every USE_CLAHE_VARI model was trained with.
+    '''
     def __call__(self, args):
         input, label, image_path = args
         image_name = os.path.basename(image_path)
         dir_name = os.path.dirname(image_path)
         vari_path = os.path.join(dir_name, 'clahe_vari' ,image_name)
-        if os.path.exists(vari_path):
-            mask = imread_cached(vari_path).astype(np.float32)[...,[0]]
-            input_t = np.concatenate([input, mask], axis=-1)
+        if image_exists(vari_path):
+            vari = imread_window(vari_path, getattr(image_path, 'window', None))[..., 0]
+        elif torch.is_tensor(input):
+            vari = None
+        else:
+            vari = vari_channel(input[..., :3])
+
+        if torch.is_tensor(input):
+            if vari is None:
+                vari_t = vari_tensor(input[:3])
+            else:
+                vari_t = torch.from_numpy(vari.astype(np.float32) / 255)
+            if input.dtype == torch.uint8:
+                # uint8 transport, the channel is scaled back by 1 / 255 on the device
+                vari_t = torch.round(vari_t * 255)
+            input_t = torch.cat([input, vari_t[None].to(input.dtype)])
             return input_t, label, image_path
-        # Input is in BGR
-        assert input.shape[1] == input.shape[2] and torch.is_tensor(input), 'invalid tensor, did you forget to put VARI after Np2Torch?'
-        R = input[0]
-        G = input[1]
-        B = input[2]
-        eps = 1e-6
-        VARI = (G-R) / 2 * (eps + G+R-B) + 0.5 # Linearly transformed to be [0, 1]
-        VARI = VARI.unsqueeze(0)
-        input_t = torch.cat([input, VARI])
+
+        input_t = append_channels(input, vari[..., None], dtype=np.float32)
         return input_t, label, image_path
 
+# Class index of pixels without any class (all zero one hot vector) in uint8 transport mode
+LABEL_INDEX_NONE = 255
+
 class Npy2Torch():
+    '''
+    :param keep_uint8: uint8 transport mode, the input is sent as a uint8 [C, H, W] tensor (float inputs are rounded)
+                       and converted to float on the training device by BatchToDevice, which applies the scaling
+    :param label_as_index: in uint8 transport mode, binary labels are sent as [H, W] uint8 class indices,
+                           only valid if the label is still binary (no interpolating Resize or RandomFlipRotate)
+    '''
+    def __init__(self, keep_uint8=False, label_as_index=False):
+        self.keep_uint8 = keep_uint8
+        self.label_as_index = keep_uint8 and label_as_index
+
     def __call__(self, args):
         input, label, image_path = args
-        input_t = TF.to_tensor(input)
-        label = TF.to_tensor(label)
+        if not self.keep_uint8:
+            input_t = chw_tensor(input)
+            label = chw_tensor(label)
+            return input_t, label, image_path
+
+        if input.dtype != np.uint8:
+            input = np.clip(np.rint(input), 0, 255).astype(np.uint8)
+        input_t = chw_tensor(input, scale_uint8=False)
+
+        if self.label_as_index:
+            if label.shape[-1] == 1:
+                label_index = label[..., 0].astype(np.uint8)
+            else:
+                label_index = label.argmax(axis=-1).astype(np.uint8)
+                label_index[label.max(axis=-1) == 0] = LABEL_INDEX_NONE
+            label = torch.from_numpy(label_index)
+        else:
+            label = chw_tensor(label)
         return input_t, label, image_path
+
+def chw_tensor(array, scale_uint8=True):
+    '''
+    TF.to_tensor without the copy: float arrays become a [C, H, W] view with channels last strides, the batch
+    is made contiguous once when the DataLoader collates it. uint8 arrays are still scaled to [0, 1] by to_tensor.
+    :param scale_uint8: False keeps uint8 arrays as unscaled uint8 views (uint8 transport)
+    '''
+    if array.dtype == np.uint8 and scale_uint8:
+        return TF.to_tensor(array)
+    if array.ndim == 2:
+        array = array[..., None]
+    if any(stride < 0 for stride in array.strides):
+        # np.flip views, torch does not support negative strides
+        array = np.ascontiguousarray(array)
+    return torch.from_numpy(array).permute(2, 0, 1)
+
+class PreallocateChannels():
+    '''
+    BGR2RGB into a [H, W, num_channels] buffer, for pipelines that stack channels onto the input
+    (IncludeLocalizationMask, StackPreDisasterImage, ...). The input is returned as a view of the leading channels,
+    and append_channels writes the stacked channels into the rest of the buffer instead of concatenating.
+    :param dtype: dtype of the stacked input (what np.concatenate would have promoted it to)
+    '''
+    def __init__(self, num_channels, dtype=np.float32):
+        self.num_channels = num_channels
+        self.dtype = dtype
+
+    def __call__(self, args):
+        input, label, image_path = args
+        buffer = np.empty(input.shape[:2] + (self.num_channels,), dtype=self.dtype)
+        # Channel swap and cast in one pass
+        buffer[..., :3] = input[..., ::-1]
+        return buffer[..., :3], label, image_path
+
+def append_channels(input, channels, dtype=None):
+    '''
+    np.concatenate([input, channels.astype(dtype)], axis=-1), written in place when input is the leading channels
+    of a PreallocateChannels buffer with enough room left
+    :param dtype: dtype the channels are cast to, by default the usual promotion of both dtypes
+    '''
+    dtype = np.result_type(input.dtype, channels.dtype if dtype is None else dtype)
+    buffer = input.base
+    start, stop = input.shape[-1], input.shape[-1] + channels.shape[-1]
+    if (isinstance(buffer, np.ndarray) and buffer.dtype == dtype and buffer.ndim == 3
+            and buffer.shape[:2] == input.shape[:2] and buffer.shape[-1] >= stop
+            and buffer.strides == input.strides and buffer.ctypes.data == input.ctypes.data):
+        buffer[..., start:stop] = channels
+        return buffer[..., :stop]
+    return np.concatenate([input, channels], axis=-1, dtype=dtype)
 class BGR2RGB():
     def __call__(self, args):
         input, label, image_path = args
@@ -62,13 +185,26 @@ class UniformCrop():
     '''
     def __init__(self, crop_size):
         self.crop_size = crop_size
-    def random_crop(self, input, label):
-        image_size = input.shape[-2]
+
+    def random_window(self, image_size):
         crop_limit = image_size - self.crop_size
         x, y = np.random.randint(0, crop_limit, size=2)
+        return y, x, self.crop_size
+
+    def choose_window(self, weight_map, key=None):
+        '''
+        Picks the crop window from the label alone, used by the datasets in crop first mode
+        to only read that window of the input
+        :param weight_map: [H, W] label summed over its channels
+        :param key: identifies the image, lets subclasses cache per image statistics
+        :return: (y, x, crop_size)
+        '''
+        return self.random_window(weight_map.shape[-1])
 
-        input = input[y:y+self.crop_size, x:x+self.crop_size, :]
-        label = label[y:y+self.crop_size, x:x+self.crop_size]
+    def random_crop(self, input, label):
+        y, x, size = self.random_window(input.shape[-2])
+        input = input[y:y+size, x:x+size, :]
+        label = label[y:y+size, x:x+size]
         return input, label
 
     def __call__(self, args):
@@ -77,30 +213,63 @@ class UniformCrop():
         return input, label, image_path
 
 class ImportanceRandomCrop(UniformCrop):
-    def __call__(self, args):
-        input, label, image_path = args
+    '''
+    Samples the crop position from the label density. Every position on a coarse grid is weighted by the label
+    sum of its window (plus BALANCING_FACTOR), read in O(1) from a summed-area table, the position is then
+    jittered within its grid cell. Densities of the last DENSITY_CACHE_SIZE images are cached (LRU, per worker),
+    so they are only computed once per image as long as the dataset fits.
+    '''
+    BALANCING_FACTOR = 200
+    GRID_STRIDE = 32
+    DENSITY_CACHE_SIZE = 2048
 
-        SAMPLE_SIZE = 5 # an arbitrary number that I came up with
-        BALANCING_FACTOR = 200
-
-        random_crops = [self.random_crop(input, label) for i in range(SAMPLE_SIZE)]
-        # TODO Multi class vs edge mask
-        weights = []
-        for input, label in random_crops:
-            if label.shape[2] >= 4:
-                # Damage detection, multi class, excluding backround
-                weights.append(label[...,:-1].sum())
-            elif label.shape[2] > 1:
-                # Edge Mask, excluding edge masks
-                weights.append(label[...,0].sum())
-            else:
-                weights.append(label.sum())
-        crop_weights = np.array([label.sum() for input, label in random_crops]) + BALANCING_FACTOR
-        crop_weights = crop_weights / crop_weights.sum()
+    def __init__(self, crop_size):
+        super().__init__(crop_size)
+        self.density_cache = OrderedDict()
+
+    def position_density(self, weight_map):
+        '''
+        :param weight_map: [H, W] label summed over its channels
+        :return: cumulative probabilities of the grid positions, row major
+        '''
+        size = self.crop_size
+        crop_limit = weight_map.shape[-1] - size
+        grid = np.arange(0, crop_limit, self.GRID_STRIDE)
+        y, x = grid[:, None], grid[None, :]
+
+        sat = cv2.integral(weight_map, sdepth=cv2.CV_64F)
+        window_sums = sat[y+size, x+size] - sat[y, x+size] - sat[y+size, x] + sat[y, x]
+        density = (window_sums + self.BALANCING_FACTOR).reshape(-1)
+        return np.cumsum(density / density.sum())
+
+    def choose_window(self, weight_map, key=None):
+        image_size = weight_map.shape[-1]
+        cache_key = (key, image_size)
+        cdf = self.density_cache.get(cache_key) if key is not None else None
+        if cdf is not None:
+            self.density_cache.move_to_end(cache_key)
+        else:
+            cdf = self.position_density(weight_map)
+            if key is not None:
+                self.density_cache[cache_key] = cdf
+                if len(self.density_cache) > self.DENSITY_CACHE_SIZE:
+                    self.density_cache.popitem(last=False)
 
-        sample_idx = np.random.choice(SAMPLE_SIZE, p=crop_weights)
-        input, label = random_crops[sample_idx]
+        crop_limit = image_size - self.crop_size
+        grid_size = -(-crop_limit // self.GRID_STRIDE)
+        cell = min(np.searchsorted(cdf, np.random.random_sample(), side='right'), cdf.size - 1)
+        y, x = np.array(divmod(cell, grid_size)) * self.GRID_STRIDE
+        y += np.random.randint(0, min(self.GRID_STRIDE, crop_limit - y))
+        x += np.random.randint(0, min(self.GRID_STRIDE, crop_limit - x))
+        return y, x, self.crop_size
+
+    def __call__(self, args):
+        input, label, image_path = args
+        weight_map = label.sum(axis=-1) if label.ndim == 3 else label
+        y, x, size = self.choose_window(weight_map.astype(np.float32), key=image_path)
 
+        input = input[y:y+size, x:x+size, :]
+        label = label[y:y+size, x:x+size]
         return input, label, image_path
 
 class IncludeLocalizationMask():
@@ -121,12 +290,12 @@ class IncludeLocalizationMask():
         subdir = 'label_mask' if self.use_gts_mask else 'loc_predicted'
         mask_path = os.path.join(dir_name, subdir, image_name)
 
-        assert os.path.exists(mask_path), 'Mask data is not generated, please double check \n' + mask_path
+        assert image_exists(mask_path), 'Mask data is not generated, please double check \n' + mask_path
 
-        mask = imread_cached(mask_path).astype(np.float32)
+        mask = imread_window(mask_path, getattr(image_path, 'window', None))
         mask = mask[...,0][...,None] # [H, W, 3] -> [H, W, 1]
 
-        input = np.concatenate([input, mask], axis=-1)
+        input = append_channels(input, mask, dtype=np.float32)
 
         return input, label, image_path
 class StackPreDisasterImage():
@@ -145,11 +314,11 @@ class StackPreDisasterImage():
 
         # Read image
         cp_image_path = os.path.join(dir_name, cp_image_name)
-        cp_image = imread_cached(cp_image_path).astype(np.float32)
+        cp_image = imread_window(cp_image_path, getattr(image_path, 'window', None))
 
-        # RGB -> BGR and stack
-        cp_image = bgr2rgb(cp_image)
-        input = np.concatenate([input, cp_image], axis=-1)
+        # RGB -> BGR and stack, the view is only copied once into the stacked input
+        cp_image = cp_image[..., ::-1]
+        input = append_channels(input, cp_image, dtype=np.float32)
         return input, label, image_path
 
 class RandomFlipRotate():
@@ -167,8 +336,9 @@ class RandomFlipRotate():
             input = np.flip(input, axis=1)
             label = np.flip(label, axis=1)
 
-        input = ndimage.rotate(input, _rot, reshape=False).copy()
-        label = ndimage.rotate(label, _rot, reshape=False).copy()
+        # rotate always returns a new array
+        input = ndimage.rotate(input, _rot, reshape=False)
+        label = ndimage.rotate(label, _rot, reshape=False)
         return input, label, image_path
 def bgr2rgb(img):
     return img[..., [2,1,0]]
@@ -195,22 +365,87 @@ class AddLabelChannels():
         return input, new_label, image_path
 
 
+# Canny hysteresis thresholds of the edge channel, one edge map per low threshold
+CANNY_LOW_THRESHOLDS = (10, 20, 50, 80, 100)
+CANNY_HIGH_THRESHOLD = 240
+CANNY_TG22 = 13573 # tan(22.5) in 15 bit fixed point, as in OpenCV
+
+def multi_threshold_canny(img, low_thresholds=CANNY_LOW_THRESHOLDS, high_threshold=CANNY_HIGH_THRESHOLD):
+    '''
+    Equivalent of summing cv2.Canny(img, low, high) * (1 / len(low_thresholds)) over all low thresholds,
+    but the gradients and the non maximum suppression are only computed once, every threshold then only
+    costs one connected components pass for the hysteresis
+    :param img: [H, W] or [H, W, C] uint8, like cv2.Canny the gradient of the strongest channel is used
+    :return: [H, W] uint8, (255 // len(low_thresholds)) * number of thresholds a pixel is an edge at
+    '''
+    dxs = cv2.split(cv2.Sobel(img, cv2.CV_16S, 1, 0, ksize=3, borderType=cv2.BORDER_REPLICATE))
+    dys = cv2.split(cv2.Sobel(img, cv2.CV_16S, 0, 1, ksize=3, borderType=cv2.BORDER_REPLICATE))
+
+    # L1 magnitude, per pixel gradient of the channel with the largest one (first one on ties)
+    dx, dy = dxs[0], dys[0]
+    mag = np.abs(dx) + np.abs(dy)
+    for dx_c, dy_c in zip(dxs[1:], dys[1:]):
+        mag_c = np.abs(dx_c) + np.abs(dy_c)
+        better = mag_c > mag
+        mag = np.where(better, mag_c, mag)
+        dx = np.where(better, dx_c, dx)
+        dy = np.where(better, dy_c, dy)
+
+    # Non maximum suppression along the quantized gradient direction, same comparisons as OpenCV
+    padded = np.pad(mag, 1)
+    xs = np.abs(dx).astype(np.int32)
+    ys = np.abs(dy).astype(np.int32) << 15
+    tg22x = xs * CANNY_TG22
+    horizontal = ys < tg22x
+    vertical = ys > tg22x + (xs << 16)
+    max_horizontal = (mag > padded[1:-1, :-2]) & (mag >= padded[1:-1, 2:])
+    max_vertical = (mag > padded[:-2, 1:-1]) & (mag >= padded[2:, 1:-1])
+    max_diagonal = np.where((dx ^ dy) < 0,
+                            (mag > padded[:-2, 2:]) & (mag > padded[2:, :-2]),
+                            (mag > padded[:-2, :-2]) & (mag > padded[2:, 2:]))
+    local_max = np.where(horizontal, max_horizontal, np.where(vertical, max_vertical, max_diagonal))
+
+    # Hysteresis: weak edges are kept if they are 8-connected to a strong one
+    strong = local_max & (mag > high_threshold)
+    level = 255 // len(low_thresholds)
+    edges = np.zeros(mag.shape, dtype=np.uint8)
+    for low_threshold in low_thresholds:
+        candidates = (local_max & (mag > low_threshold)).view(np.uint8)
+        num_labels, labels = cv2.connectedComponents(candidates, connectivity=8)
+        keep = np.zeros(num_labels, dtype=np.uint8)
+        keep[labels[strong]] = level
+        keep[0] = 0
+        edges += keep[labels]
+    return edges
+
+
 class AddCanny():
 
     def __call__(self, args):
 
         input, label, image_path = args
 
-        edges1 = np.expand_dims(cv2.Canny(input, 10, 240), -1) * 0.2
-        edges2 = np.expand_dims(cv2.Canny(input, 20, 240), -1) * 0.2
-        edges3 = np.expand_dims(cv2.Canny(input, 50, 240), -1) * 0.2
-        edges4 = np.expand_dims(cv2.Canny(input, 80, 240), -1) * 0.2
-        edges5 = np.expand_dims(cv2.Canny(input, 100, 240), -1) * 0.2
+        edges = multi_threshold_canny(input)[..., None]
+
+        new_input = append_channels(input, edges)
+
+        return new_input, label, image_path
 
-        edges = np.clip(edges1 + edges2 + edges3 + edges4 + edges5, 0., 255.)
 
-        edges = edges.astype(np.uint8)
+class IncludeCanny():
+    '''
+    Precomputed version of AddCanny, reads the edge channel from canny/ (see preprocess_xview2.py -t canny).
+    The edges are computed on the full image, so place it before any Resize, crop or rotation.
+    '''
+    def __call__(self, args):
+        input, label, image_path = args
+        image_name = os.path.basename(image_path)
+        dir_name = os.path.dirname(image_path)
+        canny_path = os.path.join(dir_name, 'canny', image_name)
+
+        assert image_exists(canny_path), 'Canny channel is not generated, please run preprocess_xview2.py -t canny \n' + canny_path
 
-        new_input = np.concatenate((input, edges), -1)
+        edges = imread_window(canny_path, getattr(image_path, 'window', None))[..., :1]
+        new_input = append_channels(input, edges)
 
         return new_input, label, image_path
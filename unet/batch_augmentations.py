@@ -0,0 +1,84 @@
+#
+# batch_augmentations.py : augmentations applied to whole collated batches, on whatever device the batch lives on.
+#                          Unlike the transforms in augmentations.py, they take and return (x, y) tensors [B, C, H, W]
+
+import math
+
+import torch
+from torch.nn import functional as F
+
+from unet.augmentations import LABEL_INDEX_NONE
+
+
+class BatchRandomFlipRotate():
+    '''
+    Batched RandomFlipRotate: random horizontal / vertical flips and a random rotation (in whole degrees,
+    without reshaping, zero padded) per sample, all folded into one affine grid per sample and sampled in a
+    single grid_sample call. Inputs are interpolated bilinearly, labels with nearest neighbour so they stay
+    valid masks / one hot vectors.
+    '''
+    def __init__(self, input_mode='bilinear', label_mode='nearest'):
+        self.input_mode = input_mode
+        self.label_mode = label_mode
+
+    def random_affine(self, batch_size, height, width, device):
+        '''
+        :return: [B, 2, 3] affine matrices in normalized coordinates, mapping output to input positions
+        '''
+        hflip = torch.randint(0, 2, (batch_size,), device=device) * 2 - 1 # flips rows, like np.flip(axis=0)
+        vflip = torch.randint(0, 2, (batch_size,), device=device) * 2 - 1 # flips columns, like np.flip(axis=1)
+        angle = torch.randint(0, 360, (batch_size,), device=device).float() * (math.pi / 180)
+
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        # Rotation is done in pixel units, so that non square images are not sheared
+        aspect = height / width
+        theta = torch.zeros(batch_size, 2, 3, device=device)
+        theta[:, 0, 0] = cos * vflip
+        theta[:, 0, 1] = -sin * aspect * vflip
+        theta[:, 1, 0] = sin / aspect * hflip
+        theta[:, 1, 1] = cos * hflip
+        return theta
+
+    def __call__(self, x, y):
+        batch_size, _, height, width = x.shape
+        theta = self.random_affine(batch_size, height, width, x.device)
+        grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+
+        x = F.grid_sample(x, grid, mode=self.input_mode, padding_mode='zeros', align_corners=False)
+        # Labels may be integer class maps, grid_sample only works on floats
+        y_dtype = y.dtype
+        y = F.grid_sample(y.float(), grid.to(y.device), mode=self.label_mode, padding_mode='zeros', align_corners=False)
+        return x, y.to(y_dtype)
+
+
+class BatchToDevice():
+    '''
+    Moves a collated batch to the device, converting uint8 transported batches (see Npy2Torch keep_uint8) on
+    the device: inputs are cast and scaled in one step, class index labels are expanded to their float layout.
+    Float batches are only moved.
+    :param input_scale: factor applied to uint8 inputs, a list gives one factor per channel
+                        (1 / 255 is what Npy2Torch applies to uint8 images, 1 for inputs that were float in the workers)
+    :param label_channels: number of label channels, class indices are expanded to one hot when > 1
+    '''
+    def __init__(self, device, input_scale=1 / 255, label_channels=1, none_index=LABEL_INDEX_NONE):
+        self.device = device
+        self.input_scale = torch.tensor(input_scale, dtype=torch.float32, device=device).reshape(1, -1, 1, 1)
+        self.label_channels = label_channels
+        # Class index -> one hot, the none index maps to an all zero vector
+        lut = torch.zeros(256, label_channels, device=device)
+        lut[:label_channels] = torch.eye(label_channels, device=device)
+        lut[none_index] = 0
+        self.one_hot_lut = lut
+
+    def __call__(self, x, y):
+        x = x.to(self.device, non_blocking=True)
+        if x.dtype == torch.uint8:
+            x = torch.mul(x, self.input_scale) # promotes to float32
+
+        y = y.to(self.device, non_blocking=True)
+        if y.dtype == torch.uint8:
+            if self.label_channels == 1:
+                y = y[:, None].float()
+            else:
+                y = self.one_hot_lut[y.long()].permute(0, 3, 1, 2).contiguous()
+        return x, y
@@ -4,8 +4,11 @@
 
 import os
 import torch
-import json
 from unet.utils import *
+from unet.label_store import ensure_label_store, rasterize_buildings, rasterize_damage_classes, damage_one_hot_lut
+from unet.tile_store import TileStore, register_tile_store
+from unet.labels_index import LabelsIndex, load_labels, file_names
+from unet.augmentations import LABEL_INDEX_NONE
 
 
 
@@ -13,6 +16,9 @@ class Xview2Detectron2Dataset(torch.utils.data.Dataset):
     '''
     Dataset for Detectron2 style labelled Dataset
     '''
+    label_store_kind = 'building_mask'
+    label_channels = 1
+
     def __init__(self, file_path,
                  pre_or_post,
                  include_index=False,
@@ -20,14 +26,16 @@ class Xview2Detectron2Dataset(torch.utils.data.Dataset):
                  transform = None,
                  include_edge_mask= False,
                  edge_mask_type = '',
-                 use_clahe = False
-
+                 use_clahe = False,
+                 use_label_store = False,
+                 use_tile_store = False,
+                 use_labels_index = False,
+                 crop_first = None,
                  ):
         super().__init__()
 
-        ds_path = os.path.join(file_path,'labels.json')
-        with open(ds_path) as f:
-            ds = json.load(f)
+        # With the labels index, metadata is memory mapped column by column instead of parsed into dicts
+        ds = load_labels(file_path, use_index=use_labels_index)
         self.dataset_metadata = ds
         self.dataset_path = file_path
 
@@ -41,22 +49,35 @@ class Xview2Detectron2Dataset(torch.utils.data.Dataset):
         self.include_edge_mask = include_edge_mask
         self.edge_mask_type = edge_mask_type
         self.use_clahe = use_clahe
+        # Crop transform (UniformCrop or ImportanceRandomCrop) applied before the input is read, it must not be part of transform
+        self.crop_first = crop_first
+        self.use_tile_store = use_tile_store
+        if use_tile_store:
+            # Images and labels (including the sibling files read by the transforms) are served from the packed tile store
+            self.tile_store = TileStore(file_path)
+            register_tile_store(self.tile_store)
+        self.use_label_store = use_label_store or use_tile_store
+        if self.use_label_store:
+            # Labels are served from the pre-rasterized store only, it is built on first use
+            self.label_store = self._load_label_store()
+            assert len(self.label_store) == self.length, 'Label store is out of date, please delete and rebuild it'
 
 
     def __getitem__(self, index):
-        data_sample = self.dataset_metadata[index][self.pre_or_post]
+        data_sample = self._data_sample(index)
 
         sample_name = data_sample['file_name']
-        input =self._process_input(sample_name)
-        label = self._extract_label(data_sample['annotations'], sample_name)
-        # label = label[None, ...] # C x H x W
-        if self.include_edge_mask:
-            # Edge mask is attached to the
-            edge_mask = self._load_edge_mask(sample_name)
-            label = np.concatenate([edge_mask, label], axis=-1)
+        image_path = os.path.join(self.dataset_path, sample_name)
+        if self.crop_first:
+            # The window is chosen from the label, only that window of the input is read
+            label, window = self._load_label_window(index, data_sample)
+            input = self._process_input(sample_name, window)
+            image_path = WindowedPath(image_path, window)
+        else:
+            input = self._process_input(sample_name)
+            label = self._load_label(index, data_sample)
 
         if self.transform:
-            image_path = os.path.join(self.dataset_path, sample_name)
             input, label, _ = self.transform([input, label, image_path])
 
 
@@ -73,41 +94,89 @@ class Xview2Detectron2Dataset(torch.utils.data.Dataset):
             if hasattr(data_sample, 'image_weight'):
                 ret['image_weight'] = data_sample['image_weight']
             else:
-                ret['image_weight'] = label.sum()
+                ret['image_weight'] = self._label_weight(label)
 
         return ret
 
+    def _label_weight(self, label):
+        return label.sum()
+
+    def _data_sample(self, index):
+        if isinstance(self.dataset_metadata, LabelsIndex):
+            # Only rebuild the view we need
+            return self.dataset_metadata.record(index, self.pre_or_post)
+        return self.dataset_metadata[index][self.pre_or_post]
+
+    def _load_label(self, index, data_sample):
+        if self.use_label_store:
+            label = self._load_stored_label(index)
+        else:
+            label = self._extract_label(data_sample['annotations'], data_sample['file_name'])
+        # label = label[None, ...] # C x H x W
+        if self.include_edge_mask:
+            # Edge mask is attached to the
+            edge_mask = self._load_edge_mask(data_sample['file_name'])
+            label = np.concatenate([edge_mask, label], axis=-1)
+        return label
+
+    def _load_label_window(self, index, data_sample):
+        '''
+        Crop first mode: picks the crop window from the label and crops the label
+        :return: cropped label, window (y, x, size)
+        '''
+        image_path = os.path.join(self.dataset_path, data_sample['file_name'])
+        if self.use_label_store and not self.include_edge_mask:
+            # Window is chosen on the compact raster, only the window is expanded
+            raster = self.label_store[index]
+            window = self.crop_first.choose_window(self._stored_label_weights(raster), key=image_path)
+            y, x, size = window
+            return self._expand_stored_label(raster[y:y+size, x:x+size]), window
+
+        label = self._load_label(index, data_sample)
+        window = self.crop_first.choose_window(label.sum(axis=-1), key=image_path)
+        y, x, size = window
+        return label[y:y+size, x:x+size], window
+
     def _extract_label(self, annotations_set, sample_name):
 
         # Load preprocessed mask if exist
         mask_path = os.path.join(self.dataset_path, 'label_mask',sample_name)
-        if os.path.exists(mask_path):
+        if image_exists(mask_path):
             mask = imread_cached(mask_path)[...,[0]].astype(np.float32)
             return mask
 
-        building_polygons = []
-        for anno in annotations_set:
-            building_polygon_xy = np.array(anno['segmentation'][0], dtype=np.int32).reshape(-1, 2)
-            building_polygons.append(building_polygon_xy)
+        mask = rasterize_buildings(annotations_set)[..., None].astype(np.float32)
+        return mask
 
-        mask2 = np.zeros((1024, 1024, 1), dtype=np.uint8)
-        cv2.fillPoly(mask2, building_polygons, 1)
-        mask = mask2.astype(np.float32)
+    def _load_label_store(self):
+        if self.use_tile_store:
+            return self.tile_store.labels(self.label_store_kind, file_names(self.dataset_metadata, self.pre_or_post))
+        return ensure_label_store(self.dataset_path, self.label_store_kind, self.pre_or_post, self.dataset_metadata)
+
+    def _load_stored_label(self, index):
+        return self._expand_stored_label(self.label_store[index])
+
+    def _expand_stored_label(self, raster):
+        mask = raster[..., None].astype(np.float32) # [H, W, 1]
         return mask
 
-    def _process_input(self, image_filename):
+    def _stored_label_weights(self, raster):
+        # Per pixel sum of the expanded label
+        return raster
+
+    def _process_input(self, image_filename, window=None):
         if self.use_clahe:
             img_path = os.path.join(self.dataset_path,'clahe', image_filename)
-            img = imread_cached(img_path)
+            img = imread_window(img_path, window)
             if img is None:
                 # For whatever reason the image can be blank
                 img_path = os.path.join(self.dataset_path, image_filename)
-                img = imread_cached(img_path)
+                img = imread_window(img_path, window)
             return img
 
         else:
             img_path = os.path.join(self.dataset_path, image_filename)
-        img = imread_cached(img_path)
+        img = imread_window(img_path, window)
         return img
 
     def _load_edge_mask(self, sample_name):
@@ -129,53 +198,39 @@ class Xview2Detectron2Dataset(torch.utils.data.Dataset):
         return self.length
 
 class Xview2Detectron2DamageLevelDataset(Xview2Detectron2Dataset):
+    label_store_kind = 'damage_class'
 
     def __init__(self, file_path,
                  pre_or_post,
                  background_class = 'new-channel',
                  *args, **kwargs
                  ):
-        super().__init__(file_path, pre_or_post, *args, **kwargs)
         self.background_class = background_class
+        self.one_hot_lut = damage_one_hot_lut(background_class)
+        self.class_weights = self.one_hot_lut.sum(axis=-1)
+        self.label_channels = self.one_hot_lut.shape[1]
+        super().__init__(file_path, pre_or_post, *args, **kwargs)
 
     def _extract_label(self, annotations_set, sample_name):
-        # TODO This data can be preprocessed
-        # TODO Resolve overlapping data in preprocessed data
-        NUM_CLASSES = 4
-
-        buildings_polygons = [[] for _ in range(NUM_CLASSES)]
-
-        # Distribute buildings to their respective classes
-        negative_damage_level_count = 0
-        unclassified_damage_level_count = 0
-        for anno in annotations_set:
-            damage_level = anno['damage_level']
-
-            # assert damage_level >= -1, 'damage level error, did you use positive damage?'
-
-            if damage_level == 4:
-                damage_level = 0
-                # TODO Decide what to do with unclassified labels
-
-            building_polygon_xy = np.array(anno['segmentation'][0], dtype=np.int32).reshape(-1, 2)
-            buildings_polygons[damage_level].append(building_polygon_xy)
-
-        masks = []
-        for class_idx, building_poly in enumerate(buildings_polygons):
-            mask = np.zeros((1024, 1024,), dtype=np.uint8)
-            cv2.fillPoly(mask, building_poly, 1)
-            masks.append(mask)
-        masks = np.dstack(masks).astype(np.float32)
-        if self.background_class == 'new-class':
-            positive_px = masks.sum(axis=-1, keepdims=True)
-            bg = 1 - positive_px
-            masks = np.concatenate([masks, bg], axis = -1)
-        elif self.background_class == 'no-damage':
-            # all the background pixels grouped with no-damage
-            positive_px = masks[..., 1:].sum(axis=-1)
-            masks[..., 0] = 1 - positive_px
-        else:
-            masks = masks
+        raster = rasterize_damage_classes(annotations_set)
+        return self._expand_damage_classes(raster)
+
+    def _label_weight(self, label):
+        if torch.is_tensor(label) and label.dtype == torch.uint8:
+            # Class indices (uint8 transport), count the pixels that have a class like the one hot sum does
+            return (label != LABEL_INDEX_NONE).sum()
+        return label.sum()
 
-        return masks
+    def _expand_stored_label(self, raster):
+        return self._expand_damage_classes(raster)
 
+    def _stored_label_weights(self, raster):
+        return self.class_weights[raster]
+
+    def _expand_damage_classes(self, raster):
+        '''
+        Expands a class index raster (see rasterize_damage_classes) to the one hot layout
+        given by background_class ('new-class', 'no-damage' or None)
+        :return: [H, W, C] float32
+        '''
+        return self.one_hot_lut[raster]
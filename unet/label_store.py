@@ -0,0 +1,198 @@
+#
+# label_store.py : packed on-disk stores of pre-rasterized xView2 labels, so
+#                  that polygons are rasterized once instead of every epoch
+
+import os
+import json
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import cv2
+
+from unet.labels_index import file_names, labels_stamp
+
+LABEL_STORE_DIR = 'label_store'
+IMAGE_SIZE = 1024
+NUM_DAMAGE_CLASSES = 4
+
+
+def rasterize_buildings(annotations_set, image_size=IMAGE_SIZE):
+    '''
+    Rasterizes all building polygons of an image into a binary mask
+    :param annotations_set: list of annotations from labels.json
+    :return: [H, W] uint8 mask, 1 = building
+    '''
+    building_polygons = []
+    for anno in annotations_set:
+        building_polygon_xy = np.array(anno['segmentation'][0], dtype=np.int32).reshape(-1, 2)
+        building_polygons.append(building_polygon_xy)
+
+    mask = np.zeros((image_size, image_size), dtype=np.uint8)
+    cv2.fillPoly(mask, building_polygons, 1)
+    return mask
+
+
+def rasterize_damage_classes(annotations_set, image_size=IMAGE_SIZE):
+    '''
+    Rasterizes all building polygons of an image into a single class index raster.
+    0 is background and 1 + damage_level is a building. Unclassified buildings (damage level 4) are
+    counted as no-damage. Where polygons overlap, the most severe damage level wins.
+    :param annotations_set: list of annotations from labels.json
+    :return: [H, W] uint8 class index raster
+    '''
+    buildings_polygons = [[] for _ in range(NUM_DAMAGE_CLASSES)]
+    for anno in annotations_set:
+        damage_level = anno['damage_level']
+        if damage_level == 4:
+            damage_level = 0
+
+        building_polygon_xy = np.array(anno['segmentation'][0], dtype=np.int32).reshape(-1, 2)
+        buildings_polygons[damage_level].append(building_polygon_xy)
+
+    raster = np.zeros((image_size, image_size), dtype=np.uint8)
+    # Drawn from least to most severe, so later classes overwrite overlapping pixels
+    for class_idx, building_poly in enumerate(buildings_polygons):
+        cv2.fillPoly(raster, building_poly, class_idx + 1)
+    return raster
+
+
+def damage_one_hot_lut(background_class):
+    '''
+    Look up table that expands a class index raster into the one hot layout used by the damage models
+    :param background_class: 'new-class' (bg is the last channel), 'no-damage' (bg grouped with no-damage) or None (no bg)
+    :return: [NUM_DAMAGE_CLASSES + 1, C] float32, index it with the raster to get [H, W, C]
+    '''
+    eye = np.eye(NUM_DAMAGE_CLASSES + 1, dtype=np.float32)
+    if background_class == 'new-class':
+        return eye[[NUM_DAMAGE_CLASSES, 0, 1, 2, 3]]
+    elif background_class == 'no-damage':
+        return eye[[0, 0, 1, 2, 3], :NUM_DAMAGE_CLASSES]
+    else:
+        return eye[:, 1:]
+
+
+# kind -> (rasterizer, bit packed)
+# Binary masks are packed 8 pixels per byte along the width axis
+STORE_KINDS = {
+    'building_mask': (rasterize_buildings, True),
+    'damage_class': (rasterize_damage_classes, False),
+}
+
+def label_store_path(dataset_path, kind, pre_or_post):
+    return os.path.join(dataset_path, LABEL_STORE_DIR, f'{kind}_{pre_or_post}.npy')
+
+
+def label_store_is_valid(dataset_path, kind, pre_or_post):
+    '''
+    :return: True if the store is built and labels.json did not change since
+    '''
+    path = label_store_path(dataset_path, kind, pre_or_post)
+    if not (os.path.exists(path) and os.path.exists(path + '.json')):
+        return False
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    stamp = labels_stamp(dataset_path)
+    # A store shipped without its labels.json can't be checked
+    return stamp is None or meta.get('labels_stamp') == stamp
+
+
+class LabelStore():
+    '''
+    Read access to a label store, rasters are stored in the same order as labels.json
+    '''
+    def __init__(self, dataset_path, kind, pre_or_post):
+        self.path = label_store_path(dataset_path, kind, pre_or_post)
+        assert label_store_is_valid(dataset_path, kind, pre_or_post), \
+            'Label store is not built or older than labels.json, please run preprocess_xview2.py \n' + self.path
+        with open(self.path + '.json') as f:
+            self.file_names = json.load(f)['file_names']
+        self.bit_packed = STORE_KINDS[kind][1]
+        self._data = None
+
+    def _open(self):
+        # Opened lazily so that every DataLoader worker maps the file on its own
+        if self._data is None:
+            self._data = np.load(self.path, mmap_mode='r')
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __getitem__(self, index):
+        raster = self._open()[index]
+        if self.bit_packed:
+            raster = np.unpackbits(raster, axis=-1)
+        return raster # [H, W] uint8
+
+    def __len__(self):
+        return len(self.file_names)
+
+
+def _rasterize_rows_worker(args):
+    store_path, kind, pre_or_post, rows = args
+    rasterize, bit_packed = STORE_KINDS[kind]
+    store = np.load(store_path, mmap_mode='r+')
+    for index in rows:
+        raster = rasterize(_worker_metadata[index][pre_or_post]['annotations'])
+        store[index] = np.packbits(raster, axis=-1) if bit_packed else raster
+    store.flush()
+    return len(rows)
+
+def _init_worker(dataset_metadata):
+    global _worker_metadata
+    _worker_metadata = dataset_metadata
+
+
+def build_label_store(dataset_path, kind, pre_or_post, dataset_metadata=None, num_workers=None, chunk_size=64):
+    '''
+    Rasterizes every annotation of a split into a label store
+    :param kind: one of STORE_KINDS
+    :param dataset_metadata: parsed labels.json, loaded from dataset_path if not provided
+    :param num_workers: number of rasterization processes, defaults to all cores
+    :return: path to the store
+    '''
+    # Taken before reading, a labels.json written meanwhile makes the store stale instead of silently newer
+    stamp = labels_stamp(dataset_path)
+    if dataset_metadata is None:
+        with open(os.path.join(dataset_path, 'labels.json')) as f:
+            dataset_metadata = json.load(f)
+    num_workers = num_workers or cpu_count()
+    bit_packed = STORE_KINDS[kind][1]
+
+    store_path = label_store_path(dataset_path, kind, pre_or_post)
+    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    tmp_path = store_path + f'.tmp{os.getpid()}.npy'
+
+    length = len(dataset_metadata)
+    width = IMAGE_SIZE // 8 if bit_packed else IMAGE_SIZE
+    store = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(length, IMAGE_SIZE, width))
+    del store
+
+    print(f'building {kind} {pre_or_post} store for {length} images...', end='', flush=True)
+    jobs = [(tmp_path, kind, pre_or_post, range(i, min(i + chunk_size, length))) for i in range(0, length, chunk_size)]
+    with Pool(num_workers, initializer=_init_worker, initargs=(dataset_metadata,)) as p:
+        for _ in p.imap_unordered(_rasterize_rows_worker, jobs):
+            pass
+
+    # Atomic so that concurrent runs never see a half written store
+    os.replace(tmp_path, store_path)
+    # The meta data goes last: until it is replaced as well, the previous stamp no longer matches the changed
+    # labels.json and the store is considered stale
+    tmp_meta_path = store_path + f'.tmp{os.getpid()}.json'
+    with open(tmp_meta_path, 'w') as f:
+        json.dump({'file_names': file_names(dataset_metadata, pre_or_post), 'labels_stamp': stamp}, f)
+    os.replace(tmp_meta_path, store_path + '.json')
+    print('done', flush=True)
+    return store_path
+
+
+def ensure_label_store(dataset_path, kind, pre_or_post, dataset_metadata=None, num_workers=None):
+    '''
+    Builds the label store if it doesn't exist yet or is older than labels.json
+    :return: LabelStore
+    '''
+    if not label_store_is_valid(dataset_path, kind, pre_or_post):
+        build_label_store(dataset_path, kind, pre_or_post, dataset_metadata, num_workers)
+    return LabelStore(dataset_path, kind, pre_or_post)
@@ -0,0 +1,302 @@
+#
+# labels_index.py : compact columnar version of labels.json. Columns are plain .npy files that are
+#                   memory mapped on first access, so DataLoader workers share clean pages instead of
+#                   each holding (and dirtying, through refcounts) the whole nested dict tree
+
+import os
+import json
+import shutil
+
+import numpy as np
+
+LABELS_INDEX_DIR = 'labels_index'
+PAIR_VIEWS = ['pre', 'post']
+FLAT_VIEW = '' # detectron2 style labels.json, one record per image
+# Image level keys not every labels.json has, they only get a column if all the records have them
+OPTIONAL_IMAGE_KEYS = [('height', np.int32), ('width', np.int32), ('image_weight', np.float64), ('img_id', np.int64)]
+# Same for the annotation level keys (detectron2 style labels.json)
+OPTIONAL_ANNO_KEYS = [('category_id', np.int32), ('iscrowd', np.int8)]
+# Bumped whenever the layout changes, older indices are rebuilt
+INDEX_VERSION = 2
+
+
+def labels_stamp(dataset_path):
+    '''
+    Changes whenever labels.json is regenerated, stores derived from it keep the stamp they were built from
+    :return: [size, mtime in ns] of labels.json, None if there is none
+    '''
+    labels_path = os.path.join(dataset_path, 'labels.json')
+    if not os.path.exists(labels_path):
+        return None
+    stat = os.stat(labels_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def replace_dir(tmp_dir, target_dir):
+    '''
+    Moves a freshly built directory in place of target_dir. The old one is moved aside first, os.replace
+    only replaces empty directories. If a concurrent build got there first its result is kept
+    '''
+    old_dir = f'{target_dir}.old{os.getpid()}'
+    try:
+        os.rename(target_dir, old_dir)
+    except FileNotFoundError:
+        old_dir = None
+    try:
+        os.replace(tmp_dir, target_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _annotation_columns(anno):
+    '''
+    Normalizes both annotation formats found in our labels.json files:
+    dicts with a 'segmentation' list of flat polygons, or plain lists of [x, y] pairs (a single polygon)
+    :return: list of polygons [V, 2], bbox [x1, y1, x2, y2], damage level (-1 if unknown)
+    '''
+    if isinstance(anno, dict):
+        polygons = [np.array(polygon, dtype=np.float64).reshape(-1, 2) for polygon in anno['segmentation']]
+        bbox = anno.get('bbox')
+        damage_level = anno.get('damage_level', -1)
+    else:
+        polygons = [np.array(anno, dtype=np.float64).reshape(-1, 2)]
+        bbox = None
+        damage_level = -1
+    if bbox is None:
+        points = np.concatenate(polygons)
+        bbox = [*points.min(axis=0), *points.max(axis=0)]
+    return polygons, bbox, damage_level
+
+
+def build_labels_index(dataset_path, dataset_metadata=None):
+    '''
+    Converts labels.json of a split into a columnar index in labels_index/
+    Per view (pre/post, or a single one for flat files) it stores the image level columns, plus
+    annotation offsets into packed bbox, damage level (category id, iscrowd) arrays and into the polygons of the
+    annotations, which have offsets into the packed vertices
+    The index is built in a temporary directory and swapped in when complete, so readers and concurrent
+    builders never see a half written one
+    :param dataset_metadata: parsed labels.json, loaded from dataset_path if not provided
+    :return: path to the index
+    '''
+    # Taken before reading, a labels.json written meanwhile makes the index stale instead of silently newer
+    stamp = labels_stamp(dataset_path)
+    if dataset_metadata is None:
+        with open(os.path.join(dataset_path, 'labels.json')) as f:
+            dataset_metadata = json.load(f)
+
+    index_dir = os.path.join(dataset_path, LABELS_INDEX_DIR)
+    tmp_dir = f'{index_dir}.tmp{os.getpid()}'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    is_pair = len(dataset_metadata) > 0 and 'pre' in dataset_metadata[0]
+    views = PAIR_VIEWS if is_pair else [FLAT_VIEW]
+    print(f'building labels index for {len(dataset_metadata)} images...', end='', flush=True)
+
+    columns = []
+    for view in views:
+        records = [image_desc[view] for image_desc in dataset_metadata] if is_pair else dataset_metadata
+
+        image_columns = {
+            'file_name': np.array([record['file_name'] for record in records]),
+        }
+        for optional_key, dtype in OPTIONAL_IMAGE_KEYS:
+            if len(records) > 0 and all(optional_key in record for record in records):
+                image_columns[optional_key] = np.array([record[optional_key] for record in records], dtype=dtype)
+
+        anno_offsets = [0]
+        seg_offsets = [0]
+        poly_offsets = [0]
+        polygons, bboxes, damage_levels = [], [], []
+        for record in records:
+            for anno in record['annotations']:
+                anno_polygons, bbox, damage_level = _annotation_columns(anno)
+                for polygon in anno_polygons:
+                    polygons.append(polygon)
+                    poly_offsets.append(poly_offsets[-1] + len(polygon))
+                seg_offsets.append(len(polygons))
+                bboxes.append(bbox)
+                damage_levels.append(damage_level)
+            anno_offsets.append(len(bboxes))
+
+        anno_columns = {
+            'anno_offsets': np.array(anno_offsets, dtype=np.int64),
+            'seg_offsets': np.array(seg_offsets, dtype=np.int64),
+            'poly_offsets': np.array(poly_offsets, dtype=np.int64),
+            'coords': np.concatenate(polygons) if polygons else np.zeros((0, 2), dtype=np.float64),
+            'bbox': np.array(bboxes, dtype=np.float64).reshape(-1, 4),
+            'damage_level': np.array(damage_levels, dtype=np.int8),
+        }
+        annotations = [anno for record in records for anno in record['annotations']]
+        for optional_key, dtype in OPTIONAL_ANNO_KEYS:
+            if len(annotations) > 0 and all(isinstance(anno, dict) and optional_key in anno for anno in annotations):
+                anno_columns[optional_key] = np.array([anno[optional_key] for anno in annotations], dtype=dtype)
+        for name, column in {**image_columns, **anno_columns}.items():
+            np.save(os.path.join(tmp_dir, f'{_column_name(name, view)}.npy'), column)
+            columns.append(_column_name(name, view))
+
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'version': INDEX_VERSION, 'length': len(dataset_metadata), 'views': views, 'columns': columns,
+                   'labels_stamp': stamp}, f)
+    replace_dir(tmp_dir, index_dir)
+    print('done', flush=True)
+    return index_dir
+
+
+def labels_index_is_valid(dataset_path):
+    '''
+    :return: True if the index is built, in the current layout, and labels.json did not change since
+    '''
+    meta_path = os.path.join(dataset_path, LABELS_INDEX_DIR, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get('version') != INDEX_VERSION:
+        return False
+    stamp = labels_stamp(dataset_path)
+    # An index shipped without its labels.json can't be checked
+    return stamp is None or meta.get('labels_stamp') == stamp
+
+
+def _column_name(name, view):
+    return f'{view}_{name}' if view else name
+
+
+class LabelsIndex():
+    '''
+    Lazily loaded, read-only stand-in for the parsed labels.json list.
+    index[i] rebuilds the record of image i (with 'file_name', 'height', 'width', 'annotations', ...),
+    the column accessors avoid building dicts altogether.
+    '''
+    def __init__(self, dataset_path):
+        self.index_dir = os.path.join(dataset_path, LABELS_INDEX_DIR)
+        with open(os.path.join(self.index_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.length = meta['length']
+        self.views = meta['views']
+        self.column_names = set(meta['columns'])
+        self._columns = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_columns'] = {}
+        return state
+
+    def has_column(self, name, view=FLAT_VIEW):
+        return _column_name(name, view) in self.column_names
+
+    def column(self, name, view=FLAT_VIEW):
+        key = _column_name(name, view)
+        if key not in self._columns:
+            self._columns[key] = np.load(os.path.join(self.index_dir, f'{key}.npy'), mmap_mode='r')
+        return self._columns[key]
+
+    def _anno_range(self, index, view):
+        anno_offsets = self.column('anno_offsets', view)
+        return int(anno_offsets[index]), int(anno_offsets[index + 1])
+
+    def num_annotations(self, index, view=FLAT_VIEW):
+        start, stop = self._anno_range(index, view)
+        return stop - start
+
+    def segmentations(self, index, view=FLAT_VIEW):
+        '''
+        :return: list of the polygons of every annotation of image index, [V, 2] float64 each
+        '''
+        start, stop = self._anno_range(index, view)
+        seg_offsets = np.asarray(self.column('seg_offsets', view)[start:stop + 1])
+        poly_offsets = self.column('poly_offsets', view)[seg_offsets[0]:seg_offsets[-1] + 1]
+        coords = self.column('coords', view)[poly_offsets[0]:poly_offsets[-1]]
+        polygons = np.split(np.asarray(coords), poly_offsets[1:-1] - poly_offsets[0])
+        return [polygons[seg_start:seg_stop] for seg_start, seg_stop in zip(seg_offsets[:-1] - seg_offsets[0],
+                                                                            seg_offsets[1:] - seg_offsets[0])]
+
+    def polygons(self, index, view=FLAT_VIEW):
+        '''
+        :return: list of the first (outer) [V, 2] float64 polygon of every annotation of image index,
+                 the one the rasterizers use
+        '''
+        return [polygons[0] for polygons in self.segmentations(index, view)]
+
+    def bboxes(self, index, view=FLAT_VIEW):
+        start, stop = self._anno_range(index, view)
+        return np.asarray(self.column('bbox', view)[start:stop])
+
+    def damage_levels(self, index, view=FLAT_VIEW):
+        start, stop = self._anno_range(index, view)
+        return np.asarray(self.column('damage_level', view)[start:stop])
+
+    def annotation_column(self, name, index, view=FLAT_VIEW):
+        '''
+        :return: values of an annotation level column (e.g. category_id) for the annotations of image index
+        '''
+        start, stop = self._anno_range(index, view)
+        return np.asarray(self.column(name, view)[start:stop])
+
+    def record(self, index, view=FLAT_VIEW):
+        record = {
+            'file_name': str(self.column('file_name', view)[index]),
+        }
+        for optional_key, _ in OPTIONAL_IMAGE_KEYS:
+            if self.has_column(optional_key, view):
+                record[optional_key] = self.column(optional_key, view)[index].item()
+
+        record['annotations'] = [
+            {
+                'segmentation': [polygon.reshape(-1).tolist() for polygon in polygons],
+                'bbox': bbox.tolist(),
+                'damage_level': int(damage_level),
+            }
+            for polygons, bbox, damage_level in zip(self.segmentations(index, view), self.bboxes(index, view), self.damage_levels(index, view))
+        ]
+        for optional_key, _ in OPTIONAL_ANNO_KEYS:
+            if self.has_column(optional_key, view):
+                for anno, value in zip(record['annotations'], self.annotation_column(optional_key, index, view)):
+                    anno[optional_key] = value.item()
+        return record
+
+    def __getitem__(self, index):
+        if self.views == [FLAT_VIEW]:
+            return self.record(index)
+        return {view: self.record(index, view) for view in self.views}
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield self[index]
+
+    def __len__(self):
+        return self.length
+
+
+def load_labels(dataset_path, use_index=False):
+    '''
+    Loads the labels of a split
+    :param use_index: if True, return the lazily loaded LabelsIndex (built on first use, rebuilt when labels.json
+                      changed) instead of the parsed json
+    '''
+    if not use_index:
+        with open(os.path.join(dataset_path, 'labels.json')) as f:
+            return json.load(f)
+
+    if not labels_index_is_valid(dataset_path):
+        build_labels_index(dataset_path)
+    return LabelsIndex(dataset_path)
+
+
+def image_weights(dataset_metadata, pre_or_post):
+    '''
+    Column of precomputed image weights (used for oversampling), without touching the annotations
+    '''
+    if isinstance(dataset_metadata, LabelsIndex):
+        return np.asarray(dataset_metadata.column('image_weight', pre_or_post))
+    return np.array([image_desc[pre_or_post]['image_weight'] for image_desc in dataset_metadata])
+
+
+def file_names(dataset_metadata, pre_or_post):
+    if isinstance(dataset_metadata, LabelsIndex):
+        return [str(file_name) for file_name in dataset_metadata.column('file_name', pre_or_post)]
+    return [image_desc[pre_or_post]['file_name'] for image_desc in dataset_metadata]
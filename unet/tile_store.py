@@ -0,0 +1,248 @@
+#
+# tile_store.py : packs all images and label rasters of an xView2 split into a single
+#                 memory mapped file, served as zero-copy slices instead of thousands of PNGs
+
+import os
+import json
+import uuid
+import hashlib
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import cv2
+from PIL import Image
+
+from unet.label_store import IMAGE_SIZE, rasterize_buildings, rasterize_damage_classes
+from unet.labels_index import labels_stamp
+
+TILE_STORE_DIR = 'tile_store'
+PAGE_SIZE = 4096
+
+# Sub directories the label rasters are stored under, they mirror the PNG layout of the split (e.g. label_mask/)
+LABEL_SUBDIRS = {
+    'building_mask': 'label_mask',
+    'damage_class': 'damage_class',
+}
+
+
+class TileStore():
+    '''
+    Read access to a packed tile store. Entries are keyed by their path relative to the split
+    directory (e.g. 'xxx_pre_disaster.png', 'label_mask/xxx_pre_disaster.png') and returned as
+    read-only views into the memory mapped file.
+    :param verify: check that labels.json and the source images did not change since the store was built
+    '''
+    def __init__(self, dataset_path, verify=True):
+        self.dataset_path = os.path.normpath(dataset_path)
+        index_path = os.path.join(dataset_path, TILE_STORE_DIR, 'index.json')
+        rebuild = 'please run preprocess_xview2.py -t tile_store \n' + index_path
+        assert os.path.exists(index_path), 'Tile store is not built, ' + rebuild
+        with open(index_path) as f:
+            meta = json.load(f)
+        assert 'bin' in meta, 'Tile store has an outdated format, ' + rebuild
+        self.path = os.path.join(dataset_path, TILE_STORE_DIR, meta['bin'])
+        assert os.path.exists(self.path) and os.path.getsize(self.path) == meta['size'], \
+            'Tile store data does not match its index, ' + rebuild
+        if verify:
+            assert meta['labels_stamp'] == labels_stamp(dataset_path) \
+                and meta['sources_stamp'] == _sources_stamp(dataset_path, _image_keys(meta['entries'])), \
+                'labels.json or the images changed since the tile store was built, ' + rebuild
+        self.index = meta['entries'] # key -> [offset, shape]
+        self._data = None
+
+    def _open(self):
+        # Opened lazily so that every DataLoader worker maps the file on its own
+        if self._data is None:
+            self._data = np.memmap(self.path, dtype=np.uint8, mode='r')
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, key):
+        offset, shape = self.index[key]
+        nbytes = int(np.prod(shape))
+        return self._open()[offset:offset + nbytes].reshape(shape)
+
+    def labels(self, kind, file_names):
+        return TileStoreLabels(self, LABEL_SUBDIRS[kind], file_names)
+
+
+class TileStoreLabels():
+    '''
+    Label rasters of a tile store in dataset order, same interface as label_store.LabelStore
+    '''
+    def __init__(self, tile_store, subdir, file_names):
+        self.tile_store = tile_store
+        self.keys = [f'{subdir}/{file_name}' for file_name in file_names]
+        missing = [key for key in self.keys if key not in tile_store]
+        assert not missing, f'{len(missing)} label rasters are missing from the tile store, e.g. {missing[0]}'
+
+    def __getitem__(self, index):
+        raster = self.tile_store.get(self.keys[index])
+        return raster.reshape(raster.shape[:2]) # [H, W] uint8
+
+    def __len__(self):
+        return len(self.keys)
+
+
+# ==== Registry used by imread_cached to serve files from tile stores
+
+_tile_stores = {}
+
+def register_tile_store(tile_store):
+    _tile_stores[tile_store.dataset_path] = tile_store
+
+def _resolve(img_path):
+    if not _tile_stores:
+        return None, None
+    img_path = os.path.normpath(img_path)
+    dir_name, file_name = os.path.split(img_path)
+    # Files live either at the root of the split or in one sub directory (e.g. label_mask/)
+    for root, key in [(dir_name, file_name), (os.path.dirname(dir_name), f'{os.path.basename(dir_name)}/{file_name}')]:
+        tile_store = _tile_stores.get(root)
+        if tile_store is not None and key in tile_store:
+            return tile_store, key
+    return None, None
+
+def read_tile(img_path):
+    '''
+    :return: read-only view of img_path if it is packed in a registered tile store, otherwise None
+    '''
+    tile_store, key = _resolve(img_path)
+    if tile_store is None:
+        return None
+    return tile_store.get(key)
+
+def tile_exists(img_path):
+    return _resolve(img_path)[0] is not None
+
+
+# ==== Conversion
+
+def _image_keys(index):
+    # Images are at the root of the split, label rasters in sub directories
+    return sorted(key for key in index if '/' not in key)
+
+def _sources_stamp(dataset_path, file_names):
+    '''
+    Digest of the size and mtime of the source images
+    '''
+    digest = hashlib.sha1()
+    for file_name in file_names:
+        stat = os.stat(os.path.join(dataset_path, file_name))
+        digest.update(f'{file_name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return digest.hexdigest()
+
+def _image_shape(img_path):
+    # Only reads the PNG header, cv2.imread always decodes to 3 channels
+    with Image.open(img_path) as img:
+        width, height = img.size
+    return [height, width, 3]
+
+def _list_entries(dataset_path, dataset_metadata):
+    '''
+    :return: list of (key, kind, source), source is the image path or the annotations of the image
+    '''
+    entries = []
+    for image_desc in dataset_metadata:
+        for pre_or_post in ['pre', 'post']:
+            data_sample = image_desc[pre_or_post]
+            file_name = data_sample['file_name']
+            annotations_set = data_sample['annotations']
+            entries.append((file_name, 'image', os.path.join(dataset_path, file_name)))
+            entries.append((f'{LABEL_SUBDIRS["building_mask"]}/{file_name}', 'building_mask', annotations_set))
+            if pre_or_post == 'post':
+                entries.append((f'{LABEL_SUBDIRS["damage_class"]}/{file_name}', 'damage_class', annotations_set))
+    return entries
+
+def _entry_shape(kind, source):
+    if kind == 'image':
+        return _image_shape(source)
+    elif kind == 'building_mask':
+        return [IMAGE_SIZE, IMAGE_SIZE, 1]
+    return [IMAGE_SIZE, IMAGE_SIZE]
+
+def _pack_entries_worker(args):
+    store_path, rows = args
+    data = np.memmap(store_path, dtype=np.uint8, mode='r+')
+    for i in rows:
+        key, kind, source = _worker_entries[i]
+        offset, shape = _worker_index[key]
+        if kind == 'image':
+            tile = cv2.imread(source)
+        elif kind == 'building_mask':
+            tile = rasterize_buildings(source)
+        else:
+            tile = rasterize_damage_classes(source)
+        assert list(tile.shape[:2]) == shape[:2], f'unexpected shape {tile.shape} for {key}'
+        data[offset:offset + tile.size] = tile.reshape(-1)
+    data.flush()
+    return len(rows)
+
+def _init_worker(entries, index):
+    global _worker_entries, _worker_index
+    _worker_entries, _worker_index = entries, index
+
+
+def build_tile_store(dataset_path, dataset_metadata=None, num_workers=None, chunk_size=32):
+    '''
+    Packs every pre image, post image and label raster of a split into tile_store/tiles.<build id>.bin,
+    with an offset index in tile_store/index.json. Every entry starts on a page boundary.
+    Every build writes a new data file and index.json, which names its data file, is replaced last: readers
+    always see a complete index with the data it was built with. The data of the previous build is deleted.
+    :param dataset_metadata: parsed labels.json, loaded from dataset_path if not provided
+    :param num_workers: number of decoding processes, defaults to all cores
+    :return: path to the store
+    '''
+    # Taken before reading anything, sources changed meanwhile make the store stale instead of silently newer
+    stamp = labels_stamp(dataset_path)
+    if dataset_metadata is None:
+        with open(os.path.join(dataset_path, 'labels.json')) as f:
+            dataset_metadata = json.load(f)
+    num_workers = num_workers or cpu_count()
+
+    store_dir = os.path.join(dataset_path, TILE_STORE_DIR)
+    os.makedirs(store_dir, exist_ok=True)
+    bin_name = f'tiles.{uuid.uuid4().hex[:12]}.bin'
+    store_path = os.path.join(store_dir, bin_name)
+    index_path = os.path.join(store_dir, 'index.json')
+
+    entries = _list_entries(dataset_path, dataset_metadata)
+    index = {}
+    offset = 0
+    for key, kind, source in entries:
+        shape = _entry_shape(kind, source)
+        index[key] = [offset, shape]
+        offset += -(-int(np.prod(shape)) // PAGE_SIZE) * PAGE_SIZE
+    sources_stamp = _sources_stamp(dataset_path, _image_keys(index))
+
+    print(f'packing {len(entries)} tiles ({offset / 1e9:.2f} GB) into the tile store...', end='', flush=True)
+    with open(store_path, 'wb') as f:
+        f.truncate(offset)
+    jobs = [(store_path, range(i, min(i + chunk_size, len(entries)))) for i in range(0, len(entries), chunk_size)]
+    with Pool(num_workers, initializer=_init_worker, initargs=(entries, index)) as p:
+        for _ in p.imap_unordered(_pack_entries_worker, jobs):
+            pass
+
+    previous_bins = ['tiles.bin'] # data file of the unversioned format
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            previous_bins.append(json.load(f).get('bin'))
+
+    tmp_index_path = index_path + f'.tmp{os.getpid()}'
+    with open(tmp_index_path, 'w') as f:
+        json.dump({'bin': bin_name, 'size': offset, 'labels_stamp': stamp, 'sources_stamp': sources_stamp,
+                   'entries': index}, f)
+    # Atomic, this is what publishes the new store
+    os.replace(tmp_index_path, index_path)
+    for previous_bin in previous_bins:
+        if previous_bin and previous_bin != bin_name and os.path.exists(os.path.join(store_dir, previous_bin)):
+            os.remove(os.path.join(store_dir, previous_bin))
+    print('done', flush=True)
+    return store_path
@@ -0,0 +1,87 @@
+#
+# tiled_inference.py : sliding window inference for images of any size. The net only ever sees tiles of a fixed
+#                      size, overlapping tiles are blended with a window that fades out towards the tile borders
+
+import math
+
+import torch
+from torch.nn import functional as F
+
+
+def tile_starts(length, tile_size, stride):
+    '''
+    :return: start offsets of the tiles covering [0, length), the last tile is aligned with the end
+    '''
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, stride))
+    starts.append(length - tile_size)
+    return starts
+
+def blend_window(tile_size, device=None):
+    '''
+    Separable sine window, largest in the tile center where the net has the most context. It never reaches 0, so
+    pixels only covered by the border of a single tile (scene borders) keep their logits
+    :return: [tile_size, tile_size] weights
+    '''
+    ramp = torch.sin(math.pi * (torch.arange(tile_size, dtype=torch.float32, device=device) + 0.5) / tile_size)
+    return ramp[:, None] * ramp[None, :]
+
+class TiledInference():
+    '''
+    Runs the net on overlapping tiles and blends the logits back into full size predictions. Tiles of all the images
+    of a batch are batched together, so memory only depends on tile_size and batch_size, not on the scene size.
+    The blended logits are accumulated on the device of the input, keep large scenes on the cpu to bound the
+    memory of the net device as well.
+    :param tile_size: tile height and width the net is run on, images smaller than that are zero padded
+    :param overlap: number of pixels shared by neighbouring tiles
+    :param batch_size: number of tiles per forward pass
+    '''
+    def __init__(self, net, tile_size=512, overlap=128, batch_size=4):
+        assert 0 <= overlap < tile_size, 'Overlap has to be smaller than the tile size'
+        self.net = net
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+
+    def tile_positions(self, height, width):
+        '''
+        :return: (y, x) offsets of the tiles of one image
+        '''
+        stride = self.tile_size - self.overlap
+        return [(y, x) for y in tile_starts(height, self.tile_size, stride)
+                       for x in tile_starts(width, self.tile_size, stride)]
+
+    def __call__(self, x):
+        '''
+        :param x: [B, C, H, W] input batch
+        :return: [B, K, H, W] blended logits
+        '''
+        batch_size, _, height, width = x.shape
+        size = self.tile_size
+        pad_h, pad_w = max(size - height, 0), max(size - width, 0)
+        if pad_h or pad_w:
+            x = F.pad(x, (0, pad_w, 0, pad_h))
+        padded_height, padded_width = x.shape[-2:]
+
+        net_device = next(self.net.parameters()).device
+        positions = self.tile_positions(padded_height, padded_width)
+        window = blend_window(size, x.device)
+        # Same tiling for every image, the normalization is shared
+        weight_sum = torch.zeros(padded_height, padded_width, device=x.device)
+        for y, x0 in positions:
+            weight_sum[y:y+size, x0:x0+size] += window
+
+        tiles = [(b, y, x0) for b in range(batch_size) for y, x0 in positions]
+        logits = None
+        for i in range(0, len(tiles), self.batch_size):
+            batch_tiles = tiles[i:i + self.batch_size]
+            tile_batch = torch.stack([x[b, :, y:y+size, x0:x0+size] for b, y, x0 in batch_tiles])
+            out = self.net(tile_batch.to(net_device)).to(x.device)
+            if logits is None:
+                logits = torch.zeros(batch_size, out.shape[1], padded_height, padded_width, device=x.device)
+            for (b, y, x0), tile_out in zip(batch_tiles, out):
+                logits[b, :, y:y+size, x0:x0+size] += tile_out * window
+
+        logits /= weight_sum
+        return logits[..., :height, :width]
@@ -0,0 +1,120 @@
+#
+# image_cache.py : LRU cache of decoded images that is shared between DataLoader workers
+
+import ctypes
+import hashlib
+import multiprocessing as mp
+
+import numpy as np
+
+XVIEW2_IMAGE_BYTES = 1024 * 1024 * 3
+
+
+def _path_key(img_path):
+    # Python's str hash is salted per interpreter, so use a stable digest instead (0 marks an empty slot)
+    key = int.from_bytes(hashlib.blake2b(img_path.encode(), digest_size=8).digest(), 'little', signed=True)
+    return key or 1
+
+
+class SharedImageCache():
+    '''
+    Byte bounded LRU cache of decoded uint8 images.
+
+    The cache is a shared memory arena split into equally sized slots, plus a small slot table
+    (key, shape, last use) guarded by a single lock. It has to be created in the main process
+    before the DataLoader forks its workers, every worker then sees the same arena.
+    Images larger than a slot are never cached.
+    '''
+    def __init__(self, max_bytes, slot_bytes=XVIEW2_IMAGE_BYTES):
+        self.slot_bytes = slot_bytes
+        self.num_slots = int(max_bytes // slot_bytes)
+        self.max_bytes = self.num_slots * slot_bytes
+
+        self._arena = mp.RawArray(ctypes.c_uint8, max(self.max_bytes, 1))
+        self._keys = mp.RawArray(ctypes.c_int64, max(self.num_slots, 1))
+        self._shapes = mp.RawArray(ctypes.c_int64, max(self.num_slots, 1) * 3)
+        self._last_used = mp.RawArray(ctypes.c_int64, max(self.num_slots, 1))
+        self._counters = mp.RawArray(ctypes.c_int64, 3) # clock, hits, misses
+        self._lock = mp.Lock()
+
+    def _views(self):
+        arena = np.frombuffer(self._arena, dtype=np.uint8)
+        keys = np.frombuffer(self._keys, dtype=np.int64)
+        shapes = np.frombuffer(self._shapes, dtype=np.int64).reshape(-1, 3)
+        last_used = np.frombuffer(self._last_used, dtype=np.int64)
+        counters = np.frombuffer(self._counters, dtype=np.int64)
+        return arena, keys, shapes, last_used, counters
+
+    def get(self, img_path):
+        '''
+        :return: a private copy of the cached image, or None on a miss
+        '''
+        if self.num_slots == 0:
+            return None
+        key = _path_key(img_path)
+        arena, keys, shapes, last_used, counters = self._views()
+        with self._lock:
+            slots = np.flatnonzero(keys == key)
+            if slots.size == 0:
+                counters[2] += 1
+                return None
+            slot = slots[0]
+            counters[0] += 1
+            counters[1] += 1
+            last_used[slot] = counters[0]
+
+            shape = tuple(d for d in shapes[slot] if d > 0)
+            nbytes = int(np.prod(shape))
+            start = slot * self.slot_bytes
+            # Copied while holding the lock, the slot may be evicted as soon as it is released
+            img = arena[start:start + nbytes].reshape(shape).copy()
+        return img
+
+    def put(self, img_path, img):
+        if self.num_slots == 0 or img is None or img.dtype != np.uint8 or img.nbytes > self.slot_bytes:
+            return
+        key = _path_key(img_path)
+        arena, keys, shapes, last_used, counters = self._views()
+        with self._lock:
+            if (keys == key).any():
+                # Another worker decoded the same image in the meantime
+                return
+            slot = last_used.argmin() # empty slots were never used, so they go first
+            counters[0] += 1
+            keys[slot] = key
+            last_used[slot] = counters[0]
+            shapes[slot] = 0
+            shapes[slot, :img.ndim] = img.shape
+            start = slot * self.slot_bytes
+            arena[start:start + img.nbytes] = img.reshape(-1)
+
+    def stats(self):
+        _, keys, _, _, counters = self._views()
+        hits, misses = int(counters[1]), int(counters[2])
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / max(hits + misses, 1),
+            'entries': int((keys != 0).sum()) if self.num_slots else 0,
+            'max_bytes': self.max_bytes,
+        }
+
+
+_image_cache = None
+
+def configure_image_cache(max_bytes, slot_bytes=XVIEW2_IMAGE_BYTES):
+    '''
+    Sets up the process wide image cache used by imread_cached, a budget of 0 disables it.
+    Has to be called before any DataLoader workers are started.
+    '''
+    global _image_cache
+    _image_cache = SharedImageCache(max_bytes, slot_bytes) if max_bytes > 0 else None
+    return _image_cache
+
+def get_image_cache():
+    return _image_cache
+
+def image_cache_stats():
+    if _image_cache is None:
+        return {'hits': 0, 'misses': 0, 'hit_rate': 0., 'entries': 0, 'max_bytes': 0}
+    return _image_cache.stats()
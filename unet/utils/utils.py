@@ -1,13 +1,110 @@
+import os
 import random
 import numpy as np
 import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import cv2
+from .image_cache import configure_image_cache, get_image_cache, image_cache_stats
+from unet.tile_store import read_tile, tile_exists
 
-# @functools.lru_cache(maxsize= 300)
 def imread_cached(img_path):
-    img = cv2.imread(img_path)
+    '''
+    cv2.imread that first looks into the registered tile stores (zero-copy, read-only)
+    and then into the shared decoded image cache (see configure_image_cache)
+    '''
+    img = read_tile(img_path)
+    if img is not None:
+        return img
+
+    cache = get_image_cache()
+    if cache is None:
+        return cv2.imread(img_path)
+
+    img = cache.get(img_path)
+    if img is None:
+        img = cv2.imread(img_path)
+        cache.put(img_path, img)
     return img
 
+class WindowedPath(str):
+    '''
+    Image path carrying the crop window (y, x, size) chosen by the dataset in crop first mode,
+    so that transforms reading sibling files (masks, pre disaster image, ...) only read that window
+    '''
+    def __new__(cls, path, window):
+        obj = super().__new__(cls, path)
+        obj.window = window
+        return obj
+
+def imread_window(img_path, window=None):
+    '''
+    Reads only the window (y, x, size) of an image. Tile store entries are sliced before anything is
+    paged in, PNGs still have to be decoded in full but are cut before any further processing
+    :return: [size, size, C] image, the full image if window is None
+    '''
+    if window is None:
+        return imread_cached(img_path)
+    y, x, size = window
+    tile = read_tile(img_path)
+    if tile is not None:
+        return np.ascontiguousarray(tile[y:y+size, x:x+size])
+    img = imread_cached(img_path)
+    if img is None:
+        return None
+    return img[y:y+size, x:x+size]
+
+def imwrite_checked(img_path, img):
+    if not cv2.imwrite(img_path, img):
+        raise IOError(f'Could not write {img_path}')
+
+class AsyncImageWriter():
+    '''
+    Encodes and writes images on a thread pool (cv2 releases the GIL while encoding), so that inference never waits
+    on the disk. At most max_pending images are queued, write blocks beyond that so queued predictions can't pile up.
+    Use it as a context manager: leaving waits for all the writes and raises the first error.
+    :param num_threads: writer threads, 0 writes synchronously
+    '''
+    def __init__(self, num_threads=4, max_pending=None):
+        self.executor = ThreadPoolExecutor(max_workers=num_threads) if num_threads > 0 else None
+        self.pending = threading.BoundedSemaphore(max_pending or 4 * max(num_threads, 1))
+        self.errors = []
+
+    def write(self, img_path, img):
+        if self.executor is None:
+            imwrite_checked(img_path, img)
+            return
+        self.pending.acquire()
+        future = self.executor.submit(imwrite_checked, img_path, img)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+        self.pending.release()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.executor is not None:
+            # Don't hide the original error behind a write error
+            self.executor.shutdown(wait=True)
+
+def image_exists(img_path):
+    '''
+    os.path.exists that also knows about the files packed in registered tile stores
+    '''
+    return tile_exists(img_path) or os.path.exists(img_path)
+
 def get_square(img, pos):
     """Extract a left or a right square from ndarray shape : (H, W, C))"""
     h = img.shape[0]